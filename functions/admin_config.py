@@ -0,0 +1,20 @@
+from typing import Any, Dict, List
+from google.cloud.firestore_v1 import Client
+from cache import TTLCache
+
+# admin_configs/current holds the app-wide settings (who may sign up, the default lessons,
+# the LLM models to use, ...). It's edited by hand, rarely, but read on hot paths like
+# sign-up and every LLM call, so each instance keeps it for a minute.
+
+_admin_configs = TTLCache(ttl_sec=60)
+
+
+def get_admin_config(db: Client) -> Dict[str, Any]:
+    return _admin_configs.get_or_load(
+        "current", lambda: db.collection('admin_configs').document("current").get().to_dict()
+    ) or {}
+
+
+def get_admin_config_list(db: Client, key: str) -> List[str]:
+    # Lists are stored as comma-separated strings
+    return [value for value in (get_admin_config(db).get(key) or "").split(',') if value != ""]
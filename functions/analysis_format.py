@@ -0,0 +1,143 @@
+from typing import Any, Dict, List, Optional
+from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion, Client, DocumentReference, transactional
+from google.cloud.firestore_v1.field_path import FieldPath
+from data_model import LessonQuestionAnalysis
+from identity import teacher_refs
+from sync import server_now
+
+# How a question's categorization is stored on the lesson: the ids of the responses in each
+# category (`response_ids_by_category`), and the reverse index (`categories_by_response_id`)
+# so a move doesn't have to search. Lessons used to embed a copy of every response under
+# each of its categories (`responses_by_category`); those are read as-is until migrated.
+# The server fills `responses_by_category` back in from the lesson's responses whenever it
+# returns them together, and clients that only sync can join the ids themselves.
+
+
+def compact_analysis(question_id: str, response_ids_by_category: Dict[str, List[str]]) -> LessonQuestionAnalysis:
+    categories_by_response_id: Dict[str, List[str]] = {}
+    for category, response_ids in response_ids_by_category.items():
+        for response_id in response_ids:
+            categories_by_response_id.setdefault(response_id, []).append(category)
+    return LessonQuestionAnalysis(
+        question_id=question_id,
+        response_ids_by_category=response_ids_by_category,
+        categories_by_response_id=categories_by_response_id,
+    )
+
+
+def to_compact(analysis_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """The stored form of an analysis in either format."""
+    if analysis_dict.get('response_ids_by_category') is not None:
+        return _stored_fields(analysis_dict)
+    response_ids_by_category = {
+        category: [response.get('id') for response in responses]
+        for category, responses in (analysis_dict.get('responses_by_category') or {}).items()
+    }
+    return compact_analysis(analysis_dict.get('question_id'), response_ids_by_category).__dict__
+
+
+def is_compact(analysis_dict: Dict[str, Any]) -> bool:
+    return analysis_dict.get('response_ids_by_category') is not None
+
+
+def analysis_categories(analysis_dict: Dict[str, Any]) -> List[str]:
+    if is_compact(analysis_dict):
+        return list(analysis_dict['response_ids_by_category'].keys())
+    return list((analysis_dict.get('responses_by_category') or {}).keys())
+
+
+def hydrate_analyses(analysis_by_question_id: Optional[Dict[str, Dict[str, Any]]], responses_by_id: Dict[str, Dict[str, Any]]):
+    """Fill in `responses_by_category` (in place) with the current responses, skipping any that are gone."""
+    for question_id, analysis_dict in (analysis_by_question_id or {}).items():
+        if analysis_dict is None:
+            continue
+        analysis_dict.update(to_compact(analysis_dict))
+        analysis_dict['responses_by_category'] = {
+            category: [responses_by_id[response_id] for response_id in response_ids if response_id in responses_by_id]
+            for category, response_ids in analysis_dict['response_ids_by_category'].items()
+        }
+
+
+def analysis_field_path(question_id: str, *field_names: str) -> str:
+    # Question ids and category names can hold characters that need quoting in a field path
+    return FieldPath('analysis_by_question_id', question_id, *field_names).to_api_repr()
+
+
+def move_response(db: Client, lesson_ref: DocumentReference, question_id: str, response_id: str, old_category: str, new_category: str) -> bool:
+    """Move one response to another category. False if the question hasn't been analyzed."""
+    return _move_response(db.transaction(), lesson_ref, question_id, response_id, old_category, new_category)
+
+
+@transactional
+def _move_response(transaction, lesson_ref: DocumentReference, question_id: str, response_id: str, old_category: str, new_category: str) -> bool:
+    lesson_doc = lesson_ref.get(field_paths=[analysis_field_path(question_id)], transaction=transaction)
+    analysis_dict: Optional[Dict[str, Any]] = ((lesson_doc.to_dict() or {}).get('analysis_by_question_id') or {}).get(question_id)
+    if analysis_dict is None:
+        return False
+    if old_category == new_category:
+        return True
+
+    if not is_compact(analysis_dict):
+        # Stored the old way: convert the question's analysis as part of the move
+        analysis_dict = to_compact(analysis_dict)
+        _apply_move(analysis_dict, response_id, old_category, new_category)
+        transaction.update(lesson_ref, {
+            analysis_field_path(question_id): analysis_dict,
+            "updated_at": server_now(),
+        })
+        return True
+
+    categories = list(analysis_dict['categories_by_response_id'].get(response_id) or [])
+    if old_category in categories:
+        categories.remove(old_category)
+    if new_category not in categories:
+        categories.append(new_category)
+    transaction.update(lesson_ref, {
+        analysis_field_path(question_id, 'response_ids_by_category', old_category): ArrayRemove([response_id]),
+        analysis_field_path(question_id, 'response_ids_by_category', new_category): ArrayUnion([response_id]),
+        analysis_field_path(question_id, 'categories_by_response_id', response_id): categories,
+        "updated_at": server_now(),
+    })
+    return True
+
+
+def migrate_analyses(db: Client, teacher_id: Optional[str] = None) -> int:
+    """Convert every embedded analysis (of one teacher, or of everyone) to ids. Returns how many lessons changed."""
+    migrated = 0
+    writer = db.bulk_writer()
+    for teacher_ref in teacher_refs(db, teacher_id):
+        for lesson_doc in teacher_ref.collection('lessons').select(['analysis_by_question_id']).stream():
+            analysis_by_question_id: Dict[str, Dict[str, Any]] = lesson_doc.to_dict().get('analysis_by_question_id') or {}
+            updates = {
+                analysis_field_path(question_id): to_compact(analysis_dict)
+                for question_id, analysis_dict in analysis_by_question_id.items()
+                if analysis_dict is not None and not is_compact(analysis_dict)
+            }
+            if len(updates) > 0:
+                writer.update(lesson_doc.reference, updates | {"updated_at": server_now()})
+                migrated += 1
+    writer.close()
+    return migrated
+
+
+def _apply_move(analysis_dict: Dict[str, Any], response_id: str, old_category: str, new_category: str):
+    response_ids_by_category: Dict[str, List[str]] = analysis_dict['response_ids_by_category']
+    categories_by_response_id: Dict[str, List[str]] = analysis_dict['categories_by_response_id']
+    if response_id in (response_ids_by_category.get(old_category) or []):
+        response_ids_by_category[old_category].remove(response_id)
+    if response_id not in response_ids_by_category.setdefault(new_category, []):
+        response_ids_by_category[new_category].append(response_id)
+    categories = [category for category in categories_by_response_id.get(response_id) or [] if category != old_category]
+    if new_category not in categories:
+        categories.append(new_category)
+    categories_by_response_id[response_id] = categories
+
+
+def _stored_fields(analysis_dict: Dict[str, Any]) -> Dict[str, Any]:
+    # Never store the hydrated responses
+    return {
+        "question_id": analysis_dict.get('question_id'),
+        "response_ids_by_category": analysis_dict.get('response_ids_by_category'),
+        "categories_by_response_id": analysis_dict.get('categories_by_response_id') or {},
+        "responses_by_category": None,
+    }
@@ -0,0 +1,142 @@
+import queue
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional
+from google.cloud.firestore_v1 import Client, DocumentReference, transactional
+from google.cloud.firestore_v1.field_path import FieldPath
+from data_model import AnalysisJob
+from sync import server_now
+
+# Categorizing a lesson's newly locked questions as a background job. `putLesson` creates
+# a job doc (teachers/{id}/analysis_jobs/{job_id}) and enqueues one task per question; each
+# task reports its question's progress on the job doc, along with the analysis once it's
+# done, and the job's own status follows from its questions'. A question goes
+#   queued -> running -> done
+#                     -> retrying -> running -> ... -> failed (gave up, see its error)
+# Clients watch the job doc through `streamAnalysisJob` (or poll it with `getAnalysisJob`).
+
+ANALYSIS_JOBS_COLLECTION = 'analysis_jobs'
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_RETRYING = 'retrying'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+FINISHED_STATUSES = [STATUS_DONE, STATUS_FAILED]
+
+# Attempts per question, including the first; the task queue's retry config should match
+MAX_ATTEMPTS = 3
+
+
+def job_ref(db: Client, teacher_id: str, job_id: str) -> DocumentReference:
+    return db.collection('teachers').document(teacher_id).collection(ANALYSIS_JOBS_COLLECTION).document(job_id)
+
+
+def create_job(db: Client, teacher_id: str, teacher_email: str, lesson_id: str, question_ids: List[str]) -> AnalysisJob:
+    now = server_now()
+    job = AnalysisJob(
+        id=str(uuid.uuid4()),
+        teacher_email=teacher_email,
+        lesson_id=lesson_id,
+        status=STATUS_QUEUED if len(question_ids) > 0 else STATUS_DONE,
+        question_ids=question_ids,
+        progress_by_question_id={
+            question_id: {"status": STATUS_QUEUED, "attempts": 0, "error": None, "analysis": None, "updated_at": now}
+            for question_id in question_ids
+        },
+        created_at=now,
+        updated_at=now,
+    )
+    job_ref(db, teacher_id, job.id).set(job.__dict__)
+    return job
+
+
+def question_task_id(job_id: str, question_id: str) -> str:
+    return f"{job_id}-{question_id}"
+
+
+def start_question(db: Client, ref: DocumentReference, question_id: str) -> Optional[int]:
+    """Mark an attempt as started and return its number, or None if the question is already finished."""
+    return _start_question(db.transaction(), ref, question_id)
+
+
+@transactional
+def _start_question(transaction, ref: DocumentReference, question_id: str) -> Optional[int]:
+    job = ref.get(transaction=transaction).to_dict()
+    if job is None:
+        return None
+    progress: Dict[str, Any] = job['progress_by_question_id'].get(question_id) or {}
+    if progress.get('status') in FINISHED_STATUSES:
+        return None
+    attempt = (progress.get('attempts') or 0) + 1
+    _write_progress(transaction, ref, job, question_id, progress | {"status": STATUS_RUNNING, "attempts": attempt})
+    return attempt
+
+
+def finish_question(db: Client, ref: DocumentReference, question_id: str, analysis: Dict[str, Any]):
+    _finish_question(db.transaction(), ref, question_id, {"status": STATUS_DONE, "error": None, "analysis": analysis})
+
+
+def fail_question(db: Client, ref: DocumentReference, question_id: str, error: str, will_retry: bool):
+    _finish_question(db.transaction(), ref, question_id, {"status": STATUS_RETRYING if will_retry else STATUS_FAILED, "error": error})
+
+
+@transactional
+def _finish_question(transaction, ref: DocumentReference, question_id: str, fields: Dict[str, Any]):
+    job = ref.get(transaction=transaction).to_dict()
+    if job is None:
+        return
+    progress: Dict[str, Any] = job['progress_by_question_id'].get(question_id) or {}
+    _write_progress(transaction, ref, job, question_id, progress | fields)
+
+
+def _write_progress(transaction, ref: DocumentReference, job: Dict[str, Any], question_id: str, progress: Dict[str, Any]):
+    now = server_now()
+    progress_by_question_id = job['progress_by_question_id'] | {question_id: progress | {"updated_at": now}}
+    transaction.update(ref, {
+        FieldPath('progress_by_question_id', question_id).to_api_repr(): progress | {"updated_at": now},
+        "status": _job_status(progress_by_question_id),
+        "updated_at": now,
+    })
+
+
+def _job_status(progress_by_question_id: Dict[str, Dict[str, Any]]) -> str:
+    statuses = [progress.get('status') for progress in progress_by_question_id.values()]
+    if all(status in FINISHED_STATUSES for status in statuses):
+        # Done if anything came out of it; the failed questions say so themselves
+        return STATUS_DONE if STATUS_DONE in statuses or len(statuses) == 0 else STATUS_FAILED
+    if all(status == STATUS_QUEUED for status in statuses):
+        return STATUS_QUEUED
+    return STATUS_RUNNING
+
+
+def watch_job(ref: DocumentReference, timeout_sec: float, heartbeat_sec: float = 15) -> Iterator[Optional[Dict[str, Any]]]:
+    """
+    Yield the job each time it changes (starting with how it is now), until it finishes or
+    `timeout_sec` passes. Yields None every `heartbeat_sec` without a change.
+    """
+    updates: queue.Queue = queue.Queue()
+
+    def on_snapshot(docs, changes, read_time):
+        for doc in docs:
+            updates.put(doc.to_dict())
+
+    watch = ref.on_snapshot(on_snapshot)
+    deadline = time.monotonic() + timeout_sec
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                job = updates.get(timeout=min(remaining, heartbeat_sec))
+            except queue.Empty:
+                yield None
+                continue
+            if job is None:
+                return
+            yield job
+            if job.get('status') in FINISHED_STATUSES:
+                return
+    finally:
+        watch.unsubscribe()
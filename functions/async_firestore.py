@@ -0,0 +1,45 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, List
+from firebase_admin import App, firestore_async
+from google.cloud.firestore_v1 import AsyncClient, AsyncQuery, DocumentSnapshot
+
+# The handlers are plain sync functions, so async reads run on one long-lived event loop
+# in a background thread. The async client's gRPC channel is bound to the loop it was
+# created on, which is why the client is created (lazily) on that same loop and reused.
+_loop: asyncio.AbstractEventLoop = None
+_client: AsyncClient = None
+_lock = threading.Lock()
+
+# Longer than any single read should take, shorter than the function timeout
+RUN_TIMEOUT_SEC = 50
+
+
+def run_async(app: App, awaitable: Awaitable[Any]) -> Any:
+    """Run a coroutine on the shared loop and block the calling thread until it's done."""
+    loop = _ensure_loop(app)
+    return asyncio.run_coroutine_threadsafe(awaitable, loop).result(timeout=RUN_TIMEOUT_SEC)
+
+
+def async_db() -> AsyncClient:
+    """The async Firestore client. Only valid inside a coroutine passed to `run_async`."""
+    return _client
+
+
+async def stream_docs(query: AsyncQuery) -> List[DocumentSnapshot]:
+    return [doc async for doc in query.stream()]
+
+
+def _ensure_loop(app: App) -> asyncio.AbstractEventLoop:
+    global _loop, _client
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="firestore-async", daemon=True).start()
+
+            async def create_client():
+                return firestore_async.client(app)
+
+            _client = asyncio.run_coroutine_threadsafe(create_client(), loop).result()
+            _loop = loop
+        return _loop
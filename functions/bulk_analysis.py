@@ -0,0 +1,276 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from anthropic import Anthropic
+from google.cloud.firestore_v1 import Client, DocumentReference, DocumentSnapshot, FieldFilter
+from analysis_format import analysis_field_path, compact_analysis
+from categorization import chunk_responses
+from data_model import Lesson, LessonQuestion, LessonQuestionAnalysis, LessonResponse
+from lesson_analysis import (
+    NO_CATEGORY,
+    QuestionAnalysisPlan,
+    build_categorization_request,
+    build_response_summary_request,
+    combine_response_summary,
+    parse_categorization,
+    plan_question_analyses,
+)
+from response_summaries import STATUS_DONE
+from summary_cache import cache_drawing_summary, lookup_drawing_summary
+from model_tiers import STAGE_CATEGORIZATION, STAGE_RESPONSE_SUMMARY, stage_tiers
+from sync import server_now
+from identity import teacher_refs
+
+# Offline re-analysis through the provider's Message Batches API. `submit_bulk_analysis`
+# collects every pending summary and categorization into batches and records what each
+# request is for; `poll_bulk_analyses` writes the results back once a batch has ended.
+
+BATCHES_COLLECTION = 'analysis_batches'
+
+# The API takes up to 100,000 requests / 256 MB per batch; stay comfortably under both
+MAX_REQUESTS_PER_BATCH = 10_000
+MAX_BYTES_PER_BATCH = 128 * 1024 * 1024
+
+DRAWING_DOWNLOAD_CONCURRENCY = 8
+
+
+def submit_bulk_analysis(
+    db: Client,
+    client: Anthropic,
+    load_image_base64: Callable[[str], str],
+    load_material_base64: Callable[[str], str],
+    teacher_id: Optional[str] = None,
+    analyze_online: Optional[Callable[[DocumentReference, Lesson, List[QuestionAnalysisPlan]], Any]] = None,
+    resummarize: bool = False,
+    recategorize: bool = False,
+) -> Dict[str, Any]:
+    """
+    Queue up analysis for every non-deleted lesson (of one teacher, or of everyone):
+    a summary for each drawing response that doesn't have one (or all of them, with
+    `resummarize`), and a categorization for each locked question that hasn't been
+    analyzed (or all of them, with `recategorize`). Questions still waiting on a response
+    summary are skipped, since categorization works from the summaries; run this again
+    after the summary batch has been written back to pick them up. A question with more
+    responses than one categorization chunk takes (see categorization.py) goes to
+    `analyze_online` instead, since the chunks have to share their categories.
+    """
+    batch_requests: List[Dict[str, Any]] = []
+    targets: Dict[str, Dict[str, Any]] = {}
+    summaries_written = 0
+    categorizations_deferred = 0
+    categorizations_online = 0
+    writer = db.bulk_writer()
+    # Batches have no fallback: each stage's first tier it is
+    summary_tier = stage_tiers(db, STAGE_RESPONSE_SUMMARY)[0]
+    categorization_tier = stage_tiers(db, STAGE_CATEGORIZATION)[0]
+
+    for teacher_ref in teacher_refs(db, teacher_id):
+        questions_by_plan_id: Dict[str, List[LessonQuestion]] = {}
+        lesson_docs = teacher_ref.collection('lessons').where(filter=FieldFilter('deleted', '!=', True)).stream()
+        for lesson_doc in lesson_docs:
+            lesson = Lesson(**lesson_doc.to_dict())
+            responses: List[DocumentSnapshot] = list(lesson_doc.reference.collection('responses').stream())
+            # What the responses will look like once this run's text-only summaries are written
+            response_dicts: Dict[str, Dict[str, Any]] = {doc.id: doc.to_dict() for doc in responses}
+            question_ids_awaiting_summary = set()
+
+            pending: List[Tuple[DocumentSnapshot, LessonResponse, LessonQuestion]] = []
+            for response_doc in responses:
+                response = LessonResponse(**response_dicts[response_doc.id])
+                if response.analysis is not None and not resummarize:
+                    continue
+                question = _get_question(teacher_ref, lesson, response.question_id, questions_by_plan_id)
+                if question is not None:
+                    pending.append((response_doc, response, question))
+            # Download the lesson's drawings together rather than one after another
+            image_urls = list(dict.fromkeys(response.response_image_url for _, response, _ in pending if response.response_has_drawing and response.response_image_url))
+            with ThreadPoolExecutor(max_workers=DRAWING_DOWNLOAD_CONCURRENCY) as executor:
+                images_base64_by_url = dict(zip(image_urls, executor.map(load_image_base64, image_urls)))
+
+            for response_doc, response, question in pending:
+                drawing_summary: Optional[str] = None
+                if response.response_has_drawing and response.response_image_url:
+                    image_base64 = images_base64_by_url[response.response_image_url]
+                    drawing_summary, cache_key = lookup_drawing_summary(db, question.id, image_base64)
+                    if drawing_summary is None:
+                        custom_id = f"summary-{len(batch_requests)}"
+                        batch_requests.append({
+                            "custom_id": custom_id,
+                            "params": build_response_summary_request(question, image_base64, summary_tier),
+                        })
+                        targets[custom_id] = {
+                            "kind": "summary",
+                            "response_path": response_doc.reference.path,
+                            "response_text": response.response_text,
+                            "cache_key": cache_key,
+                        }
+                        question_ids_awaiting_summary.add(response.question_id)
+                        continue
+
+                # Text-only responses are their own summary, and blank or already-seen drawings
+                # have one already, so no LLM needed
+                analysis = {"response_summary": combine_response_summary(response.response_text, drawing_summary)}
+                writer.set(response_doc.reference, {"analysis": analysis, "analysis_status": STATUS_DONE, "updated_at": server_now()}, merge=True)
+                response_dicts[response_doc.id]['analysis'] = analysis
+                summaries_written += 1
+
+            if lesson.questions_locked is None or len(lesson.questions_locked) == 0:
+                continue
+            if recategorize:
+                lesson.analysis_by_question_id = None
+            lesson_questions = _get_plan_questions(teacher_ref, lesson.lesson_plan_id, questions_by_plan_id)
+            online_plans: List[QuestionAnalysisPlan] = []
+            for plan in plan_question_analyses(lesson, lesson_questions, responses, lesson.questions_locked):
+                plan_response_dicts = [response_dicts[response.id] for response in plan.responses]
+                if plan.question.id in question_ids_awaiting_summary or any(
+                    response_dict.get('analysis') is None for response_dict in plan_response_dicts
+                ):
+                    categorizations_deferred += 1
+                    continue
+                if len(chunk_responses(plan_response_dicts)) > 1:
+                    if analyze_online is not None:
+                        online_plans.append(plan)
+                    else:
+                        categorizations_deferred += 1
+                    continue
+                custom_id = f"categorization-{len(batch_requests)}"
+                batch_requests.append({
+                    "custom_id": custom_id,
+                    "params": build_categorization_request(
+                        plan.question,
+                        plan_response_dicts,
+                        plan.preset_categories,
+                        plan.preset_categories_text,
+                        load_material_base64,
+                        categorization_tier,
+                    ),
+                })
+                targets[custom_id] = {
+                    "kind": "categorization",
+                    "lesson_path": lesson_doc.reference.path,
+                    "question_id": plan.question.id,
+                    # In the order the request labels them
+                    "response_ids": [response_dict.get('id') for response_dict in plan_response_dicts],
+                }
+            if len(online_plans) > 0:
+                analyze_online(lesson_doc.reference, lesson, online_plans)
+                categorizations_online += len(online_plans)
+    writer.close()
+
+    batch_ids = [
+        _create_batch(db, client, chunk, targets)
+        for chunk in _chunk_requests(batch_requests)
+    ]
+    return {
+        "batch_ids": batch_ids,
+        "requests_submitted": len(batch_requests),
+        "summaries_written": summaries_written,
+        "categorizations_deferred": categorizations_deferred,
+        "categorizations_online": categorizations_online,
+    }
+
+
+def poll_bulk_analyses(db: Client, client: Anthropic) -> int:
+    """Write back the results of every batch that has ended since the last poll. Returns how many were finished."""
+    batches_finished = 0
+    open_batches = db.collection(BATCHES_COLLECTION).where(filter=FieldFilter('processing_status', '==', 'in_progress')).stream()
+    for batch_doc in open_batches:
+        batch = client.messages.batches.retrieve(batch_doc.id)
+        if batch.processing_status != 'ended':
+            continue
+
+        targets = {doc.id: doc.to_dict() for doc in batch_doc.reference.collection('requests').stream()}
+        succeeded = 0
+        failed = 0
+        writer = db.bulk_writer()
+        for result in client.messages.batches.results(batch_doc.id):
+            target = targets.get(result.custom_id)
+            if target is None or result.result.type != 'succeeded':
+                print(f"batch {batch_doc.id} request {result.custom_id} didn't succeed: {result.result.type}")
+                failed += 1
+                continue
+            try:
+                if target['kind'] == 'summary':
+                    message_text = result.result.message.content[0].text
+                    summary = combine_response_summary(target.get('response_text'), message_text)
+                    if target.get('cache_key') is not None:
+                        cache_drawing_summary(db, target['cache_key'], message_text)
+                    writer.set(db.document(target['response_path']), {"analysis": {"response_summary": summary}, "analysis_status": STATUS_DONE, "updated_at": server_now()}, merge=True)
+                else:
+                    lesson_ref = db.document(target['lesson_path'])
+                    analysis = _parse_batch_categorization(target['question_id'], target['response_ids'], result.result.message.content)
+                    writer.update(lesson_ref, {analysis_field_path(analysis.question_id): analysis.__dict__, "updated_at": server_now()})
+                succeeded += 1
+            except Exception as e:
+                print(f"batch {batch_doc.id} request {result.custom_id} couldn't be applied: {e}")
+                failed += 1
+        writer.close()
+
+        batch_doc.reference.update({
+            "processing_status": "ended",
+            "succeeded": succeeded,
+            "failed": failed,
+            "ended_at": datetime.now().isoformat(),
+        })
+        batches_finished += 1
+    return batches_finished
+
+
+def _parse_batch_categorization(question_id: str, response_ids: List[str], message_content: List[Any]) -> LessonQuestionAnalysis:
+    response_ids_by_category = parse_categorization(message_content, response_ids)
+    # A batch can't ask again, so whatever the answer left out has no category. Only questions
+    # that fit in one chunk are batched, so that's rare
+    categorized = {response_id for category_ids in response_ids_by_category.values() for response_id in category_ids}
+    missing_ids = [response_id for response_id in response_ids if response_id not in categorized]
+    if len(missing_ids) > 0:
+        response_ids_by_category.setdefault(NO_CATEGORY, []).extend(missing_ids)
+    return compact_analysis(question_id, response_ids_by_category)
+
+
+def _create_batch(db: Client, client: Anthropic, batch_requests: List[Dict[str, Any]], targets: Dict[str, Dict[str, Any]]) -> str:
+    batch = client.messages.batches.create(requests=batch_requests)
+    batch_ref = db.collection(BATCHES_COLLECTION).document(batch.id)
+    # Record what each request is for before anything can end, so the poller can't miss it
+    writer = db.bulk_writer()
+    for request in batch_requests:
+        writer.set(batch_ref.collection('requests').document(request['custom_id']), targets[request['custom_id']])
+    writer.close()
+    batch_ref.set({
+        "id": batch.id,
+        "processing_status": "in_progress",
+        "request_count": len(batch_requests),
+        "created_at": datetime.now().isoformat(),
+    })
+    print(f"submitted analysis batch {batch.id} with {len(batch_requests)} requests")
+    return batch.id
+
+
+def _chunk_requests(batch_requests: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    chunks: List[List[Dict[str, Any]]] = []
+    chunk: List[Dict[str, Any]] = []
+    chunk_bytes = 0
+    for request in batch_requests:
+        request_bytes = len(str(request['params']))
+        if len(chunk) > 0 and (len(chunk) >= MAX_REQUESTS_PER_BATCH or chunk_bytes + request_bytes > MAX_BYTES_PER_BATCH):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(request)
+        chunk_bytes += request_bytes
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def _get_plan_questions(teacher_ref: DocumentReference, lesson_plan_id: str, questions_by_plan_id: Dict[str, List[LessonQuestion]]) -> List[LessonQuestion]:
+    if lesson_plan_id not in questions_by_plan_id:
+        question_docs = teacher_ref.collection('lesson_plans').document(lesson_plan_id).collection('questions').stream()
+        questions_by_plan_id[lesson_plan_id] = [LessonQuestion(**doc.to_dict()) for doc in question_docs]
+    return questions_by_plan_id[lesson_plan_id]
+
+
+def _get_question(teacher_ref: DocumentReference, lesson: Lesson, question_id: str, questions_by_plan_id: Dict[str, List[LessonQuestion]]) -> Optional[LessonQuestion]:
+    return next((
+        question for question in _get_plan_questions(teacher_ref, lesson.lesson_plan_id, questions_by_plan_id)
+        if question.id == question_id
+    ), None)
@@ -0,0 +1,184 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+from data_model import LessonQuestion
+from lesson_analysis import (
+    NO_CATEGORY,
+    build_categorization_request,
+    build_category_reconciliation_request,
+    parse_categorization,
+    parse_category_reconciliation,
+)
+from llm_gateway import CHARS_PER_TOKEN, LLMGateway
+from model_tiers import ModelTier
+
+# Categorizing every response to a question, for classes of any size. One prompt with the
+# whole class gets its JSON cut off at max_tokens once there are enough students, so the
+# responses are split into chunks that each fit the budget:
+#
+#   1. Without preset categories, the first chunk is categorized on its own, and its
+#      categories become the set every other chunk is sorted into
+#   2. The other chunks are categorized concurrently against that set (they may still add
+#      a category when a response fits none of them)
+#   3. Any response a chunk's answer left out (or that couldn't be repaired, see
+#      `parse_categorization`) is asked about again, on its own
+#   4. The chunks' results are merged, and if they came up with categories beyond the
+#      shared set, the LLM is asked once which of them mean the same thing
+#
+# A class that fits in one chunk makes the same single call as before.
+
+# Responses per chunk. Each entry in the answer (a label like r12 and its categories) costs
+# around 20 output tokens, so this keeps the answer well inside a 1024 max_tokens
+CHUNK_MAX_RESPONSES = 25
+# Input tokens of response summaries per chunk
+CHUNK_MAX_TOKENS = 6000
+CHUNK_CONCURRENCY = 4
+# Times to re-ask about the responses a chunk's answer left out, before filing them under NO_CATEGORY
+MAX_REASKS = 2
+
+
+def categorize_responses(
+    llm_gateway: LLMGateway,
+    tiers: List[ModelTier],
+    question: LessonQuestion,
+    responses: List[Dict[str, Any]],
+    preset_categories: List[str],
+    preset_categories_text: str,
+    load_material_base64: Callable[[str], str],
+) -> Dict[str, List[str]]:
+    """`response_ids_by_category` for `responses` (dicts that include their `id`)."""
+    chunks = chunk_responses(responses)
+    if len(chunks) == 0:
+        return {NO_CATEGORY: []}
+
+    def categorize(chunk: List[Dict[str, Any]], categories: List[str], categories_text: str) -> Dict[str, List[str]]:
+        return _categorize_chunk(llm_gateway, tiers, question, chunk, categories, categories_text, load_material_base64)
+
+    shared_categories = [category.strip().capitalize() for category in preset_categories]
+    shared_categories_text = preset_categories_text
+    results: List[Dict[str, List[str]]] = []
+    if len(shared_categories) == 0:
+        first_result = categorize(chunks[0], [], "")
+        results.append(first_result)
+        chunks = chunks[1:]
+        shared_categories = [category for category in first_result if category != NO_CATEGORY]
+        shared_categories_text = "\n".join(shared_categories)
+    if len(chunks) > 0:
+        print(f"categorizing {len(responses)} responses to question {question.id} in {len(results) + len(chunks)} chunks")
+    with ThreadPoolExecutor(max_workers=CHUNK_CONCURRENCY) as executor:
+        results += list(executor.map(lambda chunk: categorize(chunk, shared_categories, shared_categories_text), chunks))
+
+    response_ids_by_category = merge_categorizations(results)
+    new_categories = [category for category in response_ids_by_category if category not in shared_categories and category != NO_CATEGORY]
+    if len(results) > 1 and len(new_categories) > 0:
+        response_ids_by_category = _reconcile(llm_gateway, tiers, question, response_ids_by_category, [category.strip().capitalize() for category in preset_categories])
+    return response_ids_by_category
+
+
+def chunk_responses(responses: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    chunks: List[List[Dict[str, Any]]] = []
+    chunk: List[Dict[str, Any]] = []
+    chunk_tokens = 0
+    for resp in responses:
+        tokens = len((resp.get('analysis') or {}).get('response_summary') or "") // CHARS_PER_TOKEN
+        if len(chunk) > 0 and (len(chunk) >= CHUNK_MAX_RESPONSES or chunk_tokens + tokens > CHUNK_MAX_TOKENS):
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(resp)
+        chunk_tokens += tokens
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
+
+
+def merge_categorizations(results: List[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    merged: Dict[str, List[str]] = {}
+    for result in results:
+        for category, response_ids in result.items():
+            category_ids = merged.setdefault(category, [])
+            category_ids += [response_id for response_id in response_ids if response_id not in category_ids]
+    return merged
+
+
+def _categorize_chunk(
+    llm_gateway: LLMGateway,
+    tiers: List[ModelTier],
+    question: LessonQuestion,
+    chunk: List[Dict[str, Any]],
+    categories: List[str],
+    categories_text: str,
+    load_material_base64: Callable[[str], str],
+) -> Dict[str, List[str]]:
+    result, cut_off = _request_categorization(llm_gateway, tiers, question, chunk, categories, categories_text, load_material_base64)
+
+    reasks = 0
+    missing = _missing_responses(chunk, result)
+    while len(missing) > 0 and reasks < MAX_REASKS:
+        reasks += 1
+        print(f"re-asking about {len(missing)} of {len(chunk)} responses to question {question.id}")
+        # Against what this chunk has so far, so the stragglers land in the same categories
+        known_categories = categories + [category for category in result if category not in categories and category != NO_CATEGORY]
+        extra_text = "\n".join(category for category in known_categories if category not in categories)
+        known_categories_text = categories_text + ("\n" + extra_text if len(categories_text) > 0 and len(extra_text) > 0 else extra_text)
+        # An answer that ran out of tokens would again, so after one the rest go in halves
+        pieces = [missing[:(len(missing) + 1) // 2], missing[(len(missing) + 1) // 2:]] if cut_off and len(missing) > 1 else [missing]
+        cut_off = False
+        for piece in pieces:
+            piece_result, piece_cut_off = _request_categorization(llm_gateway, tiers, question, piece, known_categories, known_categories_text, load_material_base64)
+            result = merge_categorizations([result, piece_result])
+            cut_off = cut_off or piece_cut_off
+        missing = _missing_responses(chunk, result)
+    if len(missing) > 0:
+        print(f"giving up on categorizing {len(missing)} responses to question {question.id}")
+        result.setdefault(NO_CATEGORY, []).extend(resp.get('id') for resp in missing)
+    return result
+
+
+def _request_categorization(
+    llm_gateway: LLMGateway,
+    tiers: List[ModelTier],
+    question: LessonQuestion,
+    responses: List[Dict[str, Any]],
+    categories: List[str],
+    categories_text: str,
+    load_material_base64: Callable[[str], str],
+) -> Tuple[Dict[str, List[str]], bool]:
+    """The categorization of `responses`, and whether the answer was cut off at max_tokens."""
+    llm_request = build_categorization_request(question, responses, categories, categories_text, load_material_base64, tiers[0])
+    message = llm_gateway.create_message_with_fallback([tier.params() for tier in tiers], **llm_request)
+    cut_off = message.stop_reason == 'max_tokens'
+    if cut_off:
+        print(f"categorization of {len(responses)} responses to question {question.id} was cut off")
+    return parse_categorization(message.content, [resp.get('id') for resp in responses]), cut_off
+
+
+def _missing_responses(chunk: List[Dict[str, Any]], response_ids_by_category: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+    categorized = {response_id for response_ids in response_ids_by_category.values() for response_id in response_ids}
+    return [resp for resp in chunk if resp.get('id') not in categorized]
+
+
+def _reconcile(
+    llm_gateway: LLMGateway,
+    tiers: List[ModelTier],
+    question: LessonQuestion,
+    response_ids_by_category: Dict[str, List[str]],
+    fixed_categories: List[str],
+) -> Dict[str, List[str]]:
+    categories = [category for category in response_ids_by_category if category != NO_CATEGORY]
+    llm_request = build_category_reconciliation_request(question, categories, fixed_categories, tiers[0])
+    try:
+        message = llm_gateway.create_message_with_fallback([tier.params() for tier in tiers], **llm_request)
+        merged_into = parse_category_reconciliation(message.content[0].text, categories)
+    except Exception as e:
+        # The chunks' categories are still a valid (if repetitive) answer
+        print(f"couldn't reconcile categories for question {question.id}: {e}")
+        return response_ids_by_category
+    for category in fixed_categories:
+        merged_into[category] = category
+    print(f"reconciled categories for question {question.id}: {json.dumps(merged_into)}")
+
+    reconciled: Dict[str, List[str]] = {}
+    for category, response_ids in response_ids_by_category.items():
+        target_ids = reconciled.setdefault(merged_into.get(category, category), [])
+        target_ids += [response_id for response_id in response_ids if response_id not in target_ids]
+    return reconciled
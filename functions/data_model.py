@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 @dataclass
 class Teacher:
@@ -9,12 +9,18 @@ class Teacher:
     email_address: str
     created_at: str
     updated_at: str
+    # Set by the server while the default lessons are copied in (see provisioning.py)
+    onboarding_status: str = None
+    onboarding_error: str = None
 
 @dataclass
 class TeacherData(Teacher):
     classes: List['Class'] = None
     lesson_plans: List['LessonPlan'] = None
     lessons: List['Lesson'] = None
+    # Set when `lesson_plans` / `lessons` is one page of them
+    lesson_plans_next_page_token: Optional[str] = None
+    lessons_next_page_token: Optional[str] = None
 
 @dataclass
 class Class:
@@ -81,13 +87,26 @@ class Lesson:
     class_data: Optional['Class'] = None
     lesson_plan: Optional['LessonPlan'] = None
     responses: Optional[List['LessonResponse']] = None
+    responses_summary: Optional['LessonResponsesSummary'] = None
     analysis_by_question_id: Optional[Dict[str, 'LessonQuestionAnalysis']] = None
+    # The latest background analysis, see analysis_jobs.py
+    analysis_job_id: Optional[str] = None
+
+
+@dataclass
+class LessonResponsesSummary:
+    response_count: int
+    response_count_by_question_id: Dict[str, int]
+    student_ids_submitted: List[str]
 
 
 @dataclass
 class LessonQuestionAnalysis:
     question_id: str
-    responses_by_category: Dict[str, List['LessonResponse']]
+    # Filled in from the lesson's responses when they're returned together; not stored (see analysis_format.py)
+    responses_by_category: Optional[Dict[str, List['LessonResponse']]] = None
+    response_ids_by_category: Optional[Dict[str, List[str]]] = None
+    categories_by_response_id: Optional[Dict[str, List[str]]] = None
 
 
 @dataclass
@@ -105,8 +124,65 @@ class LessonResponse:
     response_text: Optional[str] = None
     response_has_drawing: Optional[bool] = None
     analysis: Optional['LessonResponseAnalysis'] = None
+    # Background summarization state, see response_summaries.py
+    analysis_status: Optional[str] = None
+    analysis_attempts: Optional[int] = None
+    analysis_error: Optional[str] = None
+    analysis_input_hash: Optional[str] = None
 
 
 @dataclass
 class LessonResponseAnalysis:
     response_summary: str
+
+
+@dataclass
+class Page:
+    items: List[Any]
+    # Pass back as `start_after` to get the next page; None on the last page
+    next_page_token: Optional[str] = None
+
+
+@dataclass
+class Tombstone:
+    kind: str
+    id: str
+    # The id of the doc the deleted one lived under (the class of a student, the plan of a question, ...)
+    parent_id: Optional[str]
+    deleted_at: str
+
+
+@dataclass
+class TeacherDataChanges:
+    # Pass back as `since` on the next sync
+    watermark: str
+    classes: List['Class'] = None
+    students: List['Student'] = None
+    lesson_plans: List['LessonPlan'] = None
+    questions: List['LessonQuestion'] = None
+    lessons: List['Lesson'] = None
+    responses: List['LessonResponse'] = None
+    # An entity that was deleted and then written again has an updated_at after its deleted_at
+    tombstones: List['Tombstone'] = None
+
+
+@dataclass
+class QuestionAnalysisProgress:
+    status: str
+    attempts: int = 0
+    error: Optional[str] = None
+    # The question's analysis, once it's done
+    analysis: Optional['LessonQuestionAnalysis'] = None
+    updated_at: Optional[str] = None
+
+
+@dataclass
+class AnalysisJob:
+    id: str
+    teacher_email: str
+    lesson_id: str
+    status: str
+    question_ids: List[str]
+    progress_by_question_id: Dict[str, 'QuestionAnalysisProgress']
+    created_at: str
+    updated_at: str
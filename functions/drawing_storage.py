@@ -0,0 +1,73 @@
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Optional
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud.firestore_v1 import Client, DocumentReference
+from google.cloud.storage import Bucket
+from identity import teacher_refs
+from sync import server_now
+
+# Student drawings live in Cloud Storage, named by their content, and responses only keep
+# the URL. Drawings are stored when the response is submitted; `migrate_drawings_to_storage`
+# moves the base64 out of responses saved before that.
+
+
+def store_drawing(bucket: Bucket, teacher_email: str, image_base64: str) -> str:
+    """Upload a base64 PNG (once per distinct drawing) and return its public URL."""
+    data = base64.b64decode(image_base64.replace("data:image/png;base64,", ""))
+    blob = bucket.blob(f"{teacher_email}/student-responses/{hashlib.sha256(data).hexdigest()}.png")
+    # The name is derived from the content, so it never changes once written
+    blob.cache_control = "public, max-age=31536000, immutable"
+    try:
+        # Only if it isn't there yet: a resubmission or a retry finds the same drawing already uploaded
+        blob.upload_from_string(data=data, content_type="image/png", if_generation_match=0)
+    except PreconditionFailed:
+        pass
+    # Also when it was already there: the upload that put it there may have failed before this
+    blob.make_public()
+    return blob.public_url
+
+
+def move_response_drawing(bucket: Bucket, response_dict: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The fields to update if the response still carries its drawing inline: the drawing's
+    URL, and no more base64. None if there's nothing to move.
+    """
+    image_base64: Optional[str] = response_dict.get('response_image_base64')
+    if image_base64 is None or image_base64 == "":
+        return None
+    image_url: Optional[str] = response_dict.get('response_image_url')
+    if image_url is None or image_url == "":
+        image_url = store_drawing(bucket, response_dict.get('teacher_email'), image_base64)
+    return {
+        "response_image_url": image_url,
+        "response_image_base64": None,
+        "updated_at": server_now(),
+    }
+
+
+def migrate_drawings_to_storage(db: Client, bucket: Bucket, teacher_id: Optional[str] = None, max_workers: int = 16) -> int:
+    """Move every inline drawing (of one teacher, or of everyone) to Cloud Storage. Returns how many were moved."""
+    moved = 0
+    writer = db.bulk_writer()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for teacher_ref in teacher_refs(db, teacher_id):
+            for lesson_ref in teacher_ref.collection('lessons').list_documents():
+                for response_doc in lesson_ref.collection('responses').stream():
+                    response_dict = response_doc.to_dict()
+                    if response_dict.get('response_image_base64'):
+                        futures[executor.submit(move_response_drawing, bucket, response_dict)] = response_doc.reference
+        for future in as_completed(futures):
+            response_ref: DocumentReference = futures[future]
+            try:
+                fields = future.result()
+            except Exception as e:
+                print(f"couldn't move the drawing of {response_ref.path}: {e}")
+                continue
+            if fields is not None:
+                writer.update(response_ref, fields)
+                moved += 1
+    writer.close()
+    return moved
@@ -0,0 +1,85 @@
+from typing import Any, Dict, List, Optional
+from firebase_admin import auth
+from google.cloud.firestore_v1 import Client, DocumentReference, FieldFilter
+from cache import TTLCache
+from data_model import TeacherData
+
+# Custom claim set on the teacher's auth user by putTeacher, so the ID token itself says
+# which teacher doc belongs to the caller
+TEACHER_ID_CLAIM = 'teacher_id'
+
+# Teacher docs rarely change, so warm instances can answer from memory for a while.
+# putTeacher invalidates explicitly; other instances pick up changes within the TTL.
+_teachers_by_uid = TTLCache(ttl_sec=300)
+_teachers_by_email = TTLCache(ttl_sec=300)
+
+
+def resolve_teacher(db: Client, uid: str, token: Dict[str, Any]) -> Optional[TeacherData]:
+    """
+    Map the caller's uid to their teacher without an Auth lookup. Tries, in order:
+    the instance cache, the `teacher_id` custom claim (one doc get), and finally the
+    email on the token (one query, after which the claim is backfilled).
+    """
+    teacher_dict = _teachers_by_uid.get(uid)
+    if teacher_dict is None:
+        teacher_dict = _load_by_claim(db, token)
+        if teacher_dict is None:
+            teacher_dict = _load_by_email(db, token.get('email'))
+            if teacher_dict is not None:
+                set_teacher_claim(uid, teacher_dict.get('id'))
+        if teacher_dict is None:
+            return None
+        _teachers_by_uid.set(uid, teacher_dict)
+    # Handlers attach nested data to the object they get, so never hand out the cached one
+    return TeacherData(**teacher_dict)
+
+
+def resolve_teacher_by_email(db: Client, email: str) -> Optional[TeacherData]:
+    """For the public (student-facing) endpoints, which only know the teacher's email."""
+    teacher_dict = _teachers_by_email.get_or_load(email, lambda: _load_by_email(db, email))
+    return TeacherData(**teacher_dict) if teacher_dict is not None else None
+
+
+def teacher_refs(db: Client, teacher_id: Optional[str] = None) -> List[DocumentReference]:
+    """The one teacher's doc, or every teacher's, for the admin tools that run for one or all of them."""
+    if teacher_id is not None:
+        return [db.collection('teachers').document(teacher_id)]
+    return list(db.collection('teachers').list_documents())
+
+
+def set_teacher_claim(uid: str, teacher_id: str):
+    # Custom claims are replaced wholesale, so keep whatever else is already set.
+    # The claim shows up in the caller's token the next time it is refreshed.
+    user: auth.UserRecord = auth.get_user(uid)
+    claims = dict(user.custom_claims or {})
+    if claims.get(TEACHER_ID_CLAIM) != teacher_id:
+        claims[TEACHER_ID_CLAIM] = teacher_id
+        auth.set_custom_user_claims(uid, claims)
+
+
+def invalidate_teacher(uid: str, email: Optional[str] = None):
+    _teachers_by_uid.invalidate(uid)
+    if email is not None:
+        _teachers_by_email.invalidate(email)
+
+
+def _load_by_claim(db: Client, token: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    teacher_id = token.get(TEACHER_ID_CLAIM)
+    if teacher_id is None:
+        return None
+    teacher_doc = db.collection('teachers').document(teacher_id).get()
+    # The claim can outlive the doc, or the doc's email can change, so double-check it
+    if not teacher_doc.exists or teacher_doc.get('email_address') != token.get('email'):
+        return None
+    return teacher_doc.to_dict()
+
+
+def _load_by_email(db: Client, email: Optional[str]) -> Optional[Dict[str, Any]]:
+    if email is None:
+        return None
+    teacher_matches = list(db.collection('teachers').where(
+        filter=FieldFilter('email_address', '==', email)
+    ).limit(2).stream())
+    if len(teacher_matches) != 1:
+        return None
+    return teacher_matches[0].to_dict()
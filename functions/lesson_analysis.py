@@ -0,0 +1,444 @@
+import json
+from dataclasses import dataclass
+from textwrap import dedent
+from typing import Any, Callable, Dict, List, Optional
+from google.cloud.firestore_v1 import DocumentSnapshot
+from analysis_format import analysis_categories
+from data_model import Lesson, LessonQuestion
+from model_tiers import DEFAULT_TIERS, STAGE_CATEGORIZATION, STAGE_RESPONSE_SUMMARY, ModelTier
+
+# Prompt construction and result parsing for the two LLM stages: summarizing one student's
+# response, and categorizing every response to a question. Nothing in here does I/O, so the
+# same requests can be sent one at a time or as part of a message batch.
+
+# Marks the end of a prompt prefix the provider should cache. Prefixes shorter than the
+# model's minimum (1024 tokens for Sonnet) are simply not cached.
+CACHE_CONTROL = {"type": "ephemeral"}
+
+# Where the LLM puts a response that fits none of the categories
+NO_CATEGORY = "No category"
+
+# Bump when the summary prompt changes, so cached summaries from the old prompt aren't reused
+RESPONSE_SUMMARY_PROMPT_VERSION = 2
+
+RESPONSE_SUMMARY_INSTRUCTIONS = dedent("""
+    You are an experienced high school teacher, and my assistant for this lesson.
+    I'll show you the question I asked my class and one student's drawing in response.
+    Your response should be a summary of this drawing that carefully considers how the student's drawing is attempting to answer the question I asked the class.
+    If you see any text in it, include the exact text in your summary.
+    Give the student the benefit of the doubt, but don't be afraid to analyze with a critical eye.
+    Your summary should be as brief as possible while being comprehensive.
+""")
+
+CATEGORIZATION_INSTRUCTIONS = dedent("""
+    You are an experienced high school teacher, and my assistant for this lesson.
+
+    As my assistant, you have one task that will help me administer this lesson: sort the students' responses into categories.
+
+    The categories will be used to track how students' understanding of the concept evolves over time, sometimes moving from one category to another as their understanding deepens. Sometimes expanding the understanding from one category to two or more.
+
+    Do your best to categorize in a way that will help the students draw connections between each other's explanations.
+
+    Pay extra attention to any guidance I have already provided on which categories to use. I expect all of my category suggestions to be considered thoughtfully.
+
+    Make sure every single response is included at least once, and remember that a response might belong to more than one category.
+
+    Make sure each category is distinct.
+
+    Record your categorization with the record_categorization tool.
+""")
+
+# The categorization comes back as this tool's input, so the API hands over structured data
+# rather than text to pick the JSON out of. Each entry is keyed by the short label the
+# response was shown with (r1, r2, ...; see `response_labels`): a full response id would cost
+# several times the output tokens. The labels aren't enumerated in the schema: the tools are
+# part of the cached prompt prefix, which has to be the same for every chunk of a class.
+CATEGORIZATION_TOOL_NAME = "record_categorization"
+CATEGORIZATION_TOOL = {
+    "name": CATEGORIZATION_TOOL_NAME,
+    "description": "Record which categories each student response belongs to.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "assignments": {
+                "type": "array",
+                "description": "One entry for every response.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "response": {
+                            "type": "string",
+                            "description": "The label the response was shown with, like r1.",
+                        },
+                        "categories": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "minItems": 1,
+                            "description": f"The categories the response belongs to, or [\"{NO_CATEGORY}\"] if it fits none.",
+                        },
+                    },
+                    "required": ["response", "categories"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["assignments"],
+        "additionalProperties": False,
+    },
+}
+
+
+CATEGORY_RECONCILIATION_INSTRUCTIONS = dedent("""
+    You are an experienced high school teacher, and my assistant for this lesson.
+    My students' responses to one question were sorted into categories in several groups, so some of the groups named the same idea differently.
+
+    Your task is to merge the categories that mean the same thing, so each idea has exactly one category. Keep categories that are genuinely distinct separate.
+
+    Your response should be output in JSON format. Respond with the JSON object ONLY, and no other text.
+""")
+
+
+@dataclass
+class QuestionAnalysisPlan:
+    question: LessonQuestion
+    responses: List[DocumentSnapshot]
+    preset_categories: List[str]
+    # How the categories are worded in the prompt (the teacher's guidance verbatim, if that's where they came from)
+    preset_categories_text: str
+
+
+def plan_question_analyses(
+    lesson: Lesson,
+    lesson_questions: List[LessonQuestion],
+    responses: List[DocumentSnapshot],
+    questions_locked: List[str],
+) -> List[QuestionAnalysisPlan]:
+    """
+    Decide up front which questions need analysis and which categories each one should use.
+    Categories carry over from the previous analyzed question (its finished analysis, or its
+    categorization guidance), so resolving them here makes that dependency explicit and
+    leaves the LLM calls free to run in any order.
+    """
+    plans: List[QuestionAnalysisPlan] = []
+    preset_categories: List[str] = []
+    for question in lesson_questions:
+        if questions_locked is None or question.id not in questions_locked:
+            continue
+
+        responses_to_question = [response for response in responses if response.to_dict().get('question_id') == question.id]
+
+        # If no responses, skip
+        if len(responses_to_question) == 0:
+            continue
+
+        # If the analysis is already done, skip (but use its categories for the next question)
+        if lesson.analysis_by_question_id is not None and question.id in lesson.analysis_by_question_id and lesson.analysis_by_question_id[question.id] is not None:
+            preset_categories = analysis_categories(lesson.analysis_by_question_id[question.id])
+            continue
+
+        preset_categories_text = ", ".join(preset_categories)
+        if len(preset_categories) > 0:
+            print("Got preset categories from the previous question:", preset_categories)
+        elif question.categorization_guidance is not None:
+            preset_cats_str = question.categorization_guidance
+            preset_cats_split_by_comma = preset_cats_str.split(",")
+            preset_cats_split_by_newline = preset_cats_str.split("\n")
+            preset_categories = preset_cats_split_by_comma if len(preset_cats_split_by_comma) > len(preset_cats_split_by_newline) else preset_cats_split_by_newline
+            preset_categories_text = preset_cats_str
+            print("Got preset categories from the categorization guidance:", preset_categories)
+
+        plans.append(QuestionAnalysisPlan(
+            question=question,
+            responses=responses_to_question,
+            preset_categories=preset_categories,
+            preset_categories_text=preset_categories_text,
+        ))
+    return plans
+
+
+def build_response_summary_request(
+    question: LessonQuestion,
+    image_base64: str,
+    tier: Optional[ModelTier] = None,
+) -> Dict[str, Any]:
+    """`messages.create` params asking for a summary of a student's drawing."""
+    # Everything up to and including the question is the same for the whole class, so it's
+    # marked for prompt caching; only the drawing comes after it. In practice that prefix is
+    # far below the models' caching minimum (1024 tokens for Sonnet, 2048 for Haiku) unless
+    # the question is very long, so caching mostly pays off in categorization, whose prefix
+    # carries the supporting materials. The student isn't named, so the same drawing gets
+    # the same summary whoever submitted it.
+    message_content = [
+        {
+            "type": "text",
+            "text": f"I asked my high school class the following question: {question.body_text}",
+            "cache_control": CACHE_CONTROL,
+        },
+        {
+            "type": "text",
+            "text": "A student answered:",
+        },
+    ]
+    message_content.append({
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": "image/png",
+            "data": image_base64,
+        },
+    })
+    message_content.append({
+        "type": "text",
+        "text": "Summarize the student's drawing.",
+    })
+    tier = tier or DEFAULT_TIERS[STAGE_RESPONSE_SUMMARY][0]
+    return {
+        "model": tier.model,
+        "max_tokens": tier.max_tokens,
+        "system": [{
+            "type": "text",
+            "text": RESPONSE_SUMMARY_INSTRUCTIONS,
+        }],
+        "messages": [{
+            "role": "user",
+            "content": message_content,
+        }],
+    }
+
+
+def combine_response_summary(response_text: Optional[str], drawing_summary: Optional[str]) -> str:
+    # The student's raw response text comes first, then the summary of their drawing (if any)
+    summary = response_text or ""
+    if drawing_summary is not None:
+        summary = summary + "\n\n" if len(summary) > 0 else ""
+        summary = summary + drawing_summary
+    return summary
+
+
+def build_categorization_request(
+    question: LessonQuestion,
+    responses: List[Dict[str, Any]],
+    preset_categories: List[str],
+    preset_categories_text: str,
+    load_material_base64: Callable[[str], str],
+    tier: Optional[ModelTier] = None,
+) -> Dict[str, Any]:
+    """`messages.create` params asking the LLM to sort the students' response summaries into categories."""
+    # The instructions, question, supporting materials and categories come first and are
+    # marked for prompt caching, so retries don't pay for them again. The students'
+    # responses come last.
+    static_content: List[Dict[str, Any]] = [{
+        "type": "text",
+        "text": dedent(f"""
+            I asked my high school students the following question:
+            "{question.body_text}"
+        """),
+    }]
+
+    # Add context (supporting materials) if any
+    ctx_materials_message_content = []
+    for ctx_material_url in question.context_material_urls or []:
+        file_name: str = ctx_material_url.split('/')[-1].split('?')[0]
+        file_ext: str = file_name.split('.')[-1]
+        file_ext_lower = file_ext.lower()
+        if file_ext_lower in ['pdf']:
+            ctx_materials_message_content.append({
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": load_material_base64(ctx_material_url),
+                },
+            })
+        elif file_ext_lower in ['png', 'jpg', 'jpeg']:
+            if file_ext_lower == 'jpg':
+                file_ext_lower = 'jpeg'
+            ctx_materials_message_content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": f"image/{file_ext_lower}",
+                    "data": load_material_base64(ctx_material_url),
+                },
+            })
+    if len(ctx_materials_message_content) > 0:
+        static_content += [{
+            "type": "text",
+            "text": "The following supporting materials are relevant to the question:",
+        }] + ctx_materials_message_content
+
+    # Add categorization_guidance if any
+    if len(preset_categories) > 0:
+        static_content.append({
+            "type": "text",
+            "text": "Please use all of the following categories in your analysis:\n\n"+
+                f"{preset_categories_text}\n\n"+
+                "Consider ALL of these carefully when deciding how to categorize each student's response. It is encouraged to assign a multiple categories to a response if and only if the response fits the requirements of more than one category.",
+        })
+
+    static_content.append({
+        "type": "text",
+        "text": f"Give every response one or more categories, using the label it is shown with. If a response fits none of the categories, give it \"{NO_CATEGORY}\".",
+        "cache_control": CACHE_CONTROL,
+    })
+
+    # Add the student responses
+    lesson_responses_message_content = [{
+        "type": "text",
+        "text": "Now here are my students' responses:", # TODO: Add anti-prompt-injection language?
+    }]
+    for label, resp in zip(response_labels([resp.get('id') for resp in responses]), responses):
+        lesson_responses_message_content.append({
+            "type": "text",
+            "text": f"Response {label}: {(resp.get('analysis') or {}).get('response_summary')}",
+        })
+    tier = tier or DEFAULT_TIERS[STAGE_CATEGORIZATION][0]
+    return {
+        "model": tier.model,
+        "max_tokens": tier.max_tokens,
+        "tools": [CATEGORIZATION_TOOL],
+        "tool_choice": {"type": "tool", "name": CATEGORIZATION_TOOL_NAME},
+        "system": [{
+            "type": "text",
+            "text": CATEGORIZATION_INSTRUCTIONS,
+        }],
+        "messages": [
+            {
+                "role": "user",
+                "content": static_content,
+            },
+            {
+                "role": "user",
+                "content": lesson_responses_message_content,
+            },
+        ],
+    }
+
+
+def parse_categorization(
+    message_content: List[Any],
+    response_ids: List[str],
+) -> Dict[str, List[str]]:
+    """
+    Turn the LLM's `record_categorization` call into `response_ids_by_category`.
+    `response_ids` are the ones the request was built with, in the same order, so the labels
+    map back to them. Whatever is usable is kept: a misquoted label or a bare category string
+    is repaired, and anything that can't be is dropped, so those responses read as missing
+    and can be asked about again.
+    """
+    tool_input = _tool_input(message_content, CATEGORIZATION_TOOL_NAME)
+    assignments = tool_input.get('assignments') if isinstance(tool_input, dict) else None
+    if isinstance(assignments, dict):
+        # {label: categories} instead of a list of entries
+        assignments = [{"response": label, "categories": categories} for label, categories in assignments.items()]
+    if not isinstance(assignments, list):
+        print(f"no categorization in response: {tool_input!r}")
+        return {}
+
+    # A full id in place of its label is fine too
+    response_ids_by_key = {key.lower(): response_id for key, response_id in zip(response_labels(response_ids), response_ids)} | \
+        {response_id.strip().lower(): response_id for response_id in response_ids}
+    response_ids_by_category: dict[str, list[str]] = {}
+    for assignment in assignments:
+        if not isinstance(assignment, dict):
+            continue
+        raw_key = assignment.get('response', assignment.get('response_id'))
+        response_id = response_ids_by_key.get(_response_key(raw_key)) if isinstance(raw_key, str) else None
+        if response_id is None:
+            print(f"ignoring unknown response {raw_key!r}")
+            continue
+        categories = assignment.get('categories')
+        if isinstance(categories, str):
+            categories = [categories]
+        if not isinstance(categories, list):
+            continue
+        for cat in categories:
+            if not isinstance(cat, str) or len(cat.strip()) == 0:
+                continue
+            category_ids = response_ids_by_category.setdefault(cat.strip().capitalize(), [])
+            if response_id not in category_ids:
+                category_ids.append(response_id)
+    return response_ids_by_category
+
+
+def response_labels(response_ids: List[str]) -> List[str]:
+    """What the LLM calls each response in a categorization request."""
+    return [f"r{i + 1}" for i in range(len(response_ids))]
+
+
+def _response_key(raw_key: str) -> str:
+    # "R3", "r3:", "response r3" all mean r3
+    key = raw_key.strip().strip('"\':').lower()
+    return key.removeprefix("response").strip()
+
+
+def _tool_input(message_content: List[Any], tool_name: str) -> Any:
+    # Content blocks are SDK objects from the live API, and the same as dicts wherever they've been serialized
+    for block in message_content or []:
+        field = block.get if isinstance(block, dict) else lambda name: getattr(block, name, None)
+        if field('type') == 'tool_use' and field('name') == tool_name:
+            return field('input')
+    return None
+
+
+def build_category_reconciliation_request(
+    question: LessonQuestion,
+    categories: List[str],
+    fixed_categories: List[str],
+    tier: Optional[ModelTier] = None,
+) -> Dict[str, Any]:
+    """`messages.create` params asking the LLM which of `categories` to merge into which."""
+    fixed_text = ""
+    if len(fixed_categories) > 0:
+        fixed_text = "These categories were chosen by me, so keep each of them as it is (other categories may be merged into them):\n\n" + \
+            "\n".join(fixed_categories) + "\n\n"
+    tier = tier or DEFAULT_TIERS[STAGE_CATEGORIZATION][0]
+    return {
+        "model": tier.model,
+        "max_tokens": tier.max_tokens,
+        "system": [{
+            "type": "text",
+            "text": CATEGORY_RECONCILIATION_INSTRUCTIONS,
+        }],
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": dedent(f"""
+                    I asked my high school students the following question:
+                    "{question.body_text}"
+                """) +
+                    "Here are the categories their responses were sorted into:\n\n" +
+                    "\n".join(categories) + "\n\n" +
+                    fixed_text +
+                    "Respond with a JSON object that maps every one of these categories to the category it should be merged into (or to itself, if it stays as it is).",
+            }],
+        }],
+    }
+
+
+def parse_category_reconciliation(message_text: str, categories: List[str]) -> Dict[str, str]:
+    """The category each of `categories` merges into. Anything the LLM left out or made up stays as it is."""
+    merged_into: Dict[str, Any] = parse_json_object(message_text)
+    normalized = {category.strip().capitalize(): category for category in categories}
+    result: Dict[str, str] = {}
+    for category in categories:
+        target = merged_into.get(category)
+        if not isinstance(target, str):
+            result[category] = category
+            continue
+        # Merge into one of the existing categories where the LLM only changed the casing
+        result[category] = normalized.get(target.strip().capitalize(), target.strip().capitalize())
+    return result
+
+
+def parse_json_object(message_text: str) -> Dict[str, Any]:
+    # Models sometimes wrap the object in prose or a code fence
+    start = message_text.find("{")
+    end = message_text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError(f"no JSON object in response: {message_text[:200]!r}")
+    parsed = json.loads(message_text[start:end + 1])
+    if not isinstance(parsed, dict):
+        raise ValueError("response is not a JSON object")
+    return parsed
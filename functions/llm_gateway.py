@@ -0,0 +1,202 @@
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+import httpx
+from anthropic import Anthropic, APIConnectionError, APIStatusError, DefaultHttpxClient
+from anthropic.types import Message
+
+# Statuses worth waiting out: rate limited, and "overloaded"
+RETRYABLE_STATUS_CODES = {429, 529}
+
+# Attempts on a model before falling back to the next tier, when there is one
+ATTEMPTS_BEFORE_FALLBACK = 2
+
+# Rough per-block costs for estimating a request's input tokens before sending it
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+PDF_PAGE_TOKENS = 1500
+PDF_BYTES_PER_PAGE = 100 * 1024
+
+
+class LLMGatewayBusyError(Exception):
+    """The gateway couldn't get a slot for the call before `queue_timeout_sec` ran out."""
+
+
+class TokenBucket:
+    """Refills continuously up to `capacity_per_minute`; `acquire` blocks until there's room."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self._available = capacity_per_minute
+        self._updated_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def acquire(self, amount: float, deadline: float) -> bool:
+        # A single call bigger than the whole bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        with self._cond:
+            while True:
+                self._refill()
+                if self._available >= amount:
+                    self._available -= amount
+                    return True
+                wait_sec = (amount - self._available) * 60 / self.capacity
+                if time.monotonic() + wait_sec > deadline:
+                    return False
+                self._cond.wait(timeout=wait_sec)
+
+    def release(self, amount: float):
+        """Give back capacity that was reserved but not used."""
+        with self._cond:
+            self._refill()
+            self._available = min(self.capacity, self._available + amount)
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated_at) * self.capacity / 60)
+        self._updated_at = now
+
+
+class LLMGateway:
+    """
+    The one place the functions talk to the LLM provider.
+
+    Holds a single long-lived client (and so one pooled set of HTTP connections) per
+    instance, limits how many calls are in flight, and paces calls through request and
+    token buckets so concurrent analyses queue up here instead of tripping the provider's
+    rate limits. 429 and 529 responses are retried with jittered exponential backoff.
+    The limits are this instance's share of the account's limits.
+    """
+
+    def __init__(
+        self,
+        get_api_key: Callable[[], str],
+        requests_per_minute: int = 50,
+        tokens_per_minute: int = 80_000,
+        max_in_flight: int = 8,
+        max_attempts: int = 5,
+        base_backoff_sec: float = 1,
+        max_backoff_sec: float = 30,
+        queue_timeout_sec: float = 120,
+        request_timeout_sec: float = 120,
+    ):
+        self._get_api_key = get_api_key
+        self.max_attempts = max_attempts
+        self.base_backoff_sec = base_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.queue_timeout_sec = queue_timeout_sec
+        self.request_timeout_sec = request_timeout_sec
+        self.max_in_flight = max_in_flight
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._client: Optional[Anthropic] = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> Anthropic:
+        # Created on first use: the API key param can't be read while the functions are being deployed
+        with self._client_lock:
+            if self._client is None:
+                self._client = Anthropic(
+                    api_key=self._get_api_key(),
+                    # Retries happen here, paced by the limiter, not inside the SDK
+                    max_retries=0,
+                    timeout=self.request_timeout_sec,
+                    http_client=DefaultHttpxClient(limits=httpx.Limits(
+                        max_connections=self.max_in_flight,
+                        max_keepalive_connections=self.max_in_flight,
+                    )),
+                )
+            return self._client
+
+    def create_message_with_fallback(self, tiers: List[Dict[str, Any]], **params: Any) -> Message:
+        """
+        `create_message`, with each of `tiers` (params to override, like the model, max_tokens
+        and timeout) in turn: when a tier is overloaded, rate limited or times out after a
+        couple of attempts, the call moves on to the next one instead of waiting it out.
+        """
+        for i, tier in enumerate(tiers):
+            is_last = i == len(tiers) - 1
+            try:
+                return self.create_message(max_attempts=None if is_last else ATTEMPTS_BEFORE_FALLBACK, **(params | tier))
+            except (APIStatusError, APIConnectionError, LLMGatewayBusyError) as e:
+                if is_last or not _should_fall_back(e):
+                    raise
+                print(f"{tier.get('model')} unavailable ({getattr(e, 'status_code', None) or type(e).__name__}), falling back to {tiers[i + 1].get('model')}")
+
+    def create_message(self, max_attempts: Optional[int] = None, **params: Any) -> Message:
+        """Same arguments as `client.messages.create`."""
+        max_attempts = max_attempts or self.max_attempts
+        reserved_tokens = estimate_input_tokens(params.get('system'), params['messages']) + params['max_tokens']
+        attempt = 0
+        while True:
+            attempt += 1
+            deadline = time.monotonic() + self.queue_timeout_sec
+            if not self._requests.acquire(1, deadline) or not self._tokens.acquire(reserved_tokens, deadline):
+                raise LLMGatewayBusyError("timed out waiting for LLM capacity")
+            if not self._in_flight.acquire(timeout=max(0, deadline - time.monotonic())):
+                raise LLMGatewayBusyError("timed out waiting for an LLM slot")
+            try:
+                message = self.client.messages.create(**params)
+                usage = message.usage
+                cache_write_tokens = usage.cache_creation_input_tokens or 0
+                cache_read_tokens = usage.cache_read_input_tokens or 0
+                print(
+                    f"LLM call used {usage.input_tokens} uncached input tokens, {cache_write_tokens} cache write, "
+                    f"{cache_read_tokens} cache read, {usage.output_tokens} output"
+                )
+                used_tokens = usage.input_tokens + cache_write_tokens + cache_read_tokens + usage.output_tokens
+                self._tokens.release(max(0, reserved_tokens - used_tokens))
+                return message
+            except (APIStatusError, APIConnectionError) as e:
+                status_code = getattr(e, 'status_code', None)
+                retryable = isinstance(e, APIConnectionError) or status_code in RETRYABLE_STATUS_CODES
+                if not retryable or attempt >= max_attempts:
+                    raise
+                backoff_sec = self._backoff_sec(attempt, e)
+                print(f"LLM call failed ({status_code or type(e).__name__}), retrying in {backoff_sec:.1f}s")
+            finally:
+                self._in_flight.release()
+            time.sleep(backoff_sec)
+
+    def _backoff_sec(self, attempt: int, error: Exception) -> float:
+        # Honor the provider's hint when it gives one, otherwise full jitter
+        response: Optional[httpx.Response] = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff_sec)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff_sec, self.base_backoff_sec * 2 ** (attempt - 1)))
+
+
+def _should_fall_back(error: Exception) -> bool:
+    # Another model won't fix a bad request, but it may well not be overloaded or slow
+    if isinstance(error, (APIConnectionError, LLMGatewayBusyError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return status_code in RETRYABLE_STATUS_CODES or (status_code is not None and status_code >= 500)
+
+
+def estimate_input_tokens(system: Any, messages: List[Dict[str, Any]]) -> int:
+    blocks: List[Any] = [system] if system is not None else []
+    for message in messages:
+        blocks += message['content'] if isinstance(message['content'], list) else [message['content']]
+    tokens = 0
+    for block in blocks:
+        if isinstance(block, str):
+            tokens += len(block) // CHARS_PER_TOKEN
+        elif isinstance(block, list):
+            tokens += estimate_input_tokens(None, [{'content': block}])
+        elif block.get('type') == 'image':
+            tokens += IMAGE_TOKENS
+        elif block.get('type') == 'document':
+            pdf_bytes = len(block['source'].get('data', '')) * 3 // 4
+            tokens += PDF_PAGE_TOKENS * max(1, pdf_bytes // PDF_BYTES_PER_PAGE)
+        else:
+            tokens += len(block.get('text', '')) // CHARS_PER_TOKEN
+    return tokens
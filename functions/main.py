@@ -1,135 +1,301 @@
 # The Cloud Functions for Firebase SDK to create Cloud Functions and set up triggers.
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import dataclasses
 import json
-from datetime import datetime, timedelta
-from textwrap import dedent
-from typing import Any, Dict, List
-from firebase_functions import https_fn, options
-from firebase_functions.params import StringParam
-from google.cloud.firestore_v1 import FieldFilter, DocumentReference, CollectionReference, DocumentSnapshot
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+from firebase_functions import firestore_fn, https_fn, options, scheduler_fn, tasks_fn
+from firebase_functions.params import IntParam, StringParam
+from google.cloud.firestore_v1 import FieldFilter, DocumentReference, CollectionReference, DocumentSnapshot, AsyncCollectionReference, AsyncDocumentReference
 # The Firebase Admin SDK to access Cloud Firestore.
-from firebase_admin import initialize_app, firestore, auth, storage
+from firebase_admin import initialize_app, firestore, auth, storage, functions
+from firebase_admin.exceptions import AlreadyExistsError
 import asyncio
-from anthropic import Anthropic
 import requests
-from data_model import Lesson, LessonPlan, LessonQuestion, LessonQuestionAnalysis, LessonResponse, Student, Teacher, Class, TeacherData
+from data_model import AnalysisJob, Lesson, LessonPlan, LessonQuestion, LessonQuestionAnalysis, LessonResponse, Page, Student, Teacher, Class, TeacherData, TeacherDataChanges, Tombstone
+from admin_config import get_admin_config_list
+import analysis_jobs
+from analysis_format import analysis_field_path, compact_analysis, hydrate_analyses, migrate_analyses, move_response
+from async_firestore import async_db, run_async, stream_docs
+from bulk_analysis import poll_bulk_analyses, submit_bulk_analysis
+from drawing_storage import migrate_drawings_to_storage, move_response_drawing
+from categorization import categorize_responses
+from lesson_analysis import QuestionAnalysisPlan, plan_question_analyses
+from llm_gateway import LLMGateway
+from pagination import DEFAULT_PAGE_SIZE, InvalidPageError, PageRequest, fetch_page, get_page_request
+from patches import InvalidPatchError, PatchConflictError, PatchNotFoundError, apply_patch, is_patch, without_server_owned
+from presence import PRESENCE_COLLECTION, merge_student_names, record_student_started
+from provisioning import MAX_ONBOARDING_ATTEMPTS, ONBOARDING_PENDING, ProvisioningResult, load_templates, onboard_teacher, provision_teachers
+import read_model
+from read_model import LESSON_SUMMARY_FIELDS, RESPONSE_SUMMARY_FIELDS
+from response_clustering import cluster_responses, expand_categories
+from teacher_email_backfill import backfill_teacher_emails
+from materials_cache import MaterialsCache
+from model_tiers import STAGE_CATEGORIZATION, stage_tiers
+from identity import invalidate_teacher, resolve_teacher, resolve_teacher_by_email, set_teacher_claim, teacher_refs
+import response_summaries
+import sync
 # from functions import data_model
 
 # OPENAI_API_KEY = StringParam("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = StringParam("ANTHROPIC_API_KEY")
+# How many questions putLesson categorizes at the same time
+ANALYSIS_MAX_CONCURRENCY = IntParam("ANALYSIS_MAX_CONCURRENCY", default=4)
+# How long streamAnalysisJob keeps a connection open before the client has to reconnect
+ANALYSIS_JOB_STREAM_SEC = 480
 
 app = initialize_app()
 db = firestore.client(app)
 bucket = storage.bucket(app=app)
+# Context materials are shared by every question, lock and lesson that uses the lesson plan
+materials_cache = MaterialsCache()
+# Every LLM call goes through here, sharing one connection pool and one rate limiter
+llm_gateway = LLMGateway(lambda: ANTHROPIC_API_KEY.value)
 
 
 ######### Queries
 
+# What the teacher read endpoints return for lessons: everything ("full", the default), or
+# just enough for lists and dashboards ("summary"). The summary view leaves the analysis
+# and the responses themselves on the server, thanks to field masks, and sends per-lesson
+# response counts instead. The lesson being viewed is fetched in full with getLesson.
+# getTeacherData's summary view comes from the teacher's read model (see read_model.py).
+VIEW_FULL = 'full'
+VIEW_SUMMARY = 'summary'
+
+# Paged reads are newest first, ordered by Firestore (see firestore.indexes.json)
+LESSON_PAGE_ORDER = ['deleted', 'created_at']
+CREATED_AT_PAGE_ORDER = ['created_at']
+
+def _getRequestTeacher(request: https_fn.CallableRequest) -> TeacherData:
+    if request.auth is None or request.auth.uid is None:
+        return None
+    return resolve_teacher(db, request.auth.uid, request.auth.token)
+
+
+def _getRequestPage(request: https_fn.CallableRequest) -> PageRequest:
+    try:
+        return get_page_request(request.data)
+    except InvalidPageError as e:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message=str(e))
+
+
+async def _fetchPage(query: Any, coll: AsyncCollectionReference, order_fields: List[str], page: PageRequest):
+    try:
+        return await fetch_page(query, coll, order_fields, page)
+    except InvalidPageError as e:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message=str(e))
+
+
+def _lessonsQuery(lessons_coll: AsyncCollectionReference, summary_view: bool, page: PageRequest = None):
+    query = lessons_coll.where(filter=FieldFilter('deleted', '!=', True))
+    if page is not None:
+        query = query.order_by('deleted').order_by('created_at', direction=firestore.Query.DESCENDING)
+    if summary_view:
+        query = query.select(LESSON_SUMMARY_FIELDS)
+    return query
+
+
+def _getRequestView(request: https_fn.CallableRequest) -> str:
+    view = (request.data or {}).get('view') or VIEW_FULL
+    if view not in [VIEW_FULL, VIEW_SUMMARY]:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message="invalid view")
+    return view
+
+
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def getTeacherData(request: https_fn.CallableRequest):
     if request.auth is None:
         raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.UNAUTHENTICATED, message="login required")
 
     # Look up the teacher
-    user: auth.UserRecord = auth.get_user(request.auth.uid)
-    if user is not None and user.email is not None:
-        teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-        print("teacher matches", len(teacherMatches))
-        if len(teacherMatches) == 1:
-            teacher = TeacherData(**teacherMatches[0].to_dict())
-            if teacher is None or teacher.id is None:
-                raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.NOT_FOUND, message="not found")
-            teacher_id = teacher.id
-            teacher_ref = db.collection('teachers').document(teacher_id)
-
-            # Look up their classes
-            classes_coll: CollectionReference = teacher_ref.collection('classes')
-            class_docs = list(classes_coll.stream())
-            teacher.classes = []
-            if len(class_docs) > 0:
-                teacher.classes = [Class(**class_docs[i].to_dict()) for i in range(len(class_docs))]
-                teacher.classes.sort(key=lambda c: c.created_at)
-                for cls in teacher.classes:
-                    students_ref: CollectionReference = classes_coll.document(cls.id).collection('students')
-                    students = list(students_ref.stream())
-                    cls.students = students
-                    if len(students) > 0:
-                        cls.students = [Student(**students[i].to_dict()) for i in range(len(students))]
-                        # Sort students by name
-                        cls.students.sort(key=lambda student: student.created_at)
-
-            # Look up their lesson plans
-            lesson_plans_coll: CollectionReference = teacher_ref.collection('lesson_plans')
-            lesson_plan_docs = list(lesson_plans_coll.stream())
-            teacher.lesson_plans = []
-            if len(lesson_plan_docs) > 0:
-                teacher.lesson_plans = [LessonPlan(**lesson_plan_docs[i].to_dict()) for i in range(len(lesson_plan_docs))]
-                for plan in teacher.lesson_plans:
-                    questions_coll: CollectionReference = lesson_plans_coll.document(plan.id).collection('questions')
-                    questions = list(questions_coll.stream())
-                    if len(questions) > 0:
-                        # for i in range(len(questions)):
-                        #     print(questions[i].to_dict())
-                        plan.questions = [LessonQuestion(**questions[i].to_dict()) for i in range(len(questions))]
-                        # Sort by created_at
-                        plan.questions.sort(key=lambda question: question.created_at)
-
-            # Look up their lessons
-            lessons_coll: CollectionReference = teacher_ref.collection('lessons')
-            lesson_docs = list(lessons_coll.where(filter=FieldFilter('deleted', '!=', True)).stream())
-            teacher.lessons = []
-            if len(lesson_docs) > 0:
-                teacher.lessons = [Lesson(**lesson_docs[i].to_dict()) for i in range(len(lesson_docs))]
-                teacher.lessons.sort(key=lambda l: l.created_at)
-                for lesson in teacher.lessons:
-                    responses_coll: CollectionReference = lessons_coll.document(lesson.id).collection('responses')
-                    responses = list(responses_coll.stream())
-                    if len(responses) > 0:
-                        lesson.responses = [LessonResponse(**responses[i].to_dict()) for i in range(len(responses))]
-                        # Sort by created_at
-                        lesson.responses.sort(key=lambda response: response.created_at, reverse=True)
-
-            return teacher
+    teacher = _getRequestTeacher(request)
+    if teacher is not None and teacher.id is not None:
+        view = _getRequestView(request)
+        page = _getRequestPage(request)
+        if view == VIEW_SUMMARY and page is None:
+            # One batched read, building the read model first if this teacher doesn't have one yet
+            dashboard = read_model.load(db, teacher)
+            if dashboard is None:
+                read_model.rebuild(db, teacher.id)
+                dashboard = read_model.load(db, teacher)
+            return dashboard
+        return run_async(app, _loadTeacherData(teacher, view, page))
 
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.NOT_FOUND, message="not found")
 
 
+async def _loadTeacherData(teacher: TeacherData, view: str = VIEW_FULL, lessons_page: PageRequest = None) -> TeacherData:
+    # Load every entity type with one query each (the nested ones via collection-group
+    # queries scoped to the teacher), then join them in memory. The number of round trips
+    # stays the same no matter how many classes, lesson plans and lessons the teacher has,
+    # and since the queries don't depend on each other they all run at once.
+    # With `lessons_page`, only that page of lessons (newest first) and their responses are read.
+    teacher_ref = async_db().collection('teachers').document(teacher.id)
+    summary_view = view == VIEW_SUMMARY
+    lessons_coll: AsyncCollectionReference = teacher_ref.collection('lessons')
+    lessons_query = _lessonsQuery(lessons_coll, summary_view, lessons_page)
+    response_fields = RESPONSE_SUMMARY_FIELDS if summary_view else None
+
+    async def read_lessons_and_responses():
+        if lessons_page is None:
+            return await asyncio.gather(
+                stream_docs(lessons_query),
+                _streamTeacherCollectionGroup(teacher, 'responses', response_fields),
+                # The summary view doesn't include who started
+                _streamTeacherCollectionGroup(teacher, PRESENCE_COLLECTION) if not summary_view else _noDocs(),
+            )
+        # A page of lessons needs just their responses, not every response the teacher has
+        lesson_docs, teacher.lessons_next_page_token = await _fetchPage(lessons_query, lessons_coll, LESSON_PAGE_ORDER, lessons_page)
+        response_docs_by_lesson, presence_docs_by_lesson = await asyncio.gather(
+            asyncio.gather(*[
+                stream_docs(
+                    lesson_doc.reference.collection('responses').select(response_fields)
+                    if response_fields is not None else lesson_doc.reference.collection('responses')
+                )
+                for lesson_doc in lesson_docs
+            ]),
+            asyncio.gather(*[
+                stream_docs(lesson_doc.reference.collection(PRESENCE_COLLECTION)) if not summary_view else _noDocs()
+                for lesson_doc in lesson_docs
+            ]),
+        )
+        return (
+            lesson_docs,
+            [doc for docs in response_docs_by_lesson for doc in docs],
+            [doc for docs in presence_docs_by_lesson for doc in docs],
+        )
+
+    (
+        class_docs,
+        student_docs,
+        lesson_plan_docs,
+        question_docs,
+        (lesson_docs, response_docs, presence_docs),
+    ) = await asyncio.gather(
+        stream_docs(teacher_ref.collection('classes')),
+        _streamTeacherCollectionGroup(teacher, 'students'),
+        stream_docs(teacher_ref.collection('lesson_plans')),
+        _streamTeacherCollectionGroup(teacher, 'questions'),
+        read_lessons_and_responses(),
+    )
+
+    # Group the nested docs by the id of the parent doc they live under
+    students_by_class_id = _groupByParentId(student_docs, Student)
+    questions_by_plan_id = _groupByParentId(question_docs, LessonQuestion)
+    responses_by_lesson_id = _groupByParentId(response_docs, dict if summary_view else LessonResponse)
+    presence_docs_by_lesson_id: Dict[str, List[DocumentSnapshot]] = {}
+    for doc in presence_docs:
+        presence_docs_by_lesson_id.setdefault(doc.reference.parent.parent.id, []).append(doc)
+
+    teacher.classes = [Class(**doc.to_dict()) for doc in class_docs]
+    teacher.classes.sort(key=lambda c: c.created_at)
+    for cls in teacher.classes:
+        cls.students = students_by_class_id.get(cls.id, [])
+        # Sort students by name
+        cls.students.sort(key=lambda student: student.created_at)
+
+    teacher.lesson_plans = [LessonPlan(**doc.to_dict()) for doc in lesson_plan_docs]
+    for plan in teacher.lesson_plans:
+        plan.questions = questions_by_plan_id.get(plan.id)
+        if plan.questions is not None:
+            # Sort by created_at
+            plan.questions.sort(key=lambda question: question.created_at)
+
+    teacher.lessons = [Lesson(**doc.to_dict()) for doc in lesson_docs]
+    if lessons_page is None:
+        teacher.lessons.sort(key=lambda l: l.created_at)
+    for lesson in teacher.lessons:
+        if summary_view:
+            lesson.responses_summary = read_model.summarize_responses(responses_by_lesson_id.get(lesson.id, []))
+            continue
+        lesson.student_names_started = merge_student_names(lesson.student_names_started, presence_docs_by_lesson_id.get(lesson.id, []))
+        lesson.responses = responses_by_lesson_id.get(lesson.id)
+        if lesson.responses is not None:
+            # Sort by created_at
+            lesson.responses.sort(key=lambda response: response.created_at, reverse=True)
+        _hydrateLessonAnalysis(lesson)
+
+    return teacher
+
+
+async def _streamTeacherCollectionGroup(
+    teacher: Teacher,
+    collection_id: str,
+    field_paths: List[str] = None,
+    updated_since: str = None,
+) -> List[DocumentSnapshot]:
+    # Every nested doc carries the teacher's email, so one collection-group query gets all of
+    # them. The path check keeps another tenant's docs out if an email was ever reused.
+    query = async_db().collection_group(collection_id).where(
+        filter=FieldFilter('teacher_email', '==', teacher.email_address)
+    )
+    if updated_since is not None:
+        query = query.where(filter=FieldFilter('updated_at', '>', updated_since))
+    if field_paths is not None:
+        query = query.select(field_paths)
+    docs = await stream_docs(query)
+    return [
+        doc for doc in docs
+        if doc.reference.parent.parent.parent.parent.id == teacher.id
+    ]
+
+
+async def _noDocs() -> List[DocumentSnapshot]:
+    return []
+
+
+def _groupByParentId(docs: List[DocumentSnapshot], model: type) -> Dict[str, List[Any]]:
+    grouped: Dict[str, List[Any]] = {}
+    for doc in docs:
+        grouped.setdefault(doc.reference.parent.parent.id, []).append(model(**doc.to_dict()))
+    return grouped
+
+
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def getLessonPlans(request: https_fn.CallableRequest):
-    teacher: TeacherData = None
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
+    teacher = _getRequestTeacher(request)
     if teacher is not None and teacher.id is not None:
-        return _getLessonPlans(teacher, True)
+        page = _getRequestPage(request)
+        lesson_plans = run_async(app, _getLessonPlans(teacher, True, page=page))
+        if page is not None:
+            return Page(items=lesson_plans or [], next_page_token=teacher.lesson_plans_next_page_token)
+        return lesson_plans
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
-def _getLessonPlans(
+async def _getLessonPlans(
     teacher: TeacherData,
     include_questions: bool = False,
     lesson_plan_id: str = None,
+    page: PageRequest = None,
 ) -> List[Lesson]:
-    teacher_ref = db.collection('teachers').document(teacher.id)
+    teacher_ref = async_db().collection('teachers').document(teacher.id)
 
-    lesson_plans_coll: CollectionReference = teacher_ref.collection('lesson_plans')
+    lesson_plans_coll: AsyncCollectionReference = teacher_ref.collection('lesson_plans')
     lesson_plan_docs: List[DocumentSnapshot] = []
     if lesson_plan_id is not None:
-        lesson_plan_docs = [lesson_plans_coll.document(lesson_plan_id).get()]
+        lesson_plan_docs = [await lesson_plans_coll.document(lesson_plan_id).get()]
+    elif page is not None:
+        lesson_plan_docs, teacher.lesson_plans_next_page_token = await _fetchPage(
+            lesson_plans_coll.order_by('created_at', direction=firestore.Query.DESCENDING),
+            lesson_plans_coll,
+            CREATED_AT_PAGE_ORDER,
+            page,
+        )
     else:
-        lesson_plan_docs = list(lesson_plans_coll.stream())
+        lesson_plan_docs = await stream_docs(lesson_plans_coll)
     if len(lesson_plan_docs) > 0:
         teacher.lesson_plans = [LessonPlan(**lesson_plan_docs[i].to_dict()) for i in range(len(lesson_plan_docs))]
 
-        # Join questions if requested
+        # Join questions if requested, fetching every plan's questions at once
         if include_questions:
-            for plan in teacher.lesson_plans:
-                questions_coll: CollectionReference = lesson_plans_coll.document(plan.id).collection('questions')
-                question_docs = list(questions_coll.stream())
+            question_docs_by_plan = await asyncio.gather(*[
+                stream_docs(lesson_plans_coll.document(plan.id).collection('questions'))
+                for plan in teacher.lesson_plans
+            ])
+            for plan, question_docs in zip(teacher.lesson_plans, question_docs_by_plan):
                 if len(question_docs) > 0:
                     plan.questions = [
                         LessonQuestion(
@@ -145,64 +311,201 @@ def _getLessonPlans(
 # Meant to be called by the teacher
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def getLessons(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                return _getLessons(teacher, True)
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        page = _getRequestPage(request)
+        lessons = run_async(app, _getLessons(teacher, True, view=_getRequestView(request), page=page))
+        if page is not None:
+            return Page(items=lessons or [], next_page_token=teacher.lessons_next_page_token)
+        return lessons
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
-def _getLessons(
+async def _getLessons(
     teacher: TeacherData,
     include_responses: bool = False,
     lesson_id: str = None,
+    include_lesson_plan: bool = False,
+    view: str = VIEW_FULL,
+    page: PageRequest = None,
 ) -> List[Lesson]:
     if teacher is not None and teacher.id is not None:
         # Look up their lesson plans
-        teacher_ref = db.collection('teachers').document(teacher.id)
-        lessons_coll: CollectionReference = teacher_ref.collection('lessons')
+        teacher_ref = async_db().collection('teachers').document(teacher.id)
+        lessons_coll: AsyncCollectionReference = teacher_ref.collection('lessons')
         lessons_data: Dict[str, Any] = []
+        summary_view = view == VIEW_SUMMARY
 
         if lesson_id is not None:
             lessons_data = [
-                lessons_coll.document(lesson_id).get()
+                await lessons_coll.document(lesson_id).get(field_paths=LESSON_SUMMARY_FIELDS if summary_view else None)
             ]
+        elif page is not None:
+            lessons_data, teacher.lessons_next_page_token = await _fetchPage(
+                _lessonsQuery(lessons_coll, summary_view, page), lessons_coll, LESSON_PAGE_ORDER, page,
+            )
         else:
-            lessons_data = list(lessons_coll.where(
-                filter=FieldFilter('deleted', '!=', True)
-            ).stream())
+            lessons_data = await stream_docs(_lessonsQuery(lessons_coll, summary_view))
 
         if len(lessons_data) > 0:
             teacher.lessons = [Lesson(**lessons_data[i].to_dict()) for i in range(len(lessons_data))]
 
+            # Everything joined onto the lessons is independent, so fetch it all concurrently
+            reads: List[Awaitable[Any]] = []
+            if not summary_view:
+                reads += [
+                    _joinLessonPresence(lesson, lessons_coll.document(lesson.id).collection(PRESENCE_COLLECTION))
+                    for lesson in teacher.lessons
+                ]
             if include_responses:
-                for plan in teacher.lessons:
-                    responses_coll: CollectionReference = lessons_coll.document(plan.id).collection('responses')
-                    responses = list(responses_coll.stream())
-                    if len(responses) > 0:
-                        plan.responses = [LessonResponse(**responses[i].to_dict()) for i in range(len(responses))]
-                        # Sort by created_at
-                        plan.responses.sort(key=lambda r: r.created_at)
-            
+                reads += [
+                    _joinLessonResponses(lesson, lessons_coll.document(lesson.id).collection('responses'), summary_view)
+                    for lesson in teacher.lessons
+                ]
             # Join class if requesting 1 lesson
             if lesson_id is not None:
-                classes_coll: CollectionReference = teacher_ref.collection('classes')
                 lesson = teacher.lessons[0]
-                lesson.class_data = Class(**classes_coll.document(lesson.class_id).get().to_dict())
-                
-                students_ref: CollectionReference = classes_coll.document(lesson.class_data.id).collection('students')
-                students = list(students_ref.stream())
-                if len(students) > 0:
-                    lesson.class_data.students = [Student(**students[i].to_dict()) for i in range(len(students))]
-                    # Sort students by name
-                    lesson.class_data.students.sort(key=lambda student: student.created_at)
+                reads.append(_joinLessonClass(lesson, teacher_ref.collection('classes')))
+                if include_lesson_plan:
+                    reads.append(_joinLessonPlan(teacher, lesson))
+            await asyncio.gather(*reads)
+            if include_responses and not summary_view:
+                for lesson in teacher.lessons:
+                    _hydrateLessonAnalysis(lesson)
 
             return teacher.lessons
 
 
+def _hydrateLessonAnalysis(lesson: Lesson):
+    # The analysis stores response ids; send the responses themselves along with them
+    hydrate_analyses(lesson.analysis_by_question_id, {response.id: response.__dict__ for response in lesson.responses or []})
+
+
+async def _joinLessonPresence(lesson: Lesson, presence_coll: AsyncCollectionReference):
+    lesson.student_names_started = merge_student_names(lesson.student_names_started, await stream_docs(presence_coll))
+
+
+async def _joinLessonResponses(lesson: Lesson, responses_coll: AsyncCollectionReference, summary_view: bool = False):
+    if summary_view:
+        responses = await stream_docs(responses_coll.select(RESPONSE_SUMMARY_FIELDS))
+        lesson.responses_summary = read_model.summarize_responses([doc.to_dict() for doc in responses])
+        return
+    responses = await stream_docs(responses_coll)
+    if len(responses) > 0:
+        lesson.responses = [LessonResponse(**responses[i].to_dict()) for i in range(len(responses))]
+        # Sort by created_at
+        lesson.responses.sort(key=lambda r: r.created_at)
+
+
+# One page of a lesson's responses, newest first
+@https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
+def getLessonResponses(request: https_fn.CallableRequest):
+    teacher = _getRequestTeacher(request)
+    lesson_id = (request.data or {}).get('lesson_id')
+    if teacher is not None and lesson_id is not None:
+        page = _getRequestPage(request) or PageRequest(page_size=DEFAULT_PAGE_SIZE)
+        return run_async(app, _getLessonResponsesPage(teacher, lesson_id, page))
+    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+
+
+async def _getLessonResponsesPage(teacher: TeacherData, lesson_id: str, page: PageRequest) -> Page:
+    responses_coll: AsyncCollectionReference = async_db().collection('teachers').document(teacher.id).collection('lessons').document(lesson_id).collection('responses')
+    response_docs, next_page_token = await _fetchPage(
+        responses_coll.order_by('created_at', direction=firestore.Query.DESCENDING),
+        responses_coll,
+        CREATED_AT_PAGE_ORDER,
+        page,
+    )
+    return Page(
+        items=[LessonResponse(**doc.to_dict()) for doc in response_docs],
+        next_page_token=next_page_token,
+    )
+
+
+async def _joinLessonClass(lesson: Lesson, classes_coll: AsyncCollectionReference):
+    class_ref: AsyncDocumentReference = classes_coll.document(lesson.class_id)
+    class_doc, students = await asyncio.gather(
+        class_ref.get(),
+        stream_docs(class_ref.collection('students')),
+    )
+    lesson.class_data = Class(**class_doc.to_dict())
+    if len(students) > 0:
+        lesson.class_data.students = [Student(**students[i].to_dict()) for i in range(len(students))]
+        # Sort students by name
+        lesson.class_data.students.sort(key=lambda student: student.created_at)
+
+
+async def _joinLessonPlan(teacher: TeacherData, lesson: Lesson):
+    lesson_plans = await _getLessonPlans(teacher, True, lesson.lesson_plan_id)
+    lesson.lesson_plan = lesson_plans[0]
+
+
+# Everything that changed since the client's last sync: the docs created or updated after
+# `since` (a watermark from a previous sync), and tombstones for the ones deleted. Without
+# `since`, everything.
+@https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
+def syncTeacherData(request: https_fn.CallableRequest):
+    teacher = _getRequestTeacher(request)
+    if teacher is not None and teacher.id is not None:
+        since = (request.data or {}).get('since') or ""
+        if not isinstance(since, str):
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message="invalid since")
+        return run_async(app, _loadTeacherDataChanges(teacher, since))
+    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+
+
+async def _loadTeacherDataChanges(teacher: TeacherData, since: str) -> TeacherDataChanges:
+    # Taken before any reads, so nothing written during them can fall between two syncs
+    watermark = sync.sync_watermark()
+    teacher_ref = async_db().collection('teachers').document(teacher.id)
+    updated_since = FieldFilter('updated_at', '>', since)
+    (
+        class_docs,
+        student_docs,
+        lesson_plan_docs,
+        question_docs,
+        lesson_docs,
+        response_docs,
+        presence_docs,
+        tombstone_docs,
+    ) = await asyncio.gather(
+        stream_docs(teacher_ref.collection('classes').where(filter=updated_since)),
+        _streamTeacherCollectionGroup(teacher, 'students', updated_since=since),
+        stream_docs(teacher_ref.collection('lesson_plans').where(filter=updated_since)),
+        _streamTeacherCollectionGroup(teacher, 'questions', updated_since=since),
+        # Soft-deleted lessons included, so the client sees them go
+        stream_docs(teacher_ref.collection('lessons').where(filter=updated_since)),
+        _streamTeacherCollectionGroup(teacher, 'responses', updated_since=since),
+        _streamTeacherCollectionGroup(teacher, PRESENCE_COLLECTION, updated_since=since),
+        stream_docs(teacher_ref.collection(sync.TOMBSTONES_COLLECTION).where(filter=FieldFilter('deleted_at', '>', since))),
+    )
+    # A student starting changes the lesson's `student_names_started` without touching the
+    # lesson doc, so those lessons count as changed too
+    lessons = [Lesson(**doc.to_dict()) for doc in lesson_docs]
+    lesson_ids_changed = set(lesson.id for lesson in lessons)
+    lesson_ids_started = set(doc.reference.parent.parent.id for doc in presence_docs) - lesson_ids_changed
+    if len(lesson_ids_started) > 0:
+        lessons += [
+            Lesson(**doc.to_dict())
+            for doc in await asyncio.gather(*[teacher_ref.collection('lessons').document(lesson_id).get() for lesson_id in lesson_ids_started])
+            if doc.exists
+        ]
+    await asyncio.gather(*[
+        _joinLessonPresence(lesson, teacher_ref.collection('lessons').document(lesson.id).collection(PRESENCE_COLLECTION))
+        for lesson in lessons
+    ])
+    return TeacherDataChanges(
+        watermark=watermark,
+        classes=[Class(**doc.to_dict()) for doc in class_docs],
+        students=[Student(**doc.to_dict()) for doc in student_docs],
+        lesson_plans=[LessonPlan(**doc.to_dict()) for doc in lesson_plan_docs],
+        questions=[LessonQuestion(**doc.to_dict()) for doc in question_docs],
+        lessons=lessons,
+        responses=[LessonResponse(**doc.to_dict()) for doc in response_docs],
+        tombstones=[Tombstone(**doc.to_dict()) for doc in tombstone_docs],
+    )
+
+
 ######### Commands
 
 
@@ -211,617 +514,774 @@ def _getLessons(
     timeout_sec=300,
 )
 def configureDefaultLessons(_: https_fn.Request):
-    _configureDefaultLessons()
-
-def _configureDefaultLessons(teacher_id: str = None):
-    template_lesson_ids_str: str = db.collection('admin_configs').document("current").get().to_dict().get("default_lesson_ids")
-    template_lesson_ids = template_lesson_ids_str.split(',')
+    result = _configureDefaultLessons()
+    return https_fn.Response(
+        response=json.dumps({
+            "result": dataclasses.asdict(result),
+        }),
+    )
+
+def _configureDefaultLessons() -> ProvisioningResult:
+    # Make sure every teacher has the default lessons with the exact same IDs
+    teachers = [Teacher(**doc.to_dict()) for doc in db.collection('teachers').stream()]
+    templates = load_templates(db, get_admin_config_list(db, "default_lesson_ids"))
+    result = provision_teachers(db, teachers, templates)
+    print(f"configured default lessons: {result}")
+    return result
+
+
+def _requireAdmin(request: https_fn.Request) -> Optional[https_fn.Response]:
+    """An error response unless the request carries the ID token of an admin (listed in `admin_emails`)."""
+    id_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    try:
+        decoded_token = auth.verify_id_token(id_token)
+    except Exception:
+        return https_fn.Response(status=401, response="login required")
+    if not decoded_token.get('email_verified') or decoded_token.get('email') not in get_admin_config_list(db, "admin_emails"):
+        return https_fn.Response(status=403, response="admins only")
+    return None
+
+
+def _adminRequestData(request: https_fn.Request) -> Dict[str, Any]:
+    """The `data` of an admin tool's POST body, or {} without one."""
+    return (request.get_json(silent=True) or {}).get('data') or {}
+
+
+# Re-run analysis in bulk through the Message Batches API (an admin tool). The collecting
+# happens in one task per teacher (see submitBulkAnalysis), not in this request.
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["POST"]),
+)
+def bulkAnalyzeLessons(request: https_fn.Request):
+    denied = _requireAdmin(request)
+    if denied is not None:
+        return denied
+    data = _adminRequestData(request)
+    teacher_ids = [ref.id for ref in teacher_refs(db, data.get('teacher_id'))]
+    queue = functions.task_queue("submitBulkAnalysis", app=app)
+    for teacher_id in teacher_ids:
+        queue.enqueue({
+            "teacher_id": teacher_id,
+            "resummarize": data.get('resummarize') is True,
+            "recategorize": data.get('recategorize') is True,
+        })
+    return https_fn.Response(
+        response=json.dumps({
+            "result": {"teachers_queued": len(teacher_ids)},
+        }),
+    )
+
+
+# One teacher's part of bulkAnalyzeLessons. Not retried: a retry could submit the same paid batch twice.
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=1),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=5),
+    timeout_sec=1800,
+    memory=options.MemoryOption.GB_1,
+)
+def submitBulkAnalysis(request: https_fn.CallableRequest):
+    result = submit_bulk_analysis(
+        db,
+        llm_gateway.client,
+        get_as_base64,
+        materials_cache.get_base64,
+        teacher_id=request.data.get('teacher_id'),
+        analyze_online=lambda lesson_ref, lesson, plans: _startAnalysisJob(lesson_ref.parent.parent.id, lesson.teacher_email, lesson_ref, plans),
+        resummarize=request.data.get('resummarize') is True,
+        recategorize=request.data.get('recategorize') is True,
+    )
+    print(f"submitted bulk analysis of teacher {request.data.get('teacher_id')}: {result}")
+
+
+# Recompute the dashboard read models (one teacher's, or everyone's) from the source collections
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["POST"]),
+    timeout_sec=540,
+)
+def rebuildReadModels(request: https_fn.Request):
+    denied = _requireAdmin(request)
+    if denied is not None:
+        return denied
+    data = _adminRequestData(request)
+    teacher_ids = [ref.id for ref in teacher_refs(db, data.get('teacher_id'))]
+    rebuilt = 0
+    for teacher_id in teacher_ids:
+        try:
+            read_model.rebuild(db, teacher_id)
+            rebuilt += 1
+        except Exception as e:
+            print(f"couldn't rebuild the read model of teacher {teacher_id}: {e}")
+    return https_fn.Response(
+        response=json.dumps({
+            "result": {"read_models_rebuilt": rebuilt},
+        }),
+    )
 
-    # Iterate over entire `teachers` collection and make sure they all have the default lessons with the exact same IDs
-    teachers_coll = db.collection('teachers')
-    teachers = list(teachers_coll.stream())
-    for teacher in teachers:
-        if teacher_id is not None and teacher_id != teacher.id:
-            continue
 
-        teacher = Teacher(**teacher.to_dict())
-        teacher_id = teacher.id
-        teacher_ref = teachers_coll.document(teacher_id)
+# Move drawings saved inline in responses out to Cloud Storage (an admin tool, like configureDefaultLessons)
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["POST"]),
+    timeout_sec=540,
+    memory=options.MemoryOption.GB_1,
+)
+def migrateDrawingsToStorage(request: https_fn.Request):
+    denied = _requireAdmin(request)
+    if denied is not None:
+        return denied
+    data = _adminRequestData(request)
+    moved = migrate_drawings_to_storage(db, bucket, teacher_id=data.get('teacher_id'))
+    return https_fn.Response(
+        response=json.dumps({
+            "result": {"drawings_moved": moved},
+        }),
+    )
+
+
+# Convert analyses stored with embedded responses to the id format (see analysis_format.py)
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["POST"]),
+    timeout_sec=540,
+)
+def migrateAnalysisFormat(request: https_fn.Request):
+    denied = _requireAdmin(request)
+    if denied is not None:
+        return denied
+    data = _adminRequestData(request)
+    migrated = migrate_analyses(db, teacher_id=data.get('teacher_id'))
+    return https_fn.Response(
+        response=json.dumps({
+            "result": {"lessons_migrated": migrated},
+        }),
+    )
+
+
+# Set teacher_email on nested docs saved before the server set it (see teacher_email_backfill.py)
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["POST"]),
+    timeout_sec=540,
+)
+def backfillTeacherEmails(request: https_fn.Request):
+    denied = _requireAdmin(request)
+    if denied is not None:
+        return denied
+    data = _adminRequestData(request)
+    backfilled = backfill_teacher_emails(db, teacher_id=data.get('teacher_id'))
+    return https_fn.Response(
+        response=json.dumps({
+            "result": {"docs_backfilled": backfilled},
+        }),
+    )
 
-        teacher_lessons_coll: CollectionReference = teacher_ref.collection('lessons')        
-        teacher_lesson_plans_coll: CollectionReference = teacher_ref.collection('lesson_plans')
-        teacher_classes_coll: CollectionReference = teacher_ref.collection('classes')
-        
-        try:
-            # Add the default lessons if they're not already there
-            for template_lesson_id_str in template_lesson_ids:
-                [template_teacher_id, template_lesson_id] = template_lesson_id_str.split(':')
-
-                if teacher.id == template_teacher_id:
-                    continue
-
-                template_teacher_ref = db.collection('teachers').document(template_teacher_id)
-                template_lesson_ref: DocumentReference = template_teacher_ref.collection('lessons').document(template_lesson_id)
-                template_lesson: DocumentSnapshot = template_lesson_ref.get()
-                template_lesson_plans_coll: CollectionReference = template_teacher_ref.collection('lesson_plans')
-                template_lesson_plan: DocumentSnapshot = template_lesson_plans_coll.document(template_lesson.to_dict().get('lesson_plan_id')).get()
-                template_classes_coll: CollectionReference = template_teacher_ref.collection('classes')
-                template_class_ref = template_classes_coll.document(template_lesson.to_dict().get('class_id'))
-                template_class: DocumentSnapshot = template_class_ref.get()
-                template_students_coll: CollectionReference = template_class_ref.collection('students')
-                template_students_snap: list[DocumentSnapshot] = list(template_students_coll.stream())
-                template_students = [Student(**student.to_dict()) for student in template_students_snap]
-
-                # if template_lesson_id not in teacher_lesson_ids:
-                tl_data = template_lesson.to_dict()
-                tl_data['teacher_email'] = teacher.email_address
-                tl_data['teacher_name'] = teacher.nickname
-                teacher_lessons_coll.document(template_lesson_id).set(document_data=tl_data)
-                print(f"wrote lesson {tl_data} for teacher {teacher.email_address}")
-
-                template_responses_coll: CollectionReference = template_lesson_ref.collection('responses')
-                template_responses_snap: list[DocumentSnapshot] = list(template_responses_coll.stream())
-                template_responses = [LessonResponse(**response.to_dict()) for response in template_responses_snap]
-                teacher_responses_coll: CollectionReference = teacher_lessons_coll.document(template_lesson_id).collection('responses')
-                # DELETE ALL EXISTING RESPONSES
-                teacher_responses_existing = list(teacher_responses_coll.stream())
-                for tre in teacher_responses_existing:
-                    teacher_responses_coll.document(tre.id).delete()
-                # resp_id_to_img_url: dict[str, str] = {}
-                for template_response in template_responses:
-                    tr_data = template_response.__dict__
-                    tr_data['teacher_email'] = teacher.email_address
-                    # # Convert the base64 images into uploaded images
-                    # resp_id_to_img_url[template_response.id] = template_response.response_image_url
-                    # if template_response.response_has_drawing and (
-                    #     template_response.response_image_base64 is not None and template_response.response_image_base64 != "" and (
-                    #         template_response.response_image_url is None or template_response.response_image_url == "")
-                    # ):
-                    #     if template_response.id not in resp_id_to_img_url or not resp_id_to_img_url[template_response.id]:
-                    #         blb = bucket.blob(f"default-teacher/student-responses/{template_response.id}_drawing_{datetime.now().isoformat()}.png")
-                    #         blb.upload_from_string(
-                    #             client=bucket.client,
-                    #             data=base64.b64decode(
-                    #                 template_response.response_image_base64.replace("data:image/png;base64,", "")
-                    #             ),
-                    #             content_type="image/png",
-                    #         )
-                    #         blb.make_public()
-                    #         resp_id_to_img_url[template_response.id] = blb.public_url
-                    #     tr_data['response_image_url'] = resp_id_to_img_url[template_response.id]
-                    #     tr_data['response_image_base64'] = None
-                    teacher_responses_coll.document(template_response.id).set(document_data=tr_data)
-
-                # In the same way, add the lesson plan if it's not already there
-                template_lesson_plan_id = template_lesson.to_dict().get('lesson_plan_id')
-                # if template_lesson_plan_id not in teacher_lesson_plan_ids:
-                template_lesson_plan: DocumentSnapshot = template_lesson_plans_coll.document(template_lesson_plan_id).get()
-                tlp_data = template_lesson_plan.to_dict()
-                tlp_data['teacher_email'] = teacher.email_address
-                teacher_lesson_plans_coll.document(template_lesson_plan_id).set(document_data=tlp_data)
-                print(f"wrote lesson plan {tlp_data} for teacher {teacher.email_address}")
-
-                template_questions_coll: CollectionReference = template_lesson_plans_coll.document(template_lesson_plan_id).collection('questions')
-                template_questions_snap: list[DocumentSnapshot] = list(template_questions_coll.stream())
-                template_questions = [LessonQuestion(**question.to_dict()) for question in template_questions_snap]
-                print(f"got template_questions: {template_questions}")
-                for template_question in template_questions:
-                    teacher_questions_coll: CollectionReference = teacher_lesson_plans_coll.document(template_lesson_plan_id).collection('questions')
-                    tq_data = template_question.__dict__
-                    tq_data['teacher_email'] = teacher.email_address
-                    print(f"got tq_data: {tq_data}")
-                    teacher_questions_coll.document(template_question.id).set(document_data=tq_data)
-
-                # if template_class_id not in teacher_class_ids:
-                template_class_id = template_lesson.to_dict().get('class_id')
-                template_class: DocumentSnapshot = template_classes_coll.document(template_class_id).get()
-                tc_data = template_class.to_dict()
-                tc_data['teacher_email'] = teacher.email_address
-                if not teacher_classes_coll.document(template_class_id).get().exists:
-                    teacher_classes_coll.document(template_class_id).set(document_data=tc_data)
-                    print(f"wrote class {tc_data} for teacher {teacher.email_address}")
-                for template_student in template_students:
-                    teacher_students_coll: CollectionReference = teacher_classes_coll.document(template_class_id).collection('students')
-                    ts_data = template_student.__dict__
-                    ts_data['teacher_email'] = teacher.email_address
-                    if not teacher_students_coll.document(template_student.id).get().exists:
-                        teacher_students_coll.document(template_student.id).set(document_data=ts_data)
-                        print(f"wrote student {ts_data} for teacher {teacher.email_address} and class {template_class_id}")
-        except Exception as e:
-            print(f"error configuring default lessons for teacher {teacher.email_address}: {e}")
-            return f"error: {e}"
-            
 
-    return "success"
+@scheduler_fn.on_schedule(schedule="every 10 minutes", timeout_sec=540, memory=options.MemoryOption.GB_1)
+def pollAnalysisBatches(_: scheduler_fn.ScheduledEvent):
+    batches_finished = poll_bulk_analyses(db, llm_gateway.client)
+    print(f"wrote back {batches_finished} analysis batches")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putTeacher(request: https_fn.CallableRequest):
     if request.auth is not None and request.auth.uid is not None:
-        emails_allowed_str: str = db.collection('admin_configs').document("current").get().to_dict().get("emails_allowed")
-        emails_allowed = emails_allowed_str.split(',')
+        emails_allowed = get_admin_config_list(db, "emails_allowed")
         if request.auth.token.get('email') in emails_allowed:
-            teacher_data: Teacher = Teacher(**request.data)
+            # The client sends back what getTeacherData returned, which has more than the Teacher fields
+            teacher_fields = [field.name for field in dataclasses.fields(Teacher)]
+            teacher_data: Teacher = Teacher(**{key: value for key, value in request.data.items() if key in teacher_fields})
             teacher_data.user_id = request.auth.uid
             teacher_data.email_address = request.auth.token.get('email')
             if teacher_data.id is not None:
+                # The default lessons are copied in the background (see onboardTeacher)
+                teacher_data.onboarding_status = ONBOARDING_PENDING
+                teacher_data.onboarding_error = None
                 db.collection('teachers').document(teacher_data.id).set(
                     document_data=teacher_data.__dict__, merge=True
                 )
-                _configureDefaultLessons(teacher_data.id)
+                # Point the caller's token at their teacher doc, and drop any stale cached copy
+                set_teacher_claim(request.auth.uid, teacher_data.id)
+                invalidate_teacher(request.auth.uid, teacher_data.email_address)
+                _enqueueOnboarding(teacher_data.id)
                 return "success"
         raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
     raise https_fn.HttpsError(code=401, message="login required")
 
 
+def _enqueueOnboarding(teacher_id: str):
+    try:
+        functions.task_queue("onboardTeacher", app=app).enqueue({"teacher_id": teacher_id})
+    except Exception as e:
+        # Better a slow sign-up than a teacher without the default lessons
+        print(f"couldn't enqueue the onboarding of teacher {teacher_id}, onboarding now: {e}")
+        onboard_teacher(db, teacher_id, get_admin_config_list(db, "default_lesson_ids"))
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=MAX_ONBOARDING_ATTEMPTS, min_backoff_seconds=10),
+    timeout_sec=300,
+)
+def onboardTeacher(request: https_fn.CallableRequest):
+    onboard_teacher(db, request.data.get('teacher_id'), get_admin_config_list(db, "default_lesson_ids"))
+
+
+def _applyPatch(ref: DocumentReference, model: type, data: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    try:
+        return apply_patch(db, ref, model, data)
+    except InvalidPatchError as e:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT, message=str(e))
+    except PatchNotFoundError:
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.NOT_FOUND, message="not found")
+    except PatchConflictError as e:
+        # The client should re-read and try again
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.ABORTED, message=str(e))
+
+
+def _patchDoc(ref: DocumentReference, model: type, data: Dict[str, Any]) -> Dict[str, Any]:
+    # The new updated_at is the client's `expected_updated_at` for its next patch
+    _, after = _applyPatch(ref, model, data)
+    return {"updated_at": after.get('updated_at')}
+
+
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putClass(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                class_data = Class(**request.data)
-                class_id = class_data.id
-                # Don't save nested data
-                class_data.students = None
-                if teacher is not None and teacher_id is not None and class_id is not None:
-                    classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
-                    classes_coll.document(class_id).set(document_data=class_data.__dict__, merge=True)
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        if is_patch(request.data):
+            class_id = request.data.get('id')
+            if teacher_id is not None and class_id is not None:
+                return _patchDoc(db.collection('teachers').document(teacher_id).collection('classes').document(class_id), Class, request.data)
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+        class_data = Class(**request.data)
+        class_id = class_data.id
+        class_data.teacher_email = teacher.email_address
+        class_data.updated_at = sync.server_now()
+        if teacher is not None and teacher_id is not None and class_id is not None:
+            classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
+            # Don't save nested data
+            classes_coll.document(class_id).set(document_data=without_server_owned(Class, class_data.__dict__), merge=True)
+            return "success"
         raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
     
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def deleteClass(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                class_id = request.data.get('id')
-                if teacher is not None and teacher_id is not None and class_id is not None:
-                    classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
-                    print("deleting class from collection", classes_coll)
-                    doc_ref = classes_coll.document(class_id)
-                    print("deleting this", doc_ref.get().to_dict())
-                    doc_ref.delete()
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        class_id = request.data.get('id')
+        if teacher is not None and teacher_id is not None and class_id is not None:
+            classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
+            print("deleting class from collection", classes_coll)
+            doc_ref = classes_coll.document(class_id)
+            print("deleting this", doc_ref.get().to_dict())
+            doc_ref.delete()
+            sync.record_tombstone(db, teacher_id, sync.KIND_CLASS, class_id)
+            return "success"
         raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putStudent(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                student_data = Student(**request.data)
-                class_id = student_data.class_id
-                student_id = student_data.id
-                if teacher_id is not None and class_id is not None and student_id is not None:
-                    classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
-                    students_coll: CollectionReference = classes_coll.document(class_id).collection('students')
-                    students_coll.document(student_id).set(document_data=student_data.__dict__, merge=True)
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        if is_patch(request.data):
+            class_id = request.data.get('class_id')
+            student_id = request.data.get('id')
+            if teacher_id is not None and class_id is not None and student_id is not None:
+                classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
+                return _patchDoc(classes_coll.document(class_id).collection('students').document(student_id), Student, request.data)
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+        student_data = Student(**request.data)
+        # What the teacher's students are found by (see _streamTeacherCollectionGroup), so never the client's
+        student_data.teacher_email = teacher.email_address
+        student_data.updated_at = sync.server_now()
+        class_id = student_data.class_id
+        student_id = student_data.id
+        if teacher_id is not None and class_id is not None and student_id is not None:
+            classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
+            students_coll: CollectionReference = classes_coll.document(class_id).collection('students')
+            students_coll.document(student_id).set(document_data=student_data.__dict__, merge=True)
+            return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def deleteStudent(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                class_id = request.data.get('class_id')
-                student_id = request.data.get('id')
-                if teacher_id is not None and class_id is not None and student_id is not None:
-                    classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
-                    students_coll: CollectionReference = classes_coll.document(class_id).collection('students')
-                    students_coll.document(student_id).delete()
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        class_id = request.data.get('class_id')
+        student_id = request.data.get('id')
+        if teacher_id is not None and class_id is not None and student_id is not None:
+            classes_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('classes')
+            students_coll: CollectionReference = classes_coll.document(class_id).collection('students')
+            students_coll.document(student_id).delete()
+            sync.record_tombstone(db, teacher_id, sync.KIND_STUDENT, student_id, class_id)
+            return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putLessonPlan(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                plan_data = LessonPlan(**request.data)
-
-                # Don't save nested data!
-                plan_data.questions = None
-
-                plan_id = plan_data.id
-                if teacher_id is not None and plan_data is not None:
-                    db.collection('teachers').document(teacher_id).collection(
-                        'lesson_plans').document(plan_id).set(
-                            document_data=plan_data.__dict__, merge=True)
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        if is_patch(request.data):
+            plan_id = request.data.get('id')
+            if teacher_id is not None and plan_id is not None:
+                return _patchDoc(db.collection('teachers').document(teacher_id).collection('lesson_plans').document(plan_id), LessonPlan, request.data)
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+        plan_data = LessonPlan(**request.data)
+        plan_data.updated_at = sync.server_now()
+
+        plan_id = plan_data.id
+        if teacher_id is not None and plan_data is not None:
+            # Don't save nested data!
+            db.collection('teachers').document(teacher_id).collection(
+                'lesson_plans').document(plan_id).set(
+                    document_data=without_server_owned(LessonPlan, plan_data.__dict__), merge=True)
+            return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def deleteLessonPlan(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                plan_id = request.data.get('id')
-                if teacher_id is not None and plan_id is not None:
-                    db.collection('teachers').document(teacher_id).collection('lesson_plans').document(plan_id).delete()
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        plan_id = request.data.get('id')
+        if teacher_id is not None and plan_id is not None:
+            db.collection('teachers').document(teacher_id).collection('lesson_plans').document(plan_id).delete()
+            sync.record_tombstone(db, teacher_id, sync.KIND_LESSON_PLAN, plan_id)
+            return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putLessonQuestion(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                question_data = LessonQuestion(**request.data)
-                lesson_plan_id = question_data.lesson_plan_id
-                question_id = question_data.id
-                if teacher_id is not None and lesson_plan_id is not None and question_data is not None:
-
-                    # Save the question
-                    db.collection('teachers').document(teacher_id).collection(
-                        'lesson_plans').document(lesson_plan_id).collection(
-                            'questions').document(question_id).set(
-                                document_data=question_data.__dict__, merge=True)
-
-                    return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        if is_patch(request.data):
+            lesson_plan_id = request.data.get('lesson_plan_id')
+            question_id = request.data.get('id')
+            if teacher_id is not None and lesson_plan_id is not None and question_id is not None:
+                plans_coll: CollectionReference = db.collection('teachers').document(teacher_id).collection('lesson_plans')
+                return _patchDoc(plans_coll.document(lesson_plan_id).collection('questions').document(question_id), LessonQuestion, request.data)
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+        question_data = LessonQuestion(**request.data)
+        # What the teacher's questions are found by (see _streamTeacherCollectionGroup), so never the client's
+        question_data.teacher_email = teacher.email_address
+        question_data.updated_at = sync.server_now()
+        lesson_plan_id = question_data.lesson_plan_id
+        question_id = question_data.id
+        if teacher_id is not None and lesson_plan_id is not None and question_data is not None:
+
+            # Save the question
+            db.collection('teachers').document(teacher_id).collection(
+                'lesson_plans').document(lesson_plan_id).collection(
+                    'questions').document(question_id).set(
+                        document_data=question_data.__dict__, merge=True)
+
+            return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def deleteLessonQuestion(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                lesson_plan_id = request.data.get('lesson_plan_id')
-                question_id = request.data.get('id')
-                if teacher_id is not None and lesson_plan_id is not None and question_id is not None:
-                    db.collection('teachers').document(teacher_id).collection('lesson_plans').document(lesson_plan_id).collection('questions').document(question_id).delete()
-                    return "success"
-                raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        lesson_plan_id = request.data.get('lesson_plan_id')
+        question_id = request.data.get('id')
+        if teacher_id is not None and lesson_plan_id is not None and question_id is not None:
+            db.collection('teachers').document(teacher_id).collection('lesson_plans').document(lesson_plan_id).collection('questions').document(question_id).delete()
+            sync.record_tombstone(db, teacher_id, sync.KIND_LESSON_QUESTION, question_id, lesson_plan_id)
+            return "success"
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def reorderAnalysisCategories(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                teacher_ref = db.collection('teachers').document(teacher_id)
-                if request.data is None:
-                    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
-                lesson_id = request.data.get('lesson_id')
-                question_id = request.data.get('question_id')
-                response_id = request.data.get('response_id')
-                old_category = request.data.get('old_category')
-                new_category = request.data.get('new_category')
-                if lesson_id is not None and question_id is not None and response_id is not None and old_category is not None and new_category is not None:
-                    lesson_ref: DocumentReference = teacher_ref.collection('lessons').document(lesson_id)
-                    lesson = Lesson(**lesson_ref.get().to_dict())
-                    if lesson.analysis_by_question_id is not None:
-                        old_cat_responses: list[dict[str, Any]] = lesson.analysis_by_question_id.get(
-                            question_id).get('responses_by_category').get(old_category)
-
-                        resp_to_move: dict[str, Any] = None
-                        for response in old_cat_responses:
-                            if response.get('id') == response_id:
-                                resp_to_move = response
-                                break
-
-                        lesson.analysis_by_question_id[question_id]['responses_by_category'][old_category] = [
-                            r for r in old_cat_responses if r.get('id') != response_id
-                        ]
-                        lesson.analysis_by_question_id[question_id]['responses_by_category'][new_category].append(resp_to_move)
-
-                        lesson_ref.set(document_data=lesson.__dict__, merge=True)
-                        return "success"
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        teacher_ref = db.collection('teachers').document(teacher_id)
+        if request.data is None:
+            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+        lesson_id = request.data.get('lesson_id')
+        question_id = request.data.get('question_id')
+        response_id = request.data.get('response_id')
+        old_category = request.data.get('old_category')
+        new_category = request.data.get('new_category')
+        if lesson_id is not None and question_id is not None and response_id is not None and old_category is not None and new_category is not None:
+            lesson_ref: DocumentReference = teacher_ref.collection('lessons').document(lesson_id)
+            # Only the moved response's entries are written, see analysis_format.py
+            if move_response(db, lesson_ref, question_id, response_id, old_category, new_category):
+                return "success"
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
-# Lock answers and do analysis, return when done
+# Lock answers and do analysis, return when done (or, with `analyze_in_background`, return the AnalysisJob right away)
 @https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
 def putLesson(request: https_fn.CallableRequest):
-    if request.auth is not None:
-        user: auth.UserRecord = auth.get_user(request.auth.uid)
-        if user is not None and user.email is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', user.email)).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                teacher_id = teacher.id
-                teacher_ref = db.collection('teachers').document(teacher_id)
-                new_lesson = Lesson(**request.data)
-
-                # Don't save nested data!
-                new_lesson.responses = None
-                new_lesson.class_data = None
-                new_lesson.lesson_plan = None
-
-                lesson_id = new_lesson.id
-                if teacher_id is not None and new_lesson is not None:
-                    lesson_ref: DocumentReference = teacher_ref.collection('lessons').document(lesson_id)
-                    old_lesson_exists = lesson_ref.get().exists
-                    old_lesson = Lesson(**lesson_ref.get().to_dict()) if old_lesson_exists else None
-
-                    # Supporting soft-delete: if the lesson didn't exist before, set deleted to False
-                    # (Enforcing non-nullness on this field makes queries easier)
-                    if old_lesson is None:
-                        new_lesson.deleted = False
-
-                    # Save the lesson, now that we have the old data in memory
-                    lesson_ref.set(document_data=new_lesson.__dict__, merge=True)
-                    print("lesson saved")
-
-                    # If the lesson existed (this is an update, not a create), check if we're going from not locked to locked
-                    num_questions_locked_before = len(old_lesson.questions_locked) if old_lesson is not None and old_lesson.questions_locked is not None else 0
-                    num_questions_locked_after = len(new_lesson.questions_locked) if new_lesson.questions_locked is not None else 0
-                    if old_lesson is not None and num_questions_locked_after > num_questions_locked_before:
-                        responses: List[DocumentSnapshot] = list(lesson_ref.collection('responses').stream())
-
-                        # attempts_remaining = 15
-                        # # Analysis happens asynchronously when the student submits the response
-                        # # Poll until all responses are analyzed
-                        # while True:
-                        #     responses = list(lesson_ref.collection('responses').stream())
-                        #     responses = [LessonResponse(**response.to_dict()) for response in responses]
-                        #     if attempts_remaining == 0:
-                        #         break
-                        #     if all(
-                        #         response.analysis is not None
-                        #         for response in responses
-                        #     ):
-                        #         break
-                        #     else:
-                        #         attempts_remaining -= 1
-                        #         asyncio.sleep(2)
+    teacher = _getRequestTeacher(request)
+    if teacher is not None:
+        teacher_id = teacher.id
+        teacher_ref = db.collection('teachers').document(teacher_id)
+        # Opt in to getting an AnalysisJob back right away, instead of waiting for the analysis
+        analyze_in_background = request.data.pop('analyze_in_background', None) is True
+        patch_mode = is_patch(request.data)
+        lesson_id = request.data.get('id') if patch_mode else None
+        new_lesson = Lesson(**request.data) if not patch_mode else None
+
+        if not patch_mode:
+            new_lesson.updated_at = sync.server_now()
+            lesson_id = new_lesson.id
+        if teacher_id is not None and lesson_id is not None:
+            lesson_ref: DocumentReference = teacher_ref.collection('lessons').document(lesson_id)
+            if patch_mode:
+                # Only the patched fields are written, and only if the lesson hasn't changed since the client read it
+                old_lesson_dict, new_lesson_dict = _applyPatch(lesson_ref, Lesson, request.data)
+                old_lesson = Lesson(**old_lesson_dict)
+                new_lesson = Lesson(**new_lesson_dict)
+            else:
+                old_lesson_exists = lesson_ref.get().exists
+                old_lesson = Lesson(**lesson_ref.get().to_dict()) if old_lesson_exists else None
+
+                # Supporting soft-delete: if the lesson didn't exist before, set deleted to False
+                # (Enforcing non-nullness on this field makes queries easier)
+                if old_lesson is None:
+                    new_lesson.deleted = False
+
+                # Save the lesson, now that we have the old data in memory. Don't save nested data,
+                # or what the server keeps up to date itself (the analysis, who started).
+                lesson_ref.set(document_data=without_server_owned(Lesson, new_lesson.__dict__), merge=True)
+            print("lesson saved")
+
+            # If the lesson existed (this is an update, not a create), check if we're going from not locked to locked
+            num_questions_locked_before = len(old_lesson.questions_locked) if old_lesson is not None and old_lesson.questions_locked is not None else 0
+            num_questions_locked_after = len(new_lesson.questions_locked) if new_lesson.questions_locked is not None else 0
+            if old_lesson is not None and num_questions_locked_after > num_questions_locked_before:
+                responses: List[DocumentSnapshot] = list(lesson_ref.collection('responses').stream())
+
+                # attempts_remaining = 15
+                # # Analysis happens asynchronously when the student submits the response
+                # # Poll until all responses are analyzed
+                # while True:
+                #     responses = list(lesson_ref.collection('responses').stream())
+                #     responses = [LessonResponse(**response.to_dict()) for response in responses]
+                #     if attempts_remaining == 0:
+                #         break
+                #     if all(
+                #         response.analysis is not None
+                #         for response in responses
+                #     ):
+                #         break
+                #     else:
+                #         attempts_remaining -= 1
+                #         asyncio.sleep(2)
                         
-                        if len(responses) == 0:
-                            raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="no responses to analyze")
+                if len(responses) == 0:
+                    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="no responses to analyze")
                         
-                        # Then, analyze the lesson overall
-                        lesson = Lesson(**lesson_ref.get().to_dict())
-                        lesson_plan_ref: DocumentReference = teacher_ref.collection('lesson_plans').document(lesson.lesson_plan_id)
-                        questions_ref: CollectionReference = lesson_plan_ref.collection('questions')
-                        lesson_questions = list(questions_ref.stream())
-                        lesson_questions = [LessonQuestion(**lesson_questions[i].to_dict()) for i in range(len(lesson_questions))]
-                        analysis_by_question_id: dict[str, Dict[str, Any]] = {}
-                        preset_categories: list[str] = []
-                        for question in lesson_questions:
-                            if new_lesson.questions_locked is None or question.id not in new_lesson.questions_locked:
-                                continue
-
-                            responses_to_question = [response for response in responses if response.to_dict().get('question_id') == question.id]
-
-                            # If no responses, skip
-                            if len(responses_to_question) == 0:
-                                continue
-
-                            # If the analysis is already done, skip
-                            if lesson.analysis_by_question_id is not None and question.id in lesson.analysis_by_question_id and lesson.analysis_by_question_id[question.id] is not None:
-                                analysis_already_done: Dict[str, Any] = lesson.analysis_by_question_id[question.id]
-                                responses_by_cat: dict[str, Any] = analysis_already_done.get('responses_by_category')
-                                preset_categories = responses_by_cat.keys()
-                                continue
-
-                            llm_messages = []
-                            llm_messages.append({
-                                "role": "user",
-                                "content": dedent(f"""
-                                    You are an experienced high school teacher, and my assistant for this lesson.
-                                    You also have experience coding in JSON and are a stickler for formatting.
-                                    I asked my high school students the following question:
-                                    "{question.body_text}"
-                                """),
-                            })
-
-                            # Add context (supporting materials) if any
-                            ctx_materials_message_content = []
-                            for ctx_material_url in question.context_material_urls:
-                                file_name: str = ctx_material_url.split('/')[-1].split('?')[0]
-                                file_ext: str = file_name.split('.')[-1]
-                                file_ext_lower = file_ext.lower()
-                                if file_ext_lower in ['pdf']:
-                                    ctx_materials_message_content.append({
-                                        "type": "document",
-                                        "source": {
-                                            "type": "base64",
-                                            "media_type": "application/pdf",
-                                            "data": get_as_base64(ctx_material_url),
-                                        },
-                                    })
-                                elif file_ext_lower in ['png', 'jpg', 'jpeg']:
-                                    if file_ext_lower == 'jpg':
-                                        file_ext_lower = 'jpeg'
-                                    ctx_materials_message_content.append({
-                                        "type": "image",
-                                        "source": {
-                                            "type": "base64",
-                                            "media_type": f"image/{file_ext_lower}",
-                                            "data": get_as_base64(ctx_material_url),
-                                        },
-                                    })
-                            if len(ctx_materials_message_content) > 0:
-                                ctx_materials_message_content = [{
-                                    "type": "text",
-                                    "text": "The following supporting materials are relevant to the question:",
-                                }] + ctx_materials_message_content
-                                llm_messages.append({
-                                    "role": "user",
-                                    "content": ctx_materials_message_content,
-                                })
-
-                            # Add categorization_guidance if any
-                            if len(preset_categories) > 0:
-                                print("Got preset categories from the previous question:", preset_categories)
-                                llm_messages.append({
-                                    "role": "user",
-                                    "content": [{
-                                        "type": "text",
-                                        "text": "Please use all of the following categories in your analysis:\n\n"+
-                                            ", ".join(preset_categories)+"\n\n"+
-                                            "Consider ALL of these carefully when deciding how to categorize each student's response. It is encouraged to assign a multiple categories to a response if and only if the response fits the requirements of more than one category.",
-                                    }],
-                                })
-                            elif question.categorization_guidance is not None:
-                                preset_cats_str = question.categorization_guidance
-                                preset_cats_split_by_comma = preset_cats_str.split(",")
-                                preset_cats_split_by_newline = preset_cats_str.split("\n")
-                                preset_categories = preset_cats_split_by_comma if len(preset_cats_split_by_comma) > len(preset_cats_split_by_newline) else preset_cats_split_by_newline
-                                print("Got preset categories from the categorization guidance:", preset_categories)
-                                llm_messages.append({
-                                    "role": "user",
-                                    "content": [{
-                                        "type": "text",
-                                        "text": "Please use all of the following categories in your analysis:\n\n"+
-                                            f"{preset_cats_str}\n\n"+
-                                            "Consider ALL of these carefully when deciding how to categorize each student's response. It is encouraged to assign a multiple categories to a response if and only if the response fits the requirements of more than one category.",
-                                    }],
-                                })
-
-                            # Add the student responses
-                            lesson_responses_message_content = [{
-                                "type": "text",
-                                "text": "Now here are my students' responses:", # TODO: Add anti-prompt-injection language?
-                            }]
-                            for resp in responses_to_question:
-                                lesson_responses_message_content.append({
-                                    "type": "text",
-                                    "text": f"{resp.get('student_name')} answered: {resp.get('analysis.response_summary')}",
-                                })
-                            llm_messages.append({
-                                "role": "user",
-                                "content": lesson_responses_message_content
-                            })
-
-                            # Get the analysis
-                            llm_messages.append({
-                                "role": "user",
-                                "content": dedent(f"""
-                                    You are a teaching assistant who is experienced in high school level topics. As my assistant, you have one task that will help me administer this lesson: sort the students' responses into categories.
-                                    
-                                    The categories will be used to track how students' understanding of the concept evolves over time, sometimes moving from one category to another as their understanding deepens. Sometimes expanding the understanding from one category to two or more.
-                                    
-                                    Do your best to categorize in a way that will help the students draw connections between each other's explanations.
-                                    
-                                    Pay extra attention to any guidance I have already provided on which categories to use. I expect all of my category suggestions to be considered thoughtfully.
-                                    
-                                    Make sure every single student is included at least once, and remember that a response might belong to more than one category.
-                                    
-                                    Make sure each category is distinct.
-
-                                    Your response should be output in JSON format. Respond with the JSON object ONLY, and no other text.
-                                    
-                                    Use this object as a template, and simply populate each array with the students' names belonging in that category:
-                                    
-                                    {json.dumps({x.strip().capitalize(): [] for x in preset_categories} | {"No category": []}, indent=2)}
-                                """),
-                            })
-                            client = Anthropic(api_key=ANTHROPIC_API_KEY.value)
-
-                            attempts_remaining = 3
-                            while attempts_remaining > 0:
-                                attempts_remaining -= 1
-                                try:
-                                    message = client.messages.create(
-                                        model="claude-3-5-sonnet-20240620",
-                                        max_tokens=1024,
-                                        messages=llm_messages,
-                                    )
-                                    print("Claude responded with content:")
-                                    print(message.content)
-                                    message_text = message.content[0].text
-                                    if not message_text.startswith("{"):
-                                        message_text = message_text.split("{")[1].split("}")[0]
-                                    analyses_raw: dict[str, list[str]] = json.loads(message_text)
-
-                                    # Map the analysis to the LessonQuestionAnalysis object
-                                    responses_by_student_name: dict[str, LessonResponse] = {}
-                                    for resp in responses_to_question:
-                                        resp_dict = resp.to_dict()
-                                        resp_img_base64: str = resp_dict.get('response_image_base64')
-                                        resp_img_url: str = resp_dict.get('response_image_url')
-                                        if resp_img_base64 is not None and resp_img_base64 != "" and (
-                                            resp_img_url is None or resp_img_url == ""
-                                        ):
-                                            blb = bucket.blob(f"{resp_dict.get('teacher_email')}/student-responses/{resp.id}_drawing_{datetime.now().isoformat()}.png")
-                                            blb.upload_from_string(
-                                                data=base64.b64decode(
-                                                    resp_img_base64.replace("data:image/png;base64,", "")
-                                                ),
-                                                content_type="image/png",
-                                            )
-                                            blb.make_public()
-                                            resp_dict['response_image_url'] = blb.public_url
-                                        resp_dict['response_image_base64'] = None
-                                        responses_by_student_name[resp.get('student_name')] = LessonResponse(**resp_dict)
-                                    responses_by_category: dict[str, list[LessonResponse]] = {}
-                                    for cat, students in analyses_raw.items():
-                                        category = cat.strip().capitalize()
-                                        if category not in responses_by_category:
-                                            responses_by_category[category] = []
-                                        for student in students:
-                                            responses_by_category[category].append(
-                                                responses_by_student_name.get(student).__dict__
-                                            )
-                                    analysis = LessonQuestionAnalysis(
-                                        question_id=question.id,
-                                        responses_by_category=responses_by_category,
-                                    )
-                                    # Add it to analysis_by_question_id on the Lesson object
-                                    analysis_by_question_id[analysis.question_id] = analysis.__dict__
-                                    break
-                                except Exception as e:
-                                    print(e)
-                                    if attempts_remaining == 0:
-                                        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="analysis failed")
-                                    else:
-                                        print("retrying")
-
-                        # Back at the Lesson level -- save the new analysis_by_question_id
-                        lesson_ref.set(
-                            document_data={"analysis_by_question_id": analysis_by_question_id},
-                            merge=True,
-                        )
+                # Then, analyze the lesson overall
+                lesson = Lesson(**lesson_ref.get().to_dict())
+                lesson_plan_ref: DocumentReference = teacher_ref.collection('lesson_plans').document(lesson.lesson_plan_id)
+                questions_ref: CollectionReference = lesson_plan_ref.collection('questions')
+                lesson_questions = list(questions_ref.stream())
+                lesson_questions = [LessonQuestion(**lesson_questions[i].to_dict()) for i in range(len(lesson_questions))]
+                if analyze_in_background:
+                    return _startAnalysisJob(teacher.id, teacher.email_address, lesson_ref, plan_question_analyses(lesson, lesson_questions, responses, new_lesson.questions_locked))
+                # Categorization works from the response summaries, so finish any the background task hasn't
+                responses = _summarizeMissingResponses(responses, lesson_questions, new_lesson.questions_locked)
+                analysis_updates: Dict[str, Any] = {}
+                question_analysis_plans = plan_question_analyses(lesson, lesson_questions, responses, new_lesson.questions_locked)
+
+                # Each question only depends on its resolved categories, not on another question's
+                # analysis finishing, so run them concurrently (capped, to stay kind to the LLM API)
+                failed_question_ids: list[str] = []
+                with ThreadPoolExecutor(max_workers=ANALYSIS_MAX_CONCURRENCY.value) as executor:
+                    futures = {
+                        executor.submit(_analyzeLessonQuestion, plan): plan.question.id
+                        for plan in question_analysis_plans
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            analysis = future.result()
+                            # Replace just this question's entry in analysis_by_question_id on the Lesson
+                            analysis_updates[analysis_field_path(analysis.question_id)] = analysis.__dict__
+                        except Exception as e:
+                            print(f"analysis failed for question {futures[future]}: {e}")
+                            failed_question_ids.append(futures[future])
+
+                # Back at the Lesson level -- save the new analyses
+                if len(analysis_updates) > 0:
+                    lesson_ref.update(analysis_updates | {"updated_at": sync.server_now()})
+                # The questions that did finish are saved, so a retry only redoes the failed ones
+                if len(failed_question_ids) > 0:
+                    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="analysis failed")
+
+            # Whether this was an update or a create, return the new lesson
+            return Lesson(**lesson_ref.get().to_dict())
+    raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
+
+
+def _startAnalysisJob(teacher_id: str, teacher_email: str, lesson_ref: DocumentReference, plans: List[QuestionAnalysisPlan]) -> AnalysisJob:
+    job = analysis_jobs.create_job(db, teacher_id, teacher_email, lesson_ref.id, [plan.question.id for plan in plans])
+    lesson_ref.update({"analysis_job_id": job.id, "updated_at": sync.server_now()})
+    job_ref = analysis_jobs.job_ref(db, teacher_id, job.id)
+    queue = functions.task_queue("analyzeLessonQuestion", app=app)
+    any_failed = False
+    for plan in plans:
+        try:
+            queue.enqueue(
+                {
+                    "job_path": job_ref.path,
+                    "lesson_path": lesson_ref.path,
+                    "question_id": plan.question.id,
+                    "preset_categories": plan.preset_categories,
+                    "preset_categories_text": plan.preset_categories_text,
+                },
+                functions.TaskOptions(task_id=analysis_jobs.question_task_id(job.id, plan.question.id)),
+            )
+        except AlreadyExistsError:
+            pass
+        except Exception as e:
+            # Nothing will ever pick this question up, so don't leave it (and the job) queued
+            print(f"couldn't enqueue the analysis of question {plan.question.id}: {e}")
+            analysis_jobs.fail_question(db, job_ref, plan.question.id, f"couldn't start: {e}", will_retry=False)
+            any_failed = True
+    return AnalysisJob(**job_ref.get().to_dict()) if any_failed else job
+
+
+# One question of an analysis job. Each attempt is one categorization run; the task queue does the retrying.
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=analysis_jobs.MAX_ATTEMPTS, min_backoff_seconds=10),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=10),
+    timeout_sec=540,
+    memory=options.MemoryOption.GB_1,
+)
+def analyzeLessonQuestion(request: https_fn.CallableRequest):
+    job_ref = db.document(request.data.get('job_path'))
+    lesson_ref = db.document(request.data.get('lesson_path'))
+    question_id: str = request.data.get('question_id')
+    attempt = analysis_jobs.start_question(db, job_ref, question_id)
+    if attempt is None:
+        return
+    try:
+        lesson = Lesson(**lesson_ref.get().to_dict())
+        questions_coll = db.collection('teachers').document(lesson_ref.parent.parent.id).collection('lesson_plans').document(lesson.lesson_plan_id).collection('questions')
+        question = LessonQuestion(**questions_coll.document(question_id).get().to_dict())
+        responses: List[DocumentSnapshot] = list(lesson_ref.collection('responses').where(filter=FieldFilter('question_id', '==', question_id)).stream())
+        responses = _summarizeMissingResponses(responses, [question], [question_id])
+        analysis = _analyzeLessonQuestion(
+            QuestionAnalysisPlan(
+                question=question,
+                responses=responses,
+                preset_categories=request.data.get('preset_categories') or [],
+                preset_categories_text=request.data.get('preset_categories_text') or "",
+            ),
+        )
+        lesson_ref.update({analysis_field_path(question_id): analysis.__dict__, "updated_at": sync.server_now()})
+    except Exception as e:
+        will_retry = attempt < analysis_jobs.MAX_ATTEMPTS
+        analysis_jobs.fail_question(db, job_ref, question_id, str(e), will_retry)
+        if will_retry:
+            raise
+        return
+    analysis_jobs.finish_question(db, job_ref, question_id, analysis.__dict__)
 
-                    # Whether this was an update or a create, return the new lesson
-                    return Lesson(**lesson_ref.get().to_dict())
+
+@https_fn.on_call(cors=options.CorsOptions(cors_origins=["*"]))
+def getAnalysisJob(request: https_fn.CallableRequest):
+    teacher = _getRequestTeacher(request)
+    job_id = (request.data or {}).get('id')
+    if teacher is not None and job_id is not None:
+        job_doc = analysis_jobs.job_ref(db, teacher.id, job_id).get()
+        if job_doc.exists:
+            return AnalysisJob(**job_doc.to_dict())
+        raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.NOT_FOUND, message="not found")
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
+# Server-sent events: the job each time it changes, until it finishes (or the connection
+# has been open for a while, after which the client reconnects). The ID token goes in the
+# Authorization header, never in the URL, which request logs record; since EventSource
+# can't send headers, clients read the stream with fetch.
+@https_fn.on_request(
+    cors=options.CorsOptions(cors_origins=["*"], cors_methods=["GET"]),
+    timeout_sec=540,
+)
+def streamAnalysisJob(request: https_fn.Request):
+    id_token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    job_id = request.args.get('id')
+    try:
+        decoded_token = auth.verify_id_token(id_token)
+    except Exception:
+        return https_fn.Response(status=401, response="login required")
+    teacher = resolve_teacher(db, decoded_token.get('uid'), decoded_token)
+    if teacher is None or job_id is None:
+        return https_fn.Response(status=400, response="invalid request")
+    job_ref = analysis_jobs.job_ref(db, teacher.id, job_id)
+
+    def events():
+        for job in analysis_jobs.watch_job(job_ref, timeout_sec=ANALYSIS_JOB_STREAM_SEC):
+            if job is None:
+                # Keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: job\ndata: {json.dumps(job)}\n\n"
+
+    return https_fn.Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def _summarizeMissingResponses(
+    responses: List[DocumentSnapshot],
+    lesson_questions: List[LessonQuestion],
+    questions_locked: List[str],
+) -> List[DocumentSnapshot]:
+    questions_by_id = {question.id: question for question in lesson_questions}
+    missing = [
+        response for response in responses
+        if response.to_dict().get('analysis') is None
+        and response.to_dict().get('question_id') in (questions_locked or [])
+        and response.to_dict().get('question_id') in questions_by_id
+    ]
+    if len(missing) == 0:
+        return responses
+
+    def summarize(response_doc: DocumentSnapshot):
+        response = LessonResponse(**response_doc.to_dict())
+        summary = response_summaries.summarize_response(db, llm_gateway, get_as_base64, questions_by_id[response.question_id], response)
+        response_summaries.save_summary(response_doc.reference, summary, response_summaries.response_input_hash(response))
+
+    print(f"summarizing {len(missing)} responses that weren't summarized in the background")
+    failed_ids = set()
+    with ThreadPoolExecutor(max_workers=ANALYSIS_MAX_CONCURRENCY.value) as executor:
+        futures = {executor.submit(summarize, response): response for response in missing}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # One bad response shouldn't fail the lesson; its question is analyzed without it
+                print(f"couldn't summarize response {futures[future].id}: {e}")
+                failed_ids.add(futures[future].id)
+    return [
+        response for response in db.get_all([response.reference for response in responses])
+        if response.id not in failed_ids
+    ]
+
+
+def _analyzeLessonQuestion(plan: QuestionAnalysisPlan) -> LessonQuestionAnalysis:
+    question = plan.question
+    responses_to_question = plan.responses
+    tiers = stage_tiers(db, STAGE_CATEGORIZATION)
+
+    # Map the analysis to the LessonQuestionAnalysis object. Drawings are normally in Cloud
+    # Storage already; any response saved before that gets its drawing moved there now, once.
+    responses: List[Dict[str, Any]] = []
+    for resp in responses_to_question:
+        moved_fields = move_response_drawing(bucket, resp.to_dict())
+        if moved_fields is not None:
+            resp.reference.update(moved_fields)
+        responses.append(resp.to_dict() | {"id": resp.id})
+
+    # Near-duplicate text answers are categorized once, through one representative each
+    members_by_representative_id = cluster_responses(responses)
+    representatives = [resp for resp in responses if resp['id'] in members_by_representative_id]
+    if len(representatives) < len(responses):
+        print(f"question {question.id}: {len(responses)} responses collapsed to {len(representatives)} for categorization")
+
+    # No retrying here: the gateway retries and falls back on transient errors, and each
+    # chunk re-asks about just the responses its answer left out (see categorization.py)
+    response_ids_by_category = categorize_responses(
+        llm_gateway,
+        tiers,
+        question,
+        representatives,
+        plan.preset_categories,
+        plan.preset_categories_text,
+        materials_cache.get_base64,
+    )
+    response_ids_by_category = expand_categories(response_ids_by_category, members_by_representative_id)
+    print(f"categorized question {question.id}: {json.dumps(response_ids_by_category)}")
+    return compact_analysis(question.id, response_ids_by_category)
+
+
+######### Read model maintenance
+
+# Each trigger applies one write to the teacher's read model, whichever code path made it
+
+
+def _afterDict(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]) -> Dict[str, Any]:
+    after = event.data.after
+    return after.to_dict() if after is not None and after.exists else None
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/classes/{classId}")
+def onClassWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    read_model.put_class(db, event.params['teacherId'], event.params['classId'], _afterDict(event))
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/classes/{classId}/students/{studentId}")
+def onStudentWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    read_model.put_student(db, event.params['teacherId'], event.params['classId'], event.params['studentId'], _afterDict(event))
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/lesson_plans/{lessonPlanId}")
+def onLessonPlanWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    read_model.put_lesson_plan(db, event.params['teacherId'], event.params['lessonPlanId'], _afterDict(event))
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/lesson_plans/{lessonPlanId}/questions/{questionId}")
+def onLessonQuestionWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    read_model.put_question(db, event.params['teacherId'], event.params['lessonPlanId'], event.params['questionId'], _afterDict(event))
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/lessons/{lessonId}")
+def onLessonWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    before = event.data.before.to_dict() if event.data.before is not None and event.data.before.exists else None
+    after = _afterDict(event)
+    # Most lesson writes are analysis; skip the ones the dashboard can't see
+    if before is not None and after is not None and not read_model.lesson_summary_changed(before, after):
+        return
+    read_model.put_lesson(db, event.params['teacherId'], event.params['lessonId'], after)
+
+
+@firestore_fn.on_document_written(document="teachers/{teacherId}/lessons/{lessonId}/responses/{responseId}")
+def onLessonResponseWritten(event: firestore_fn.Event[firestore_fn.Change[DocumentSnapshot]]):
+    before = event.data.before.to_dict() if event.data.before is not None and event.data.before.exists else None
+    after = _afterDict(event)
+    # Only the counts are in the read model, so summary progress and the like don't matter
+    if before is not None and after is not None and all(before.get(field) == after.get(field) for field in RESPONSE_SUMMARY_FIELDS):
+        return
+    _scheduleResponsesRefresh(event.params['teacherId'], event.params['lessonId'])
+
+
+def _scheduleResponsesRefresh(teacher_id: str, lesson_id: str):
+    task_id, delay_sec = read_model.responses_refresh_schedule(teacher_id, lesson_id, time.time())
+    try:
+        functions.task_queue("refreshLessonResponses", app=app).enqueue(
+            {"teacher_id": teacher_id, "lesson_id": lesson_id},
+            functions.TaskOptions(task_id=task_id, schedule_delay_seconds=delay_sec),
+        )
+    except AlreadyExistsError:
+        # Another write in this window already scheduled the recount
+        pass
+    except Exception as e:
+        print(f"couldn't schedule the response counts of lesson {lesson_id}, counting now: {e}")
+        read_model.refresh_lesson_responses(db, teacher_id, lesson_id)
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=3, min_backoff_seconds=10),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=20),
+)
+def refreshLessonResponses(request: https_fn.CallableRequest):
+    read_model.refresh_lesson_responses(db, request.data.get('teacher_id'), request.data.get('lesson_id'))
+
+
 ##########################################################
 # PUBLIC API
 
@@ -831,12 +1291,10 @@ def getLesson(request: https_fn.Request):
     if request.method == 'POST':
         data: Dict[str, str] = request.get_json().get('data')
         if data.get('teacher_email') is not None:
-            teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', data.get('teacher_email'))).stream())
-            if len(teacherMatches) == 1:
-                teacher = TeacherData(**teacherMatches[0].to_dict())
-                lessons = _getLessons(teacher, True, data.get('id'))
-                for lesson in lessons:
-                    lesson.lesson_plan = _getLessonPlans(teacher, True, lesson.lesson_plan_id)[0]
+            teacher = resolve_teacher_by_email(db, data.get('teacher_email'))
+            if teacher is not None:
+                # The lesson's class, students, plan and questions are all read concurrently
+                lessons = run_async(app, _getLessons(teacher, True, data.get('id'), include_lesson_plan=True))
                 return https_fn.Response(
                     response=json.dumps({
                         "result": dataclasses.asdict(lessons[0]),
@@ -851,9 +1309,8 @@ def putLessonResponse(request: https_fn.Request):
     teacher_email = lesson_resp_data.teacher_email
     lesson_id = lesson_resp_data.lesson_id
     question_id = lesson_resp_data.question_id
-    teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', teacher_email)).stream())
-    if len(teacherMatches) == 1 and lesson_id is not None and question_id is not None:
-        teacher = TeacherData(**teacherMatches[0].to_dict())
+    teacher = resolve_teacher_by_email(db, teacher_email)
+    if teacher is not None and lesson_id is not None and question_id is not None:
 
         # Look up the lesson
         teacher_ref = db.collection('teachers').document(teacher.id)
@@ -871,17 +1328,30 @@ def putLessonResponse(request: https_fn.Request):
             if lesson.questions_locked is not None and question_data.id in lesson.questions_locked:
                 raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="responses locked")
 
-            # Save the response data
+            # Save the response data, marking it for summarization (the summary state is the server's, not the client's)
             responses_coll: CollectionReference = lessons_coll.document(lesson_id).collection('responses')
-            print(f"saving lesson response: {lesson_resp_data.__dict__}")
-            responses_coll.document(lesson_resp_data.id).set(document_data=lesson_resp_data.__dict__, merge=True)
+            response_ref = responses_coll.document(lesson_resp_data.id)
+            # Only the drawing's URL goes in the response; the drawing itself goes to Cloud Storage
+            moved_fields = move_response_drawing(bucket, lesson_resp_data.__dict__)
+            if moved_fields is not None:
+                lesson_resp_data.__dict__.update(moved_fields)
+            input_hash = response_summaries.response_input_hash(lesson_resp_data)
+            stored: Dict[str, Any] = response_ref.get().to_dict() or {}
+            # A re-sent submission whose summary is already done keeps it
+            already_summarized = stored.get('analysis_input_hash') == input_hash and stored.get('analysis_status') == response_summaries.STATUS_DONE
+            for field in ['analysis', 'analysis_status', 'analysis_attempts', 'analysis_error']:
+                setattr(lesson_resp_data, field, stored.get(field) if already_summarized else None)
+            if not already_summarized:
+                lesson_resp_data.analysis_status = response_summaries.STATUS_PENDING
+                lesson_resp_data.analysis_attempts = 0
+            lesson_resp_data.analysis_input_hash = input_hash
+            lesson_resp_data.updated_at = sync.server_now()
+            print(f"saving lesson response {lesson_resp_data.id} to question {question_id}")
+            response_ref.set(document_data=lesson_resp_data.__dict__, merge=True)
 
             # In the background, use the LLM to summarize each response for easier use later
-            analyze_lesson_response(
-                question_data,
-                responses_coll.document(lesson_resp_data.id),
-                lesson_resp_data,
-            )
+            if not already_summarized:
+                _enqueueResponseSummary(response_ref, input_hash, lesson_resp_data.updated_at)
 
             return https_fn.Response(
                 response=json.dumps({
@@ -897,17 +1367,10 @@ def postStudentNameStarted(request: https_fn.Request):
     student_name = req_data.get('student_name')
     teacher_email = req_data.get('teacher_email')
     lesson_id = req_data.get('lesson_id')
-    teacherMatches = list(db.collection('teachers').where(filter=FieldFilter('email_address', '==', teacher_email)).stream())
-    if len(teacherMatches) == 1 and lesson_id is not None:
-        teacher = TeacherData(**teacherMatches[0].to_dict())
-        teacher_ref = db.collection('teachers').document(teacher.id)
-        lessons_coll: CollectionReference = teacher_ref.collection('lessons')
-        lesson_doc_ref: DocumentReference = lessons_coll.document(lesson_id)
-        lesson = Lesson(**lesson_doc_ref.get().to_dict())
-        if lesson.student_names_started is None:
-            lesson.student_names_started = []
-        lesson.student_names_started.append(student_name)
-        lesson_doc_ref.set(document_data=lesson.__dict__, merge=True)
+    teacher = resolve_teacher_by_email(db, teacher_email)
+    if teacher is not None and lesson_id is not None and isinstance(student_name, str) and student_name != "":
+        # One doc per student rather than a read-modify-write of the lesson, see presence.py
+        record_student_started(db, teacher.id, teacher.email_address, lesson_id, student_name)
         return https_fn.Response(
             response=json.dumps({
                 "result": "success",
@@ -916,63 +1379,33 @@ def postStudentNameStarted(request: https_fn.Request):
     raise https_fn.HttpsError(code=https_fn.FunctionsErrorCode.FAILED_PRECONDITION, message="invalid request")
 
 
-def analyze_lesson_response(
-    question_data: LessonQuestion,
-    lesson_response_doc_ref: DocumentReference,
-    lesson_resp_data: LessonResponse,
-):
-    # Use the student's raw response text as the summary by default
-    summary = lesson_resp_data.response_text
-
-    # If the student responded with a drawing, use Claude to summarize it, and append it to the summary
-    if lesson_resp_data.response_has_drawing and len(lesson_resp_data.response_image_url) > 0:
-        llm_messages = []
-        message_content = [
-            {
-                "type": "text",
-                "text": f"I asked my high school class the following question: {question_data.body_text}",
-            },
-            {
-                "type": "text",
-                "text": f"{lesson_resp_data.student_name} answered:",
-            },
-        ]
-        message_content.append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/png",
-                "data": get_as_base64(lesson_resp_data.response_image_url).replace("data:image/png;base64,", ""),
-            },
-        })
-        message_content.append({
-            "type": "text",
-            "text": dedent(f"""
-                Your response should be a summary of this drawing that carefully considers how {lesson_resp_data.student_name}'s drawing is attempting to answer the question I asked the class.
-                If you see any text in it, include the exact text in your summary.
-                Give the student the benefit of the doubt, but don't be afraid to analyze with a critical eye.
-                Your summary should be as brief as possible while being comprehensive.
-            """),
-        })
-        llm_messages.append({
-            "role": "user",
-            "content": message_content,
-        })
-        client = Anthropic(api_key=ANTHROPIC_API_KEY.value)
-        print("Calling Anthropic API -- messages.create()")
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1024,
-            messages=llm_messages,
+def _enqueueResponseSummary(response_ref: DocumentReference, input_hash: str, submitted_at: str):
+    # The submission is already saved, so a failure here mustn't fail it; putLesson
+    # summarizes anything still pending when the question is locked
+    try:
+        functions.task_queue("summarizeLessonResponse", app=app).enqueue(
+            {"response_path": response_ref.path, "input_hash": input_hash},
+            functions.TaskOptions(task_id=response_summaries.summary_task_id(response_ref, input_hash, submitted_at)),
         )
-        print("Claude responded with content:")
-        print(message.content)
-        # Append it to the summary
-        summary = summary + "\n\n" if len(summary) > 0 else ""
-        summary = summary + message.content[0].text
-
-    # Save the summary
-    lesson_response_doc_ref.set(document_data={"analysis": {"response_summary": summary}}, merge=True)
+    except AlreadyExistsError:
+        pass
+    except Exception as e:
+        print(f"couldn't enqueue the summary of {response_ref.path}: {e}")
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=response_summaries.MAX_ATTEMPTS, min_backoff_seconds=10),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=20),
+    timeout_sec=300,
+)
+def summarizeLessonResponse(request: https_fn.CallableRequest):
+    response_summaries.run_summary_task(
+        db,
+        llm_gateway,
+        get_as_base64,
+        request.data.get('response_path'),
+        request.data.get('input_hash'),
+    )
 
 
 def get_as_base64(url):
@@ -0,0 +1,218 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+import requests
+
+
+@dataclass
+class MaterialVersion:
+    url: str
+    content_hash: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # time.time() of the last successful fetch or revalidation
+    checked_at: float = 0
+
+
+class MaterialsCache:
+    """
+    Caches question context materials (PDFs, images) as the base64 the LLM API wants.
+
+    Each URL maps to the sha256 of its content, and the encoded data is stored once per
+    content hash: in an in-memory LRU bounded by `max_memory_bytes`, backed by files under
+    `disk_dir` that survive for the life of the instance. On Cloud Functions /tmp is held in
+    memory too, so the files are an LRU of their own, bounded by `max_disk_bytes`. A URL
+    that was checked within `fresh_for_sec` is served without any request; after that it's
+    revalidated with If-None-Match / If-Modified-Since, so unchanged materials are never
+    downloaded twice.
+    """
+
+    def __init__(
+        self,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+        disk_dir: str = '/tmp/seek-materials',
+        fresh_for_sec: float = 300,
+        request_timeout_sec: float = 30,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = disk_dir
+        self.fresh_for_sec = fresh_for_sec
+        self.request_timeout_sec = request_timeout_sec
+        self._data_by_hash: OrderedDict[str, str] = OrderedDict()
+        self._memory_bytes = 0
+        # Size of each data file, least recently used first; None until the directory is scanned
+        self._disk_bytes_by_hash: Optional[OrderedDict[str, int]] = None
+        self._disk_bytes = 0
+        self._versions_by_url: Dict[str, MaterialVersion] = {}
+        self._lock = threading.Lock()
+        # One lock per URL, so concurrent questions sharing a material fetch it once
+        self._url_locks: Dict[str, threading.Lock] = {}
+
+    def get_base64(self, url: str) -> str:
+        with self._url_lock(url):
+            version = self._get_version(url)
+            data = self._get_data(version.content_hash) if version is not None else None
+            if version is not None and data is not None:
+                if time.time() - version.checked_at < self.fresh_for_sec:
+                    return data
+                revalidated = self._revalidate(version, data)
+                if revalidated is not None:
+                    return revalidated
+            return self._fetch(url)
+
+    def _revalidate(self, version: MaterialVersion, data: str) -> Optional[str]:
+        """The current data (`data` itself if unchanged), or None if the URL has to be fetched again."""
+        headers = {}
+        if version.etag is not None:
+            headers['If-None-Match'] = version.etag
+        if version.last_modified is not None:
+            headers['If-Modified-Since'] = version.last_modified
+        if len(headers) == 0:
+            return None
+        response = requests.get(version.url, headers=headers, timeout=self.request_timeout_sec)
+        if response.status_code != 304:
+            # Changed (or the server ignored the condition); use the body we just got
+            if response.ok:
+                return self._store(version.url, response)
+            response.raise_for_status()
+        version.checked_at = time.time()
+        self._put_version(version)
+        return data
+
+    def _fetch(self, url: str) -> str:
+        response = requests.get(url, timeout=self.request_timeout_sec)
+        response.raise_for_status()
+        return self._store(url, response)
+
+    def _store(self, url: str, response: requests.Response) -> str:
+        content = response.content
+        content_hash = hashlib.sha256(content).hexdigest()
+        data = self._get_data(content_hash)
+        if data is None:
+            data = base64.b64encode(content).decode('utf-8')
+            self._put_data(content_hash, data)
+        self._put_version(MaterialVersion(
+            url=url,
+            content_hash=content_hash,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            checked_at=time.time(),
+        ))
+        return data
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _get_version(self, url: str) -> Optional[MaterialVersion]:
+        with self._lock:
+            version = self._versions_by_url.get(url)
+        if version is None:
+            try:
+                with open(self._version_path(url)) as f:
+                    version = MaterialVersion(**json.load(f))
+            except (OSError, ValueError, TypeError):
+                return None
+            with self._lock:
+                self._versions_by_url[url] = version
+        return version
+
+    def _put_version(self, version: MaterialVersion):
+        with self._lock:
+            self._versions_by_url[version.url] = version
+        self._write_file(self._version_path(version.url), json.dumps(asdict(version)))
+
+    def _get_data(self, content_hash: str) -> Optional[str]:
+        with self._lock:
+            data = self._data_by_hash.get(content_hash)
+            if data is not None:
+                self._data_by_hash.move_to_end(content_hash)
+                return data
+        try:
+            with open(self._data_path(content_hash)) as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            disk_bytes_by_hash = self._scan_disk()
+            if content_hash in disk_bytes_by_hash:
+                disk_bytes_by_hash.move_to_end(content_hash)
+        self._remember(content_hash, data)
+        return data
+
+    def _put_data(self, content_hash: str, data: str):
+        self._remember(content_hash, data)
+        if len(data) > self.max_disk_bytes:
+            return
+        if self._write_file(self._data_path(content_hash), data):
+            self._track_disk(content_hash, len(data))
+
+    def _track_disk(self, content_hash: str, size: int):
+        evicted_hashes = []
+        with self._lock:
+            disk_bytes_by_hash = self._scan_disk()
+            self._disk_bytes -= disk_bytes_by_hash.pop(content_hash, 0)
+            disk_bytes_by_hash[content_hash] = size
+            self._disk_bytes += size
+            while self._disk_bytes > self.max_disk_bytes and len(disk_bytes_by_hash) > 1:
+                evicted_hash, evicted_size = disk_bytes_by_hash.popitem(last=False)
+                self._disk_bytes -= evicted_size
+                evicted_hashes.append(evicted_hash)
+        for evicted_hash in evicted_hashes:
+            try:
+                os.remove(self._data_path(evicted_hash))
+            except OSError:
+                pass
+
+    def _scan_disk(self) -> OrderedDict[str, int]:
+        # Files left by earlier cache objects on this instance count against the budget too,
+        # oldest first. Called with the lock held.
+        if self._disk_bytes_by_hash is None:
+            self._disk_bytes_by_hash = OrderedDict()
+            data_dir = os.path.dirname(self._data_path(''))
+            try:
+                entries = [entry for entry in os.scandir(data_dir) if entry.name.endswith('.b64')]
+            except OSError:
+                entries = []
+            for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+                size = entry.stat().st_size
+                self._disk_bytes_by_hash[entry.name[:-len('.b64')]] = size
+                self._disk_bytes += size
+        return self._disk_bytes_by_hash
+
+    def _remember(self, content_hash: str, data: str):
+        with self._lock:
+            if content_hash in self._data_by_hash or len(data) > self.max_memory_bytes:
+                return
+            self._data_by_hash[content_hash] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._data_by_hash.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _write_file(self, path: str, contents: str) -> bool:
+        # Best effort: a full or read-only disk just means a colder cache
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(contents)
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            print(f"materials cache: couldn't write {path}: {e}")
+            return False
+
+    def _version_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, 'urls', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _data_path(self, content_hash: str) -> str:
+        return os.path.join(self.disk_dir, 'data', content_hash + '.b64')
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from google.cloud.firestore_v1 import Client
+from admin_config import get_admin_config
+
+# Which models each LLM stage uses. A stage has an ordered list of tiers: the first is
+# used normally, and the gateway falls back to the next one when a tier is overloaded,
+# rate limited or too slow (see `LLMGateway.create_message_with_fallback`). Configured in
+# admin_configs/current as `model_tiers`, for example
+#
+#   {"response_summary": [{"model": "claude-3-haiku-20240307", "max_tokens": 512, "timeout_sec": 20}, ...],
+#    "categorization": [{"model": "claude-3-5-sonnet-20240620", "max_tokens": 1024}, ...]}
+#
+# A stage that isn't configured (or is configured wrong) uses its defaults below.
+
+# Summarizing one student's drawing: the highest-volume call, and on the submit path, so fast first
+STAGE_RESPONSE_SUMMARY = 'response_summary'
+# Categorizing every response to a question: one call per question, where quality matters most
+STAGE_CATEGORIZATION = 'categorization'
+
+DEFAULT_MAX_TOKENS = 1024
+DEFAULT_TIMEOUT_SEC = 120
+
+
+@dataclass
+class ModelTier:
+    model: str
+    max_tokens: int = DEFAULT_MAX_TOKENS
+    # How long to wait for this tier before falling back to the next
+    timeout_sec: float = DEFAULT_TIMEOUT_SEC
+
+    def params(self) -> Dict[str, Any]:
+        """What this tier overrides in `messages.create` params."""
+        return {"model": self.model, "max_tokens": self.max_tokens, "timeout": self.timeout_sec}
+
+
+DEFAULT_TIERS: Dict[str, List[ModelTier]] = {
+    STAGE_RESPONSE_SUMMARY: [
+        ModelTier(model="claude-3-haiku-20240307", max_tokens=512, timeout_sec=30),
+        ModelTier(model="claude-3-5-sonnet-20240620", max_tokens=1024, timeout_sec=90),
+    ],
+    STAGE_CATEGORIZATION: [
+        ModelTier(model="claude-3-5-sonnet-20240620", max_tokens=1024, timeout_sec=120),
+        ModelTier(model="claude-3-haiku-20240307", max_tokens=1024, timeout_sec=60),
+    ],
+}
+
+
+def stage_tiers(db: Client, stage: str) -> List[ModelTier]:
+    configured = _parse_tiers((get_admin_config(db).get('model_tiers') or {}).get(stage))
+    return configured if configured is not None else DEFAULT_TIERS[stage]
+
+
+def _parse_tiers(tiers_config: Any) -> Optional[List[ModelTier]]:
+    if not isinstance(tiers_config, list) or len(tiers_config) == 0:
+        return None
+    tiers: List[ModelTier] = []
+    try:
+        for tier_config in tiers_config:
+            if not isinstance(tier_config.get('model'), str):
+                raise ValueError("no model")
+            tiers.append(ModelTier(
+                model=tier_config['model'],
+                max_tokens=int(tier_config.get('max_tokens') or DEFAULT_MAX_TOKENS),
+                timeout_sec=float(tier_config.get('timeout_sec') or DEFAULT_TIMEOUT_SEC),
+            ))
+    except (AttributeError, TypeError, ValueError):
+        print(f"ignoring invalid model tiers config: {tiers_config}")
+        return None
+    return tiers
@@ -0,0 +1,53 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud.firestore_v1 import AsyncCollectionReference, AsyncQuery, DocumentSnapshot
+from async_firestore import stream_docs
+
+# Cursor pagination for the teacher read endpoints. The caller's query does the ordering;
+# a page token is the id of the last doc on the previous page, which is looked up (only
+# the ordered fields) to resume right after it.
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+class InvalidPageError(ValueError):
+    pass
+
+
+@dataclass
+class PageRequest:
+    page_size: int
+    start_after: Optional[str] = None
+
+
+def get_page_request(data: Optional[Dict[str, Any]]) -> Optional[PageRequest]:
+    """The page asked for, or None if the caller wants everything (the pre-pagination behavior)."""
+    data = data or {}
+    if data.get('page_size') is None and data.get('start_after') is None:
+        return None
+    page_size = data.get('page_size') or DEFAULT_PAGE_SIZE
+    start_after = data.get('start_after')
+    if not isinstance(page_size, int) or page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise InvalidPageError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+    if start_after is not None and (not isinstance(start_after, str) or '/' in start_after or start_after == ''):
+        raise InvalidPageError("invalid start_after")
+    return PageRequest(page_size=page_size, start_after=start_after)
+
+
+async def fetch_page(
+    query: AsyncQuery,
+    coll: AsyncCollectionReference,
+    order_fields: List[str],
+    page: PageRequest,
+) -> Tuple[List[DocumentSnapshot], Optional[str]]:
+    """One page of `query` (which must be ordered by `order_fields`, and over `coll`), and the token for the next one."""
+    if page.start_after is not None:
+        cursor = await coll.document(page.start_after).get(field_paths=order_fields)
+        if not cursor.exists:
+            raise InvalidPageError("invalid start_after")
+        query = query.start_after(cursor)
+    # One extra doc says whether there's another page, without an extra round trip
+    docs = await stream_docs(query.limit(page.page_size + 1))
+    next_page_token = docs[page.page_size - 1].id if len(docs) > page.page_size else None
+    return docs[:page.page_size], next_page_token
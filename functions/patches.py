@@ -0,0 +1,87 @@
+import dataclasses
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud.firestore_v1 import Client, DocumentReference, transactional
+from google.cloud.firestore_v1.field_path import FieldPath
+from data_model import Class, Lesson, LessonPlan, LessonQuestion, Student
+from sync import server_now
+
+# Patch mode for the put* endpoints. Instead of the whole object, the client sends the ids
+# that locate the doc, the changed fields under `patch`, and optionally the `updated_at` it
+# last saw as `expected_updated_at`. Only those fields are written (each one replaced
+# outright), and if the doc has changed since the client read it, nothing is written and
+# the client gets a conflict, so two tabs editing different fields no longer undo each other.
+#
+#   {"id": ..., "lesson_plan_id": ..., "patch": {"body_text": ...}, "expected_updated_at": ...}
+#
+# The ids, the fields the server owns, and anything nested are never patchable.
+
+PATCH_KEY = 'patch'
+EXPECTED_UPDATED_AT_KEY = 'expected_updated_at'
+
+_NEVER_PATCHABLE = ['id', 'teacher_email', 'created_at', 'updated_at']
+
+# The ids of the parent doc, which are part of the doc's path
+_PATH_FIELDS: Dict[type, List[str]] = {
+    Student: ['class_id'],
+    LessonQuestion: ['lesson_plan_id'],
+}
+
+# Also never written from a client's full object (the pre-patch way of saving)
+SERVER_OWNED_FIELDS: Dict[type, List[str]] = {
+    Class: ['students'],
+    LessonPlan: ['questions'],
+    Lesson: ['student_names_started', 'class_data', 'lesson_plan', 'responses', 'responses_summary', 'analysis_by_question_id', 'analysis_job_id'],
+}
+
+
+class InvalidPatchError(ValueError):
+    pass
+
+
+class PatchNotFoundError(LookupError):
+    pass
+
+
+class PatchConflictError(Exception):
+    pass
+
+
+def is_patch(data: Optional[Dict[str, Any]]) -> bool:
+    return data is not None and data.get(PATCH_KEY) is not None
+
+
+def patchable_fields(model: type) -> List[str]:
+    never = _NEVER_PATCHABLE + _PATH_FIELDS.get(model, []) + SERVER_OWNED_FIELDS.get(model, [])
+    return [field.name for field in dataclasses.fields(model) if field.name not in never]
+
+
+def without_server_owned(model: type, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in data.items() if key not in SERVER_OWNED_FIELDS.get(model, [])}
+
+
+def apply_patch(db: Client, ref: DocumentReference, model: type, data: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Apply the request's patch to an existing doc. Returns the doc before and after."""
+    patch = data.get(PATCH_KEY)
+    if not isinstance(patch, dict) or len(patch) == 0:
+        raise InvalidPatchError("patch must be a non-empty object")
+    allowed = patchable_fields(model)
+    not_allowed = [field for field in patch if field not in allowed]
+    if len(not_allowed) > 0:
+        raise InvalidPatchError(f"can't patch {', '.join(sorted(not_allowed))}")
+    expected_updated_at = data.get(EXPECTED_UPDATED_AT_KEY)
+    if expected_updated_at is not None and not isinstance(expected_updated_at, str):
+        raise InvalidPatchError(f"invalid {EXPECTED_UPDATED_AT_KEY}")
+    return _apply_patch(db.transaction(), ref, patch, expected_updated_at)
+
+
+@transactional
+def _apply_patch(transaction, ref: DocumentReference, patch: Dict[str, Any], expected_updated_at: Optional[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    doc = ref.get(transaction=transaction)
+    if not doc.exists:
+        raise PatchNotFoundError(ref.id)
+    before = doc.to_dict()
+    if expected_updated_at is not None and before.get('updated_at') != expected_updated_at:
+        raise PatchConflictError(f"{ref.id} has changed since {expected_updated_at}")
+    updated_at = server_now()
+    transaction.update(ref, {FieldPath(field).to_api_repr(): value for field, value in patch.items()} | {"updated_at": updated_at})
+    return before, before | patch | {"updated_at": updated_at}
@@ -0,0 +1,49 @@
+import hashlib
+from typing import Any, Dict, List, Optional
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1 import Client, DocumentSnapshot
+from sync import server_now
+
+# Which students have opened a lesson. Each student gets their own doc under
+# lessons/{id}/presence, so a whole class joining at once writes to as many docs as there
+# are students instead of all rewriting the lesson doc. The doc is keyed by the student's
+# name and only created if it isn't there yet, so joining twice, or a retried request,
+# changes nothing. Readers merge the entries into the lesson's `student_names_started`, after the names
+# stored on the lesson itself before this existed.
+
+PRESENCE_COLLECTION = 'presence'
+
+
+def record_student_started(db: Client, teacher_id: str, teacher_email: str, lesson_id: str, student_name: str):
+    presence_ref = db.collection('teachers').document(teacher_id).collection('lessons').document(lesson_id).collection(PRESENCE_COLLECTION).document(presence_id(student_name))
+    now = server_now()
+    try:
+        # The first join wins, so the student keeps their place in the list
+        presence_ref.create({
+            "lesson_id": lesson_id,
+            "student_name": student_name,
+            "teacher_email": teacher_email,
+            "started_at": now,
+            "updated_at": now,
+        })
+    except AlreadyExists:
+        pass
+
+
+def presence_id(student_name: str) -> str:
+    # Names can hold characters that aren't allowed in doc ids
+    return hashlib.sha1(student_name.encode('utf-8')).hexdigest()
+
+
+def merge_student_names(student_names_started: Optional[List[str]], presence_docs: List[DocumentSnapshot]) -> Optional[List[str]]:
+    """The lesson's own names, then the ones from presence (in the order they joined), without repeats."""
+    entries: List[Dict[str, Any]] = sorted((doc.to_dict() for doc in presence_docs), key=lambda entry: entry.get('started_at') or "")
+    names = list(student_names_started or [])
+    seen = set(names)
+    for entry in entries:
+        if entry.get('student_name') not in seen:
+            seen.add(entry.get('student_name'))
+            names.append(entry.get('student_name'))
+    if student_names_started is None and len(names) == 0:
+        return None
+    return names
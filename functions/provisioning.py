@@ -0,0 +1,186 @@
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from google.cloud.firestore_v1 import Client, DocumentReference, DocumentSnapshot
+from google.cloud.firestore_v1.bulk_writer import BulkWriter
+from data_model import Teacher
+from sync import KIND_LESSON_RESPONSE, record_tombstone, server_now
+
+# Copies the default (template) lessons into teachers' accounts: each template lesson with
+# its responses, lesson plan, questions, class and students, under the same ids. Templates
+# are read once per run, teachers are provisioned concurrently and independently, and a
+# doc is only written when its content differs from what the teacher already has.
+
+# Fields that differ between copies without the content having changed
+_UNCOMPARED_FIELDS = ['updated_at']
+
+# A new teacher's `onboarding_status`, while their copy of the templates is made in the background
+ONBOARDING_PENDING = 'pending'
+ONBOARDING_RUNNING = 'running'
+ONBOARDING_DONE = 'done'
+ONBOARDING_FAILED = 'failed'
+MAX_ONBOARDING_ATTEMPTS = 3
+
+
+@dataclass
+class LessonTemplate:
+    template_teacher_id: str
+    lesson: Dict[str, Any]
+    responses: List[Dict[str, Any]]
+    lesson_plan: Dict[str, Any]
+    questions: List[Dict[str, Any]]
+    class_data: Dict[str, Any]
+    students: List[Dict[str, Any]]
+
+
+@dataclass
+class ProvisioningResult:
+    teachers_provisioned: int = 0
+    docs_written: int = 0
+    docs_unchanged: int = 0
+    docs_deleted: int = 0
+    errors_by_teacher_id: Dict[str, str] = field(default_factory=dict)
+
+
+def load_templates(db: Client, template_lesson_ids: List[str], max_workers: int = 8) -> List[LessonTemplate]:
+    """Read every template (given as "teacher_id:lesson_id") once, concurrently."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda template_lesson_id: _load_template(db, template_lesson_id), template_lesson_ids))
+
+
+def provision_teachers(db: Client, teachers: List[Teacher], templates: List[LessonTemplate], max_workers: int = 8) -> ProvisioningResult:
+    """Give every teacher every template. A teacher that fails doesn't stop the others."""
+    result = ProvisioningResult()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(provision_teacher, db, teacher, templates): teacher for teacher in teachers}
+        for future in as_completed(futures):
+            teacher = futures[future]
+            try:
+                teacher_result = future.result()
+            except Exception as e:
+                print(f"error configuring default lessons for teacher {teacher.email_address}: {e}")
+                result.errors_by_teacher_id[teacher.id] = str(e)
+                continue
+            result.teachers_provisioned += 1
+            result.docs_written += teacher_result.docs_written
+            result.docs_unchanged += teacher_result.docs_unchanged
+            result.docs_deleted += teacher_result.docs_deleted
+    return result
+
+
+def provision_teacher(db: Client, teacher: Teacher, templates: List[LessonTemplate]) -> ProvisioningResult:
+    result = ProvisioningResult()
+    teacher_ref = db.collection('teachers').document(teacher.id)
+    writer = db.bulk_writer()
+    try:
+        for template in templates:
+            if teacher.id == template.template_teacher_id:
+                continue
+            _provision_template(db, writer, teacher, teacher_ref, template, result)
+    finally:
+        writer.close()
+    return result
+
+
+def onboard_teacher(db: Client, teacher_id: str, template_lesson_ids: List[str]) -> Optional[ProvisioningResult]:
+    """Give one teacher the templates, reading only their doc, and keep their onboarding status up to date."""
+    teacher_ref = db.collection('teachers').document(teacher_id)
+    teacher_doc = teacher_ref.get()
+    if not teacher_doc.exists:
+        return None
+    _set_onboarding_status(teacher_ref, ONBOARDING_RUNNING)
+    try:
+        result = provision_teacher(db, Teacher(**teacher_doc.to_dict()), load_templates(db, template_lesson_ids))
+    except Exception as e:
+        # Raised again so that the task is retried
+        _set_onboarding_status(teacher_ref, ONBOARDING_FAILED, str(e))
+        raise
+    _set_onboarding_status(teacher_ref, ONBOARDING_DONE)
+    return result
+
+
+def _set_onboarding_status(teacher_ref: DocumentReference, status: str, error: Optional[str] = None):
+    teacher_ref.update({
+        "onboarding_status": status,
+        "onboarding_error": error,
+        "updated_at": server_now(),
+    })
+
+
+def _provision_template(
+    db: Client,
+    writer: BulkWriter,
+    teacher: Teacher,
+    teacher_ref: DocumentReference,
+    template: LessonTemplate,
+    result: ProvisioningResult,
+):
+    lesson_ref = teacher_ref.collection('lessons').document(template.lesson['id'])
+    lesson_plan_ref = teacher_ref.collection('lesson_plans').document(template.lesson_plan['id'])
+    class_ref = teacher_ref.collection('classes').document(template.class_data['id'])
+    # The teacher's current copies, to compare against
+    existing_lesson, existing_lesson_plan, existing_class = _get_all(db, [lesson_ref, lesson_plan_ref, class_ref])
+    existing_responses = {doc.id: doc for doc in lesson_ref.collection('responses').stream()}
+    existing_questions = {doc.id: doc for doc in lesson_plan_ref.collection('questions').stream()}
+    existing_students = {doc.id: doc for doc in class_ref.collection('students').stream()}
+
+    def put(ref: DocumentReference, data: Dict[str, Any], existing: Optional[DocumentSnapshot]):
+        if existing is not None and existing.exists and _content_hash(existing.to_dict()) == _content_hash(data):
+            result.docs_unchanged += 1
+            return
+        writer.set(ref, data | {"updated_at": server_now()})
+        result.docs_written += 1
+
+    # The lesson, its responses, its plan and the plan's questions always match the template
+    put(lesson_ref, template.lesson | {"teacher_email": teacher.email_address, "teacher_name": teacher.nickname}, existing_lesson)
+    template_response_ids = set()
+    for response in template.responses:
+        template_response_ids.add(response['id'])
+        put(lesson_ref.collection('responses').document(response['id']), response | {"teacher_email": teacher.email_address}, existing_responses.get(response['id']))
+    for response_id in existing_responses:
+        if response_id not in template_response_ids:
+            writer.delete(lesson_ref.collection('responses').document(response_id))
+            record_tombstone(db, teacher.id, KIND_LESSON_RESPONSE, response_id, template.lesson['id'], writer=writer)
+            result.docs_deleted += 1
+    put(lesson_plan_ref, template.lesson_plan | {"teacher_email": teacher.email_address}, existing_lesson_plan)
+    for question in template.questions:
+        put(lesson_plan_ref.collection('questions').document(question['id']), question | {"teacher_email": teacher.email_address}, existing_questions.get(question['id']))
+
+    # The class and its students are only added if missing, since the teacher may have edited them
+    if not existing_class.exists:
+        put(class_ref, template.class_data | {"teacher_email": teacher.email_address}, None)
+    for student in template.students:
+        if student['id'] not in existing_students:
+            put(class_ref.collection('students').document(student['id']), student | {"teacher_email": teacher.email_address}, None)
+
+
+def _load_template(db: Client, template_lesson_id: str) -> LessonTemplate:
+    [template_teacher_id, lesson_id] = template_lesson_id.split(':')
+    template_teacher_ref = db.collection('teachers').document(template_teacher_id)
+    lesson_ref = template_teacher_ref.collection('lessons').document(lesson_id)
+    lesson = lesson_ref.get().to_dict()
+    lesson_plan_ref = template_teacher_ref.collection('lesson_plans').document(lesson.get('lesson_plan_id'))
+    class_ref = template_teacher_ref.collection('classes').document(lesson.get('class_id'))
+    lesson_plan, class_data = _get_all(db, [lesson_plan_ref, class_ref])
+    return LessonTemplate(
+        template_teacher_id=template_teacher_id,
+        lesson=lesson,
+        responses=[doc.to_dict() for doc in lesson_ref.collection('responses').stream()],
+        lesson_plan=lesson_plan.to_dict(),
+        questions=[doc.to_dict() for doc in lesson_plan_ref.collection('questions').stream()],
+        class_data=class_data.to_dict(),
+        students=[doc.to_dict() for doc in class_ref.collection('students').stream()],
+    )
+
+
+def _get_all(db: Client, refs: List[DocumentReference]) -> List[DocumentSnapshot]:
+    # get_all doesn't keep the order it was given
+    snapshots_by_path = {snapshot.reference.path: snapshot for snapshot in db.get_all(refs)}
+    return [snapshots_by_path[ref.path] for ref in refs]
+
+
+def _content_hash(data: Dict[str, Any]) -> str:
+    comparable = {key: value for key, value in data.items() if key not in _UNCOMPARED_FIELDS}
+    return hashlib.sha256(json.dumps(comparable, sort_keys=True, default=str).encode('utf-8')).hexdigest()
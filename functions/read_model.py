@@ -0,0 +1,197 @@
+import dataclasses
+import hashlib
+import math
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud.firestore_v1 import DELETE_FIELD, Client, DocumentSnapshot, FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from data_model import Class, Lesson, LessonPlan, LessonQuestion, LessonResponsesSummary, Student, TeacherData
+from sync import server_now
+
+# A denormalized copy of each teacher's dashboard (the summary view of getTeacherData),
+# kept in three shard docs under teachers/{id}/read_models so that loading it is one
+# batched read. Triggers on the source collections keep the shards up to date one entry
+# at a time; `rebuild` recomputes them from scratch, for new teachers and for repairs.
+# A shard is only trusted once a rebuild has stamped it with `built_at`.
+
+READ_MODELS_COLLECTION = 'read_models'
+SHARD_CLASSES = 'classes'            # classes: {class_id: Class}, students: {class_id: {student_id: Student}}
+SHARD_LESSON_PLANS = 'lesson_plans'  # lesson_plans: {plan_id: LessonPlan}, questions: {plan_id: {question_id: LessonQuestion}}
+SHARD_LESSONS = 'lessons'            # lessons: {lesson_id: Lesson (summary fields)}, responses_summaries: {lesson_id: LessonResponsesSummary}
+SHARDS = [SHARD_CLASSES, SHARD_LESSON_PLANS, SHARD_LESSONS]
+
+# The lesson fields in the summary view: everything but the heavy or joined ones
+LESSON_SUMMARY_FIELDS = [
+    field.name for field in dataclasses.fields(Lesson)
+    if field.name not in ['student_names_started', 'class_data', 'lesson_plan', 'responses', 'responses_summary', 'analysis_by_question_id']
+]
+RESPONSE_SUMMARY_FIELDS = ['question_id', 'student_id']
+
+# Responses come in bursts (a whole class submitting at once), so a lesson's counts are
+# recounted once per window, after it closes, rather than on every response write
+RESPONSES_REFRESH_WINDOW_SEC = 10
+
+# Joined fields that never go in an entry
+_NESTED_FIELDS = ['students', 'questions']
+
+
+def summarize_responses(responses: List[Dict[str, Any]]) -> LessonResponsesSummary:
+    response_count_by_question_id: Dict[str, int] = {}
+    student_ids_submitted = set()
+    for response in responses:
+        question_id = response.get('question_id')
+        response_count_by_question_id[question_id] = response_count_by_question_id.get(question_id, 0) + 1
+        if response.get('student_id') is not None:
+            student_ids_submitted.add(response.get('student_id'))
+    return LessonResponsesSummary(
+        response_count=len(responses),
+        response_count_by_question_id=response_count_by_question_id,
+        student_ids_submitted=sorted(student_ids_submitted),
+    )
+
+
+def lesson_summary(lesson_dict: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: lesson_dict.get(field) for field in LESSON_SUMMARY_FIELDS}
+
+
+def lesson_summary_changed(before: Dict[str, Any], after: Dict[str, Any]) -> bool:
+    # Every write stamps updated_at, so it alone doesn't count as a change
+    return any(before.get(field) != after.get(field) for field in LESSON_SUMMARY_FIELDS if field != 'updated_at')
+
+
+def responses_refresh_schedule(teacher_id: str, lesson_id: str, now_sec: float) -> Tuple[str, int]:
+    """The refresh task id for the window `now_sec` falls in, and the seconds until that window closes."""
+    window = int(now_sec // RESPONSES_REFRESH_WINDOW_SEC)
+    lesson_key = hashlib.sha1(f"{teacher_id}/{lesson_id}".encode('utf-8')).hexdigest()
+    return f"{lesson_key}-{window}", max(1, math.ceil((window + 1) * RESPONSES_REFRESH_WINDOW_SEC - now_sec))
+
+
+######### Incremental updates (each replaces or removes one entry)
+
+def put_class(db: Client, teacher_id: str, class_id: str, class_dict: Optional[Dict[str, Any]]):
+    _put_entry(db, teacher_id, SHARD_CLASSES, ['classes', class_id], class_dict)
+    if class_dict is None:
+        _put_entry(db, teacher_id, SHARD_CLASSES, ['students', class_id], None)
+
+
+def put_student(db: Client, teacher_id: str, class_id: str, student_id: str, student_dict: Optional[Dict[str, Any]]):
+    _put_entry(db, teacher_id, SHARD_CLASSES, ['students', class_id, student_id], student_dict)
+
+
+def put_lesson_plan(db: Client, teacher_id: str, plan_id: str, plan_dict: Optional[Dict[str, Any]]):
+    _put_entry(db, teacher_id, SHARD_LESSON_PLANS, ['lesson_plans', plan_id], plan_dict)
+    if plan_dict is None:
+        _put_entry(db, teacher_id, SHARD_LESSON_PLANS, ['questions', plan_id], None)
+
+
+def put_question(db: Client, teacher_id: str, plan_id: str, question_id: str, question_dict: Optional[Dict[str, Any]]):
+    _put_entry(db, teacher_id, SHARD_LESSON_PLANS, ['questions', plan_id, question_id], question_dict)
+
+
+def put_lesson(db: Client, teacher_id: str, lesson_id: str, lesson_dict: Optional[Dict[str, Any]]):
+    # Soft-deleted lessons leave the dashboard just like deleted ones
+    if lesson_dict is not None and lesson_dict.get('deleted') is True:
+        lesson_dict = None
+    _put_entry(db, teacher_id, SHARD_LESSONS, ['lessons', lesson_id], lesson_summary(lesson_dict) if lesson_dict is not None else None)
+    if lesson_dict is None:
+        _put_entry(db, teacher_id, SHARD_LESSONS, ['responses_summaries', lesson_id], None)
+
+
+def refresh_lesson_responses(db: Client, teacher_id: str, lesson_id: str):
+    # Recounted rather than incremented, so a missed or repeated event can't skew the counts
+    responses = db.collection('teachers').document(teacher_id).collection('lessons').document(lesson_id).collection('responses').select(RESPONSE_SUMMARY_FIELDS).stream()
+    summary = summarize_responses([doc.to_dict() for doc in responses])
+    _put_entry(db, teacher_id, SHARD_LESSONS, ['responses_summaries', lesson_id], dataclasses.asdict(summary))
+
+
+def _put_entry(db: Client, teacher_id: str, shard: str, path: List[str], entry: Optional[Dict[str, Any]]):
+    shard_ref = _shard_ref(db, teacher_id, shard)
+    if entry is None:
+        shard_ref.set(_nest(path, DELETE_FIELD), merge=True)
+    else:
+        # Replaces the whole entry, leaving the rest of the shard alone
+        shard_ref.set(_nest(path, _without_nested(entry)), merge=[FieldPath(*path)])
+
+
+def _nest(path: List[str], value: Any) -> Dict[str, Any]:
+    for key in reversed(path):
+        value = {key: value}
+    return value
+
+
+######### Rebuild and load
+
+def rebuild(db: Client, teacher_id: str):
+    teacher_ref = db.collection('teachers').document(teacher_id)
+    teacher_email = teacher_ref.get().to_dict().get('email_address')
+
+    def stream_nested(collection_id: str, field_paths: List[str] = None) -> List[DocumentSnapshot]:
+        query = db.collection_group(collection_id).where(filter=FieldFilter('teacher_email', '==', teacher_email))
+        if field_paths is not None:
+            query = query.select(field_paths)
+        return [doc for doc in query.stream() if doc.reference.parent.parent.parent.parent.id == teacher_id]
+
+    classes_shard: Dict[str, Any] = {"classes": {}, "students": {}}
+    for doc in teacher_ref.collection('classes').stream():
+        classes_shard["classes"][doc.id] = _without_nested(doc.to_dict())
+    for doc in stream_nested('students'):
+        classes_shard["students"].setdefault(doc.reference.parent.parent.id, {})[doc.id] = doc.to_dict()
+
+    lesson_plans_shard: Dict[str, Any] = {"lesson_plans": {}, "questions": {}}
+    for doc in teacher_ref.collection('lesson_plans').stream():
+        lesson_plans_shard["lesson_plans"][doc.id] = _without_nested(doc.to_dict())
+    for doc in stream_nested('questions'):
+        lesson_plans_shard["questions"].setdefault(doc.reference.parent.parent.id, {})[doc.id] = doc.to_dict()
+
+    lessons_shard: Dict[str, Any] = {"lessons": {}, "responses_summaries": {}}
+    lesson_docs = teacher_ref.collection('lessons').where(filter=FieldFilter('deleted', '!=', True)).select(LESSON_SUMMARY_FIELDS).stream()
+    for doc in lesson_docs:
+        lessons_shard["lessons"][doc.id] = lesson_summary(doc.to_dict())
+    responses_by_lesson_id: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in stream_nested('responses', RESPONSE_SUMMARY_FIELDS):
+        responses_by_lesson_id.setdefault(doc.reference.parent.parent.id, []).append(doc.to_dict())
+    for lesson_id in lessons_shard["lessons"]:
+        lessons_shard["responses_summaries"][lesson_id] = dataclasses.asdict(summarize_responses(responses_by_lesson_id.get(lesson_id, [])))
+
+    built_at = server_now()
+    batch = db.batch()
+    for shard, data in [(SHARD_CLASSES, classes_shard), (SHARD_LESSON_PLANS, lesson_plans_shard), (SHARD_LESSONS, lessons_shard)]:
+        batch.set(_shard_ref(db, teacher_id, shard), data | {"built_at": built_at})
+    batch.commit()
+
+
+def load(db: Client, teacher: TeacherData) -> Optional[TeacherData]:
+    """The teacher's dashboard from the read model, or None if it hasn't been built."""
+    shard_docs = {doc.id: doc for doc in db.get_all([_shard_ref(db, teacher.id, shard) for shard in SHARDS])}
+    if any(shard not in shard_docs or not shard_docs[shard].exists or shard_docs[shard].to_dict().get('built_at') is None for shard in SHARDS):
+        return None
+    classes_shard = shard_docs[SHARD_CLASSES].to_dict()
+    lesson_plans_shard = shard_docs[SHARD_LESSON_PLANS].to_dict()
+    lessons_shard = shard_docs[SHARD_LESSONS].to_dict()
+
+    teacher.classes = [Class(**class_dict) for class_dict in (classes_shard.get('classes') or {}).values()]
+    teacher.classes.sort(key=lambda c: c.created_at)
+    for cls in teacher.classes:
+        cls.students = [Student(**student) for student in ((classes_shard.get('students') or {}).get(cls.id) or {}).values()]
+        cls.students.sort(key=lambda student: student.created_at)
+
+    teacher.lesson_plans = [LessonPlan(**plan) for plan in (lesson_plans_shard.get('lesson_plans') or {}).values()]
+    for plan in teacher.lesson_plans:
+        questions = ((lesson_plans_shard.get('questions') or {}).get(plan.id) or {}).values()
+        plan.questions = [LessonQuestion(**question) for question in questions] or None
+        if plan.questions is not None:
+            plan.questions.sort(key=lambda question: question.created_at)
+
+    teacher.lessons = [Lesson(**lesson) for lesson in (lessons_shard.get('lessons') or {}).values()]
+    teacher.lessons.sort(key=lambda l: l.created_at)
+    for lesson in teacher.lessons:
+        summary = (lessons_shard.get('responses_summaries') or {}).get(lesson.id)
+        lesson.responses_summary = LessonResponsesSummary(**summary) if summary is not None else summarize_responses([])
+    return teacher
+
+
+def _shard_ref(db: Client, teacher_id: str, shard: str):
+    return db.collection('teachers').document(teacher_id).collection(READ_MODELS_COLLECTION).document(shard)
+
+
+def _without_nested(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in entry.items() if key not in _NESTED_FIELDS}
@@ -0,0 +1,137 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+# Collapsing near-duplicate text responses before categorization. Short answers repeat a lot
+# ("mitochondria", "The mitochondria!"), and every repeat costs prompt tokens without telling
+# the LLM anything new. Responses are compared locally by the character n-grams of their
+# normalized text (TF-IDF weighted, cosine similarity), grouped by complete-linkage
+# agglomerative clustering, and only one representative of each group is sent. The
+# categories the representative gets are then given to every member of its group.
+#
+# Complete linkage means every pair in a group is at least SIMILARITY_THRESHOLD alike, so a
+# chain of small differences can't pull two different answers together. Similar characters
+# aren't enough on their own: "boils at 100 degrees" and "boils at 10 degrees", or "plants
+# get energy" and "plants do not get energy", differ by a few characters and mean opposite
+# things, so two texts are only grouped when their numbers and negations match exactly (see
+# `answer_key`). Only text responses are clustered; a response with a drawing is always its
+# own group.
+
+NGRAM_SIZES = (3, 4)
+SIMILARITY_THRESHOLD = 0.85
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+# Articles change nothing about an answer; negations and everything else are kept
+_ARTICLES = re.compile(r"\b(a|an|the)\b")
+_CONTRACTED_NOT = re.compile(r"n[\'’]t\b")
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_NEGATIONS = {"not", "no", "never", "none", "nothing", "nobody", "neither", "nor", "cannot", "without"}
+_WHITESPACE = re.compile(r"\s+")
+
+
+def cluster_responses(responses: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+    """Member response ids by representative response id, in the order of `responses`."""
+    # Identical once normalized: one entry up front, so the vectors only cover distinct texts
+    ids_by_text: Dict[str, List[str]] = {}
+    for resp in responses:
+        if not _has_drawing(resp):
+            ids_by_text.setdefault(normalize_text(resp.get('response_text')), []).append(resp.get('id'))
+    texts = list(ids_by_text.keys())
+    vectors = tfidf_vectors(texts)
+
+    representative_id_by_response_id: Dict[str, str] = {}
+    for group in agglomerate(vectors, SIMILARITY_THRESHOLD, [answer_key(text) for text in texts]):
+        # Represented by a response with the text most like the rest of its group
+        member_ids = [response_id for text_index in group for response_id in ids_by_text[texts[text_index]]]
+        representative_id = ids_by_text[texts[_medoid(vectors, group)]][0]
+        for response_id in member_ids:
+            representative_id_by_response_id[response_id] = representative_id
+    members_by_representative_id: Dict[str, List[str]] = {}
+    for resp in responses:
+        representative_id = representative_id_by_response_id.get(resp.get('id'), resp.get('id'))
+        members_by_representative_id.setdefault(representative_id, []).append(resp.get('id'))
+    return members_by_representative_id
+
+
+def expand_categories(response_ids_by_category: Dict[str, List[str]], members_by_representative_id: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Give every member of a group the categories its representative got."""
+    return {
+        category: [member_id for response_id in response_ids for member_id in members_by_representative_id.get(response_id, [response_id])]
+        for category, response_ids in response_ids_by_category.items()
+    }
+
+
+def normalize_text(text: Any) -> str:
+    text = _CONTRACTED_NOT.sub(" not", str(text or "").lower())
+    # Decimal points and thousands separators are part of the number
+    text = _NUMBER.sub(lambda match: match.group(0).replace(",", "").replace(".", "_"), text)
+    text = _ARTICLES.sub(" ", _NON_WORD.sub(" ", text))
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def answer_key(normalized_text: str) -> Tuple[Tuple[str, ...], int]:
+    """What two texts must share to be grouped: their numbers, in order, and how many negations they have."""
+    words = normalized_text.split(" ")
+    numbers = tuple(word for word in words if _NUMBER.fullmatch(word.replace("_", ".")))
+    return numbers, sum(1 for word in words if word in _NEGATIONS)
+
+
+def tfidf_vectors(texts: List[str]) -> np.ndarray:
+    """One L2-normalized row of character n-gram TF-IDF weights per text."""
+    ngram_counts: List[Dict[str, int]] = []
+    vocabulary: Dict[str, int] = {}
+    for text in texts:
+        padded = f" {text} "
+        counts: Dict[str, int] = {}
+        for n in NGRAM_SIZES:
+            for i in range(len(padded) - n + 1):
+                ngram = padded[i:i + n]
+                counts[ngram] = counts.get(ngram, 0) + 1
+                vocabulary.setdefault(ngram, len(vocabulary))
+        ngram_counts.append(counts)
+
+    tf = np.zeros((len(texts), max(1, len(vocabulary))))
+    for row, counts in enumerate(ngram_counts):
+        for ngram, count in counts.items():
+            tf[row, vocabulary[ngram]] = count
+    document_frequency = np.count_nonzero(tf, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    vectors = np.log1p(tf) * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def agglomerate(vectors: np.ndarray, threshold: float, keys: Optional[List[Any]] = None) -> List[List[int]]:
+    """
+    Complete-linkage clusters of the rows of `vectors` whose members are all at least
+    `threshold` similar (and, given `keys`, all have the same key).
+    """
+    similarity = vectors @ vectors.T
+    if keys is not None:
+        key_ids = {key: i for i, key in enumerate(dict.fromkeys(keys))}
+        key_index = np.array([key_ids[key] for key in keys])
+        similarity[key_index[:, None] != key_index[None, :]] = -np.inf
+    np.fill_diagonal(similarity, -np.inf)
+    active = np.ones(len(vectors), dtype=bool)
+    clusters: List[List[int]] = [[i] for i in range(len(vectors))]
+    while len(vectors) > 1:
+        masked = np.where(active[:, None] & active[None, :], similarity, -np.inf)
+        a, b = np.unravel_index(np.argmax(masked), masked.shape)
+        if masked[a, b] < threshold:
+            break
+        # A merged cluster is as similar to another as its least similar members are
+        similarity[a, :] = np.minimum(similarity[a, :], similarity[b, :])
+        similarity[:, a] = similarity[a, :]
+        similarity[a, a] = -np.inf
+        active[b] = False
+        clusters[a] += clusters[b]
+    return [sorted(clusters[i]) for i in range(len(vectors)) if active[i]]
+
+
+def _medoid(vectors: np.ndarray, group: List[int]) -> int:
+    group_vectors = vectors[group]
+    return group[int(np.argmax((group_vectors @ group_vectors.T).sum(axis=1)))]
+
+
+def _has_drawing(resp: Dict[str, Any]) -> bool:
+    return bool(resp.get('response_has_drawing') or resp.get('response_image_url') or resp.get('response_image_base64'))
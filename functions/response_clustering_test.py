@@ -0,0 +1,48 @@
+from response_clustering import cluster_responses, expand_categories
+
+
+def _responses(*texts):
+    return [{"id": f"r{i}", "response_text": text} for i, text in enumerate(texts)]
+
+
+def _grouped(responses, first_text, second_text):
+    texts = [resp["response_text"] for resp in responses]
+    first_id = responses[texts.index(first_text)]["id"]
+    second_id = responses[texts.index(second_text)]["id"]
+    return any(first_id in members and second_id in members for members in cluster_responses(responses).values())
+
+
+def test_groups_near_duplicates():
+    responses = _responses("mitochondria", "The mitochondria!", "mitochondria.", "chloroplast")
+    assert _grouped(responses, "mitochondria", "The mitochondria!")
+    assert _grouped(responses, "mitochondria", "mitochondria.")
+    assert not _grouped(responses, "mitochondria", "chloroplast")
+
+
+def test_keeps_different_numbers_apart():
+    responses = _responses("water boils at 100 degrees celsius", "water boils at 10 degrees celsius")
+    assert not _grouped(responses, "water boils at 100 degrees celsius", "water boils at 10 degrees celsius")
+
+
+def test_keeps_negations_apart():
+    positive = "plants get their energy from sunlight through photosynthesis in the leaves"
+    negative = "plants do not get their energy from sunlight through photosynthesis in the leaves"
+    contracted = "plants don't get their energy from sunlight through photosynthesis in the leaves"
+    responses = _responses(positive, negative, contracted)
+    assert not _grouped(responses, positive, negative)
+    assert not _grouped(responses, positive, contracted)
+    assert _grouped(responses, negative, contracted)
+
+
+def test_drawings_are_never_grouped():
+    responses = _responses("mitochondria", "mitochondria")
+    responses[1]["response_has_drawing"] = True
+    assert cluster_responses(responses) == {"r0": ["r0"], "r1": ["r1"]}
+
+
+def test_expand_categories_gives_members_their_representatives_categories():
+    responses = _responses("mitochondria", "The mitochondria!", "chloroplast")
+    members_by_representative_id = cluster_responses(responses)
+    representative_id = next(rid for rid, members in members_by_representative_id.items() if "r1" in members)
+    expanded = expand_categories({"Organelles": [representative_id, "r2"]}, members_by_representative_id)
+    assert sorted(expanded["Organelles"]) == ["r0", "r1", "r2"]
@@ -0,0 +1,164 @@
+import hashlib
+from typing import Callable, Optional
+from google.cloud.firestore_v1 import Client, DocumentReference, Transaction, transactional
+from data_model import Lesson, LessonQuestion, LessonResponse
+from lesson_analysis import build_response_summary_request, combine_response_summary
+from llm_gateway import LLMGateway
+from model_tiers import STAGE_RESPONSE_SUMMARY, stage_tiers
+from summary_cache import cache_drawing_summary, lookup_drawing_summary
+from sync import server_now
+
+# Summarizing a student's response happens in the background, off the student's submit
+# request. `putLessonResponse` marks the response pending and enqueues a task; the task
+# runs `run_summary_task`, which is safe to run more than once for the same submission.
+# The response's `analysis_status` tracks where it is:
+#   pending -> processing -> done
+#                         -> pending (retrying) -> ... -> failed (gave up, see analysis_error)
+
+STATUS_PENDING = 'pending'
+STATUS_PROCESSING = 'processing'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Attempts per submission, including the first; the task queue's retry config should match
+MAX_ATTEMPTS = 5
+
+
+def response_input_hash(response: LessonResponse) -> str:
+    """Identifies what a summary was made from, so a resubmission of the same answer isn't summarized twice."""
+    hasher = hashlib.sha256()
+    for part in [
+        response.question_id,
+        response.response_text,
+        response.response_image_url,
+        response.response_image_base64,
+    ]:
+        hasher.update((part or '').encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def summary_task_id(response_ref: DocumentReference, input_hash: str, submitted_at: str) -> str:
+    # The task queue drops a task whose id it has already seen, so a retried enqueue of the
+    # same submission is a no-op. A later submission with the same content gets its own task:
+    # it reset the response to pending, so an earlier task that already finished won't do.
+    return hashlib.sha256(f"{response_ref.path}:{input_hash}:{submitted_at}".encode('utf-8')).hexdigest()
+
+
+def summarize_response(
+    db: Client,
+    llm_gateway: LLMGateway,
+    load_image_base64: Callable[[str], str],
+    question: LessonQuestion,
+    response: LessonResponse,
+) -> str:
+    drawing_summary: Optional[str] = None
+
+    # If the student responded with a drawing, use Claude to summarize it, and append it to the summary
+    if response.response_has_drawing and response.response_image_url:
+        drawing_summary = summarize_drawing(db, llm_gateway, question, load_image_base64(response.response_image_url))
+
+    return combine_response_summary(response.response_text, drawing_summary)
+
+
+def summarize_drawing(db: Client, llm_gateway: LLMGateway, question: LessonQuestion, image_base64: str) -> str:
+    # Blank canvases and drawings we've already summarized for this question skip the LLM
+    drawing_summary, cache_key = lookup_drawing_summary(db, question.id, image_base64)
+    if drawing_summary is not None:
+        return drawing_summary
+
+    print("Calling Anthropic API -- messages.create()")
+    tiers = stage_tiers(db, STAGE_RESPONSE_SUMMARY)
+    message = llm_gateway.create_message_with_fallback(
+        [tier.params() for tier in tiers],
+        **build_response_summary_request(question, image_base64, tiers[0]),
+    )
+    print("Claude responded with content:")
+    print(message.content)
+    drawing_summary = message.content[0].text
+    if cache_key is not None:
+        cache_drawing_summary(db, cache_key, drawing_summary)
+    return drawing_summary
+
+
+def save_summary(response_ref: DocumentReference, summary: str, input_hash: str):
+    response_ref.set(document_data={
+        "analysis": {"response_summary": summary},
+        "analysis_status": STATUS_DONE,
+        "analysis_input_hash": input_hash,
+        "analysis_error": None,
+        "updated_at": server_now(),
+    }, merge=True)
+
+
+def run_summary_task(
+    db: Client,
+    llm_gateway: LLMGateway,
+    load_image_base64: Callable[[str], str],
+    response_path: str,
+    input_hash: str,
+):
+    """
+    Summarize one submission. Does nothing if the response has since been resubmitted or
+    deleted, or this submission was already summarized (or given up on). Raises to have the
+    task retried, until the last attempt, which marks the response failed instead.
+    """
+    response_ref = db.document(response_path)
+    response = _claim(db.transaction(), response_ref, input_hash)
+    if response is None:
+        return
+
+    try:
+        question = _get_question(db, response_ref, response)
+        summary = summarize_response(db, llm_gateway, load_image_base64, question, response)
+    except Exception as e:
+        gave_up = response.analysis_attempts >= MAX_ATTEMPTS
+        print(f"summary attempt {response.analysis_attempts} for {response_path} failed: {e}")
+        _finish(db.transaction(), response_ref, input_hash, {
+            "analysis_status": STATUS_FAILED if gave_up else STATUS_PENDING,
+            "analysis_error": str(e),
+        })
+        if gave_up:
+            return
+        raise
+
+    _finish(db.transaction(), response_ref, input_hash, {
+        "analysis": {"response_summary": summary},
+        "analysis_status": STATUS_DONE,
+        "analysis_error": None,
+    })
+
+
+@transactional
+def _claim(transaction: Transaction, response_ref: DocumentReference, input_hash: str) -> Optional[LessonResponse]:
+    snapshot = response_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    response = LessonResponse(**snapshot.to_dict())
+    if response.analysis_input_hash != input_hash or response.analysis_status in [STATUS_DONE, STATUS_FAILED]:
+        return None
+    response.analysis_status = STATUS_PROCESSING
+    response.analysis_attempts = (response.analysis_attempts or 0) + 1
+    transaction.update(response_ref, {
+        "analysis_status": response.analysis_status,
+        "analysis_attempts": response.analysis_attempts,
+        "updated_at": server_now(),
+    })
+    return response
+
+
+@transactional
+def _finish(transaction: Transaction, response_ref: DocumentReference, input_hash: str, fields: dict):
+    # Only if the student hasn't resubmitted in the meantime; the newer submission has its own task
+    snapshot = response_ref.get(transaction=transaction)
+    if snapshot.exists and snapshot.to_dict().get('analysis_input_hash') == input_hash:
+        transaction.update(response_ref, fields | {"updated_at": server_now()})
+
+
+def _get_question(db: Client, response_ref: DocumentReference, response: LessonResponse) -> LessonQuestion:
+    # teachers/{teacher_id}/lessons/{lesson_id}/responses/{response_id}
+    lesson_ref = response_ref.parent.parent
+    teacher_ref = lesson_ref.parent.parent
+    lesson = Lesson(**lesson_ref.get().to_dict())
+    question_doc = teacher_ref.collection('lesson_plans').document(lesson.lesson_plan_id).collection('questions').document(response.question_id).get()
+    return LessonQuestion(**question_doc.to_dict())
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import hashlib
+import io
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+from PIL import Image
+from google.cloud.firestore_v1 import Client
+from lesson_analysis import RESPONSE_SUMMARY_PROMPT_VERSION
+
+# Drawing summaries, keyed by what was drawn rather than who drew it. Resubmissions, copies
+# of the same template response and identical drawings to the same question all reuse one
+# summary, and blank canvases never reach the LLM at all. Entries expire through a TTL
+# policy on `expires_at` (see firestore.indexes.json).
+
+SUMMARY_CACHE_COLLECTION = 'response_summary_cache'
+SUMMARY_CACHE_TTL = timedelta(days=30)
+
+BLANK_DRAWING_SUMMARY = "(The drawing is blank.)"
+# A pixel counts as ink if it's noticeably darker than the white canvas...
+INK_THRESHOLD = 230
+# ...and a canvas with less ink than this (a stray tap, a dot) counts as blank
+BLANK_INK_FRACTION = 0.001
+
+
+@dataclass
+class NormalizedDrawing:
+    content_hash: str
+    is_blank: bool
+
+
+def normalize_drawing(image_base64: str) -> Optional[NormalizedDrawing]:
+    """Hash a drawing by its pixels, not its encoding. None if it isn't an image we can read."""
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+        image.load()
+    except (OSError, ValueError, binascii.Error):
+        return None
+    # Flatten transparency onto white, the way the canvas is shown, so a transparent and a
+    # white background hash the same
+    canvas = Image.new('RGBA', image.size, (255, 255, 255, 255))
+    canvas.alpha_composite(image.convert('RGBA'))
+    pixels = canvas.convert('RGB')
+
+    histogram = pixels.convert('L').histogram()
+    ink_pixels = sum(histogram[:INK_THRESHOLD])
+    hasher = hashlib.sha256(f"{pixels.width}x{pixels.height}:".encode('utf-8'))
+    hasher.update(pixels.tobytes())
+    return NormalizedDrawing(
+        content_hash=hasher.hexdigest(),
+        is_blank=ink_pixels < BLANK_INK_FRACTION * pixels.width * pixels.height,
+    )
+
+
+def lookup_drawing_summary(db: Client, question_id: str, image_base64: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    The summary to use for this drawing without asking the LLM, if there is one, and the
+    cache key a fresh summary should be saved under (None if the drawing can't be cached).
+    """
+    drawing = normalize_drawing(image_base64)
+    if drawing is None:
+        return None, None
+    if drawing.is_blank:
+        return BLANK_DRAWING_SUMMARY, None
+
+    cache_key = hashlib.sha256(
+        f"v{RESPONSE_SUMMARY_PROMPT_VERSION}:{question_id}:{drawing.content_hash}".encode('utf-8')
+    ).hexdigest()
+    snapshot = db.collection(SUMMARY_CACHE_COLLECTION).document(cache_key).get()
+    if snapshot.exists:
+        entry = snapshot.to_dict()
+        # TTL deletion runs eventually, not exactly on time
+        if entry.get('expires_at') is None or entry['expires_at'] > datetime.now(timezone.utc):
+            print(f"reusing the cached summary of drawing {drawing.content_hash[:12]}")
+            return entry.get('drawing_summary'), cache_key
+    return None, cache_key
+
+
+def cache_drawing_summary(db: Client, cache_key: str, drawing_summary: str):
+    now = datetime.now(timezone.utc)
+    db.collection(SUMMARY_CACHE_COLLECTION).document(cache_key).set({
+        "drawing_summary": drawing_summary,
+        "prompt_version": RESPONSE_SUMMARY_PROMPT_VERSION,
+        "created_at": now.isoformat(),
+        "expires_at": now + SUMMARY_CACHE_TTL,
+    })
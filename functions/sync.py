@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from google.cloud.firestore_v1 import Client
+from google.cloud.firestore_v1.bulk_writer import BulkWriter
+
+# Delta sync support. Every write the server makes stamps `updated_at` with the server's
+# clock (`server_now`), and every hard delete leaves a tombstone, so a client can ask for
+# just what changed since its last sync.
+
+TOMBSTONES_COLLECTION = 'tombstones'
+
+# Tombstone kinds, one per entity that can be deleted outright
+KIND_CLASS = 'class'
+KIND_STUDENT = 'student'
+KIND_LESSON_PLAN = 'lesson_plan'
+KIND_LESSON_QUESTION = 'lesson_question'
+KIND_LESSON_RESPONSE = 'lesson_response'
+
+# A write is stamped before it commits, so a sync can miss one that commits just after
+# its reads. Handing out a watermark a little in the past makes the next sync look again.
+WATERMARK_OVERLAP = timedelta(seconds=10)
+
+
+def server_now() -> str:
+    """The current time in the same format as the client's `new Date().toISOString()`, so they sort together."""
+    return _to_iso(datetime.now(timezone.utc))
+
+
+def sync_watermark() -> str:
+    return _to_iso(datetime.now(timezone.utc) - WATERMARK_OVERLAP)
+
+
+def record_tombstone(db: Client, teacher_id: str, kind: str, entity_id: str, parent_id: Optional[str] = None, writer: Optional[BulkWriter] = None):
+    """Written right away, or queued on `writer` alongside the delete it records."""
+    tombstone_ref = db.collection('teachers').document(teacher_id).collection(TOMBSTONES_COLLECTION).document(f"{kind}_{entity_id}")
+    tombstone = {
+        "kind": kind,
+        "id": entity_id,
+        "parent_id": parent_id,
+        "deleted_at": server_now(),
+    }
+    if writer is not None:
+        writer.set(tombstone_ref, tombstone)
+    else:
+        tombstone_ref.set(tombstone)
+
+
+def _to_iso(dt: datetime) -> str:
+    return dt.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
@@ -0,0 +1,37 @@
+from typing import Optional
+from google.cloud.firestore_v1 import Client, CollectionReference
+from identity import teacher_refs
+from sync import server_now
+
+# Students, questions and responses are found by collection-group queries on `teacher_email`
+# (see `_streamTeacherCollectionGroup` and `read_model.rebuild`), so a nested doc without
+# its teacher's email is invisible to them. The put handlers set it on the server now;
+# `backfill_teacher_emails` fixes the docs saved before that.
+
+# (parent collection, nested collection) under teachers/{teacher_id}
+_NESTED_COLLECTIONS = [
+    ('classes', 'students'),
+    ('lesson_plans', 'questions'),
+    ('lessons', 'responses'),
+]
+
+
+def backfill_teacher_emails(db: Client, teacher_id: Optional[str] = None) -> int:
+    """Set `teacher_email` on every nested doc (of one teacher, or of everyone) missing it. Returns how many changed."""
+    backfilled = 0
+    writer = db.bulk_writer()
+    for teacher_ref in teacher_refs(db, teacher_id):
+        teacher_doc = teacher_ref.get()
+        teacher_email = teacher_doc.to_dict().get('email_address') if teacher_doc.exists else None
+        if not teacher_email:
+            continue
+        for parent_collection, nested_collection in _NESTED_COLLECTIONS:
+            for parent_ref in teacher_ref.collection(parent_collection).list_documents():
+                nested_coll: CollectionReference = parent_ref.collection(nested_collection)
+                for doc in nested_coll.select(['teacher_email']).stream():
+                    if doc.to_dict().get('teacher_email') != teacher_email:
+                        # A new updated_at, so clients syncing deltas pick the doc up again
+                        writer.update(doc.reference, {"teacher_email": teacher_email, "updated_at": server_now()})
+                        backfilled += 1
+    writer.close()
+    return backfilled
@@ -9,12 +9,16 @@ export interface Teacher {
 	email_address: string
 	created_at: string
 	updated_at: string
+	onboarding_status?: 'pending' | 'running' | 'done' | 'failed'
+	onboarding_error?: string
 }
 
 export interface TeacherData extends Teacher {
 	classes?: ClassWithStudents[]
 	lesson_plans?: LessonPlanWithQuestions[]
 	lessons?: LessonWithResponses[]
+	lesson_plans_next_page_token?: string
+	lessons_next_page_token?: string
 }
 
 export interface Class {
@@ -81,15 +85,47 @@ export interface Lesson {
 	class_data?: ClassWithStudents
 	lesson_plan?: LessonPlanWithQuestions
 	analysis_by_question_id?: Record<string, LessonQuestionAnalysis>
+	analysis_job_id?: string
 }
 
 export interface LessonQuestionAnalysis {
 	question_id: string
+	// Filled in by the server when the lesson comes with its responses
 	responses_by_category: Record<string, LessonResponse[]>
+	response_ids_by_category?: Record<string, string[]>
+	categories_by_response_id?: Record<string, string[]>
+}
+
+export type AnalysisStatus = 'queued' | 'running' | 'retrying' | 'done' | 'failed'
+
+export interface QuestionAnalysisProgress {
+	status: AnalysisStatus
+	attempts: number
+	error?: string
+	analysis?: LessonQuestionAnalysis
+	updated_at?: string
+}
+
+export interface AnalysisJob {
+	id: string
+	teacher_email: string
+	lesson_id: string
+	status: AnalysisStatus
+	question_ids: string[]
+	progress_by_question_id: Record<string, QuestionAnalysisProgress>
+	created_at: string
+	updated_at: string
 }
 
 export interface LessonWithResponses extends Lesson {
 	responses?: LessonResponse[]
+	responses_summary?: LessonResponsesSummary
+}
+
+export interface LessonResponsesSummary {
+	response_count: number
+	response_count_by_question_id: Record<string, number>
+	student_ids_submitted: string[]
 }
 
 export interface LessonResponse {
@@ -104,6 +140,10 @@ export interface LessonResponse {
 	response_text?: string
 	response_has_drawing?: boolean
 	analysis?: LessonResponseAnalysis
+	analysis_status?: 'pending' | 'processing' | 'done' | 'failed'
+	analysis_attempts?: number
+	analysis_error?: string
+	analysis_input_hash?: string
 	created_at: string
 	updated_at: string
 }
@@ -126,3 +166,37 @@ export interface AppContext {
 	) => Promise<ReturnType | null>
 	uploadFile: (file: File, destFolder: string) => Promise<string>
 }
+
+export interface Page<T> {
+	items: T[]
+	next_page_token?: string
+}
+
+export interface Tombstone {
+	kind: 'class' | 'student' | 'lesson_plan' | 'lesson_question' | 'lesson_response'
+	id: string
+	parent_id?: string
+	deleted_at: string
+}
+
+export interface TeacherDataChanges {
+	watermark: string
+	classes: Class[]
+	students: Student[]
+	lesson_plans: LessonPlan[]
+	questions: LessonQuestion[]
+	lessons: Lesson[]
+	responses: LessonResponse[]
+	tombstones: Tombstone[]
+}
+
+// Patch mode for the put* endpoints: just the changed fields, plus the ids that locate the
+// doc (class_id for a student, lesson_plan_id for a question). Rejected if the doc's
+// updated_at is no longer expected_updated_at.
+export interface PatchRequest<T> {
+	id: string
+	class_id?: string
+	lesson_plan_id?: string
+	patch: Partial<T>
+	expected_updated_at?: string
+}